@@ -1,9 +1,10 @@
 import argparse
 import os
 import sys
-import xml.etree.ElementTree as ET
 from pathlib import Path
 
+from category_taxonomy import Taxonomy
+
 # Location for category data
 categoriesFilename = "/workspace/datasets/product_data/categories/categories_0001_abcat0010000_to_pcmcat99300050000.xml"
 parser = argparse.ArgumentParser(description="Process some integers.")
@@ -22,23 +23,14 @@ categoriesFilename = args.input
 # Optional arg to specify max depth of category tree
 maxDepth = args.max_depth
 
-tree = ET.parse(categoriesFilename)
-root = tree.getroot()
-
-catPathStrs = set()
-
-for child in root:
-    catPath = child.find("path")
-    catPathStr = ""
-    depth = 0
-    for cat in catPath:
-        if catPathStr != "":
-            catPathStr = catPathStr + " > "
-        catPathStr = catPathStr + cat.find("name").text
-        depth = depth + 1
-        catPathStrs.add(catPathStr)
-        if maxDepth > 0 and depth == maxDepth:
-            break
+taxonomy = Taxonomy.load(categoriesFilename)
+
+# Every category path, cut to maxDepth names, is the path of a category no
+#   deeper than maxDepth
+if maxDepth > 0:
+    catPathStrs = set(taxonomy.path_table()[taxonomy.depths < maxDepth])
+else:
+    catPathStrs = set(taxonomy.path_table())
 
 # Sort for readability
 for catPathStr in sorted(catPathStrs):
@@ -0,0 +1,214 @@
+"""Parsed BestBuy category taxonomy, cached as compact arrays
+
+| Shared by ``week2/createContentTrainingData.py``, the week3 scripts (through
+``week3/utils/taxonomy.py``) and ``categoryViewer.py``.  It only depends on
+numpy and pandas, and leaves logging configuration to the scripts.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+CATEGORIES_FILE: str = (
+    "/workspace/datasets/product_data/categories/"
+    "categories_0001_abcat0010000_to_pcmcat99300050000.xml"
+)
+
+# The root category, named Best Buy with id cat00000, doesn't have a parent
+ROOT_CATEGORY_ID: str = "cat00000"
+
+PATH_SEPARATOR: str = " > "
+
+# Columns of ``Taxonomy.parents_df``, the same as week3's
+#   ``COLNAMES.THIS_CATEGORY`` and ``COLNAMES.PARENT_CATEGORY``
+THIS_CATEGORY: str = "category"
+PARENT_CATEGORY: str = "parent"
+
+logger: logging.Logger = logging.getLogger(__name__)
+
+
+class Taxonomy:
+    """Category tree as arrays indexed by category position
+
+    | Parsing the categories XML takes seconds, so the arrays are cached in a
+    ``.npz`` file next to it and only re-parsed when the XML is newer
+
+    Attributes
+    ----------
+    ids : np.ndarray
+        | Category id of each category
+    names : np.ndarray
+        | Category name of each category
+    parents : np.ndarray
+        | Index of each category's parent (-1 for the root)
+    depths : np.ndarray
+        | Depth of each category (0 for the root)
+    ancestors : np.ndarray
+        | ``ancestors[i, d]`` is the index of the ancestor of category ``i``
+        at depth ``d`` (``i`` itself at its own depth, -1 below it)
+
+    Example usages
+    ---------------
+    >>> taxonomy = Taxonomy.load()
+    >>> taxonomy.path_names(taxonomy.index_of(["abcat0101001"]))
+    array(['Best Buy > TV & Home Theater > TVs > All Flat-Panel TVs'],
+          dtype=object)
+
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        names: np.ndarray,
+        parents: np.ndarray,
+        depths: np.ndarray,
+    ) -> None:
+        self.ids: np.ndarray = ids
+        self.names: np.ndarray = names
+        self.parents: np.ndarray = parents
+        self.depths: np.ndarray = depths
+        self.id_index: pd.Index = pd.Index(ids)
+        self.ancestors: np.ndarray = self.__ancestor_matrix()
+        self.__path_tables: Dict[int, np.ndarray] = {}
+
+    @classmethod
+    def load(
+        cls,
+        categories_file: str = CATEGORIES_FILE,
+        cache_file: Optional[str] = None,
+    ) -> Taxonomy:
+        """Load the taxonomy from its cache, or parse (and cache) the XML
+
+        Parameters
+        ----------
+        categories_file : str
+            | Path to the categories XML
+        cache_file : Optional[str]
+            | Path to the ``.npz`` cache;
+            defaults to the categories file with ``.taxonomy.npz`` appended
+
+        """
+        cache_file = cache_file or f"{categories_file}.taxonomy.npz"
+        if os.path.exists(cache_file) and os.path.getmtime(
+            cache_file
+        ) >= os.path.getmtime(categories_file):
+            logger.info("Load cached taxonomy from %s", cache_file)
+            with np.load(cache_file) as arrays:
+                return cls(
+                    arrays["ids"].astype(object),
+                    arrays["names"].astype(object),
+                    arrays["parents"],
+                    arrays["depths"],
+                )
+        taxonomy = cls.parse(categories_file)
+        try:
+            np.savez(
+                cache_file,
+                ids=taxonomy.ids.astype(str),
+                names=taxonomy.names.astype(str),
+                parents=taxonomy.parents,
+                depths=taxonomy.depths,
+            )
+            logger.info("Cached taxonomy to %s", cache_file)
+        except OSError as error:
+            logger.warning("Unable to cache taxonomy: %s", error)
+        return taxonomy
+
+    @classmethod
+    def parse(cls, categories_file: str = CATEGORIES_FILE) -> Taxonomy:
+        """Parse the categories XML
+
+        | Every category along every category's path becomes a node,
+        with the category before it in the path as its parent
+        """
+        logger.info("Parse categories from %s", categories_file)
+        positions: Dict[str, int] = {}
+        names, parents, depths = [], [], []
+        for child in ET.parse(categories_file).getroot():
+            parent = -1
+            for depth, cat in enumerate(child.find("path")):
+                cat_id = cat.find("id").text
+                if cat_id not in positions:
+                    positions[cat_id] = len(positions)
+                    names.append(cat.find("name").text)
+                    parents.append(parent)
+                    depths.append(depth)
+                parent = positions[cat_id]
+        return cls(
+            np.array(list(positions.keys()), dtype=object),
+            np.array(names, dtype=object),
+            np.array(parents, dtype=np.int32),
+            np.array(depths, dtype=np.int32),
+        )
+
+    def __ancestor_matrix(self) -> np.ndarray:
+        max_depth = int(self.depths.max()) if len(self.depths) > 0 else 0
+        ancestors = np.full((len(self.ids), max_depth + 1), -1, dtype=np.int32)
+        current = np.arange(len(self.ids), dtype=np.int32)
+        # Walk every category up one level at a time, filling in its ancestor
+        #   at each depth on the way
+        while (current >= 0).any():
+            has_current = np.flatnonzero(current >= 0)
+            ancestors[has_current, self.depths[current[has_current]]] = current[
+                has_current
+            ]
+            current[has_current] = self.parents[current[has_current]]
+        return ancestors
+
+    def index_of(self, category_ids: Iterable[str]) -> np.ndarray:
+        """Index of each category id, -1 for ids not in the taxonomy"""
+        return self.id_index.get_indexer(pd.Index(category_ids))
+
+    def ancestor_at(self, category_indices: np.ndarray, depth: int) -> np.ndarray:
+        """Ancestor at ``depth`` of each category, itself if not that deep"""
+        category_indices = np.asarray(category_indices)
+        depth = min(depth, self.ancestors.shape[1] - 1)
+        ancestors = self.ancestors[category_indices, depth]
+        return np.where(ancestors >= 0, ancestors, category_indices)
+
+    def path_table(self, max_depth: int = 0) -> np.ndarray:
+        """Path string (names joined by ``PATH_SEPARATOR``) of every category
+
+        | With ``max_depth`` > 0, paths keep only their first ``max_depth``
+        names.  Each table is built once and kept.
+        """
+        if max_depth not in self.__path_tables:
+            table = np.empty(len(self.ids), dtype=object)
+            # Parents are parsed before their children, so their paths are
+            #   always there to build on
+            for idx in range(len(self.ids)):
+                parent = self.parents[idx]
+                if parent < 0:
+                    table[idx] = self.names[idx]
+                elif max_depth > 0 and self.depths[idx] >= max_depth:
+                    table[idx] = table[parent]
+                else:
+                    table[idx] = f"{table[parent]}{PATH_SEPARATOR}{self.names[idx]}"
+            self.__path_tables[max_depth] = table
+        return self.__path_tables[max_depth]
+
+    def path_names(
+        self, category_indices: np.ndarray, max_depth: int = 0
+    ) -> np.ndarray:
+        """Path string of each category, NaN for index -1"""
+        table = np.append(self.path_table(max_depth), np.nan)
+        return table[np.asarray(category_indices)]
+
+    def parents_df(self) -> pd.DataFrame:
+        """Category vs. parent dataframe of every non-root category
+
+        | As used by ``rollup_category``
+        """
+        has_parent = self.parents >= 0
+        return pd.DataFrame(
+            {
+                THIS_CATEGORY: self.ids[has_parent],
+                PARENT_CATEGORY: self.ids[self.parents[has_parent]],
+            }
+        )
@@ -15,11 +15,15 @@ from urllib.parse import urljoin
 
 import click_models as cm
 import data_prepper as dp
+import feature_cache as fc
+import local_features as lf
 import ltr_utils as ltr
 import pandas as pd
 import search_utils as su
+import tree_eval as te
 import xgb_utils as xgbu
 from opensearchpy import OpenSearch
+from prior_index import PriorIndex
 
 if __name__ == "__main__":
     host = "localhost"
@@ -157,6 +161,36 @@ if __name__ == "__main__":
         action="store_true",
         help="Create the training data set by logging the features for the training file and then outputting in RankSVM format.  Must have --train_file and --featureset",
     )
+    xgb_group.add_argument(
+        "--feature_cache",
+        help="With --create_xgb_training, keep the logged features in this directory under --output_dir and only log the queries in --impressions_file that aren't in it yet.  The cache starts over whenever the featureset or the index changes",
+    )
+    xgb_group.add_argument(
+        "--local_features",
+        help="With --create_xgb_training, compute the --featureset features locally from a table of products instead of logging them through OpenSearch.  The argument is where to keep the product table under --output_dir; it is pulled from --index when it doesn't exist yet.  Text match features are approximated, see --local_features_parity",
+    )
+    xgb_group.add_argument(
+        "--local_features_workers",
+        type=int,
+        help="With --local_features, the number of processes to compute features with.  Defaults to the number of CPUs",
+    )
+    xgb_group.add_argument(
+        "--local_features_parity",
+        type=int,
+        default=0,
+        help="With --local_features, also log the features for this many randomly chosen queries through OpenSearch and write a comparison to local_features_parity.csv under --output_dir",
+    )
+    xgb_group.add_argument(
+        "--xgb_training_format",
+        choices=["text", "binary", "both"],
+        default="text",
+        help="With --create_xgb_training, write the training data as SVMRank text (training.xgb), as an XGB binary buffer built straight from the feature matrix (training.xgb.buffer), or both",
+    )
+    xgb_group.add_argument(
+        "--xgb_cache",
+        action="store_true",
+        help="Cache the training data as an XGB binary buffer (training.xgb.buffer under --output_dir).  With --create_xgb_training, the buffer is built straight from the training data.  With --xgb, the buffer is used instead of parsing the --xgb file if it was built from that same file (path, size and modification time are kept in training.xgb.buffer.source), and rebuilt otherwise.  Handy for trying out many --xgb_conf/--xgb_rounds",
+    )
     xgb_group.add_argument(
         "--train_file",
         default="train.csv",
@@ -178,6 +212,26 @@ if __name__ == "__main__":
         type=int,
         help="The number of rounds to train the model on.",
     )
+    xgb_group.add_argument(
+        "--xgb_sweep",
+        help='Path to a JSON grid of XGB params to sweep, e.g. {"eta": [0.1, 0.3], "max_depth": [3, 6], "num_rounds": [5, 20]}.  Trains one model per combination in parallel from the cached training.xgb.buffer (rebuilt from --xgb unless it was built from it), scores each offline on held out queries and writes --xgb_sweep_output.  Other params come from --xgb_conf',
+    )
+    xgb_group.add_argument(
+        "--xgb_sweep_output",
+        default="xgb_sweep_leaderboard.csv",
+        help="File under --output_dir to write the --xgb_sweep leaderboard to",
+    )
+    xgb_group.add_argument(
+        "--xgb_sweep_holdout",
+        default=0.2,
+        type=float,
+        help="Fraction of query groups to hold out for scoring --xgb_sweep models",
+    )
+    xgb_group.add_argument(
+        "--xgb_sweep_workers",
+        type=int,
+        help="Number of processes to use for --xgb_sweep.  Defaults to the number of cores",
+    )
     xgb_group.add_argument(
         "--xgb_model",
         default="xgb_model.model",
@@ -186,6 +240,43 @@ if __name__ == "__main__":
     xgb_group.add_argument(
         "--xgb_model_name", default="ltr_model", help="The name of the model"
     )
+    xgb_group.add_argument(
+        "--xgb_max_trees",
+        type=int,
+        help="Only export the first N trees of the model to the LTR model file, to make it smaller and cheaper to score",
+    )
+    xgb_group.add_argument(
+        "--xgb_threshold_digits",
+        type=int,
+        help="Round the split thresholds in the LTR model file to this many significant digits, to make it smaller",
+    )
+    xgb_group.add_argument(
+        "--xgb_cost",
+        action="store_true",
+        help="Estimate the cost of rescoring with the --xgb_model LTR model by scoring --xgb_cost_data with it locally",
+    )
+    xgb_group.add_argument(
+        "--xgb_cost_data",
+        help="A CSV of logged features to use for --xgb_cost and --xgb_latency_budget.  Defaults to training.xgb.csv in --output_dir",
+    )
+    xgb_group.add_argument(
+        "--xgb_cost_windows",
+        nargs="+",
+        type=int,
+        default=[100, 250, 500, 1000],
+        help="The rescore window sizes to estimate the cost of with --xgb_cost",
+    )
+    xgb_group.add_argument(
+        "--xgb_node_ns",
+        type=float,
+        default=5.0,
+        help="How many nanoseconds it takes the LTR plugin to go through one tree node, for --xgb_cost",
+    )
+    xgb_group.add_argument(
+        "--xgb_latency_budget",
+        type=float,
+        help="The most milliseconds rescoring a query with a 500 doc window may take, checked against a worst case bound: every doc in the window visiting the 99th percentile number of nodes per doc.  With --upload_ltr_model, models over budget aren't uploaded",
+    )
     xgb_group.add_argument(
         "--xgb_plot",
         action="store_true",
@@ -195,6 +286,17 @@ if __name__ == "__main__":
         "--xgb_test",
         help="Given a path to a test data set, created separately from the train set, see how our model does!",
     )
+    xgb_group.add_argument(
+        "--xgb_test_offline",
+        action="store_true",
+        help="With --xgb_test, retrieve the candidates for each test query once, log their features once and apply --xgb_model locally to simulate the LTR rescore, instead of sending the LTR queries to OpenSearch.  Requires --xgb_feat_map",
+    )
+    xgb_group.add_argument(
+        "--xgb_test_batch_size",
+        default=50,
+        type=int,
+        help="With --xgb_test_offline, how many test queries to send to OpenSearch per msearch",
+    )
     xgb_group.add_argument(
         "--xgb_test_output",
         default="xgb_test_output.csv",
@@ -242,20 +344,36 @@ if __name__ == "__main__":
         default=100,
         help="The maximum number of explains to output",
     )
+    analyze_group.add_argument(
+        "--explain_workers",
+        type=int,
+        default=8,
+        help="The number of explain requests to run against OpenSearch at the same time.  Used by --analyze_explains and --lookup_explain",
+    )
+    analyze_group.add_argument(
+        "--explain_per_query",
+        action="store_true",
+        help="Get all the explains for a query from a single search with explain turned on, rather than one explain call per query/sku pair.  Used by --analyze_explains and --lookup_explain",
+    )
 
     click_group = parser.add_argument_group("Click Models")
     click_group.add_argument(
         "--click_model",
-        choices=[
-            "ctr",
-            "binary",
-            "beta",
-            "quantiles",
-            "beta_quantiles",
-            "heuristic",
-        ],
+        choices=list(cm.CLICK_MODELS.keys()),
         default="ctr",
-        help="Simple Click-through-rate model",
+        help="The click model to grade the training data with.  Defaults to a simple click-through-rate model.  See click_models.CLICK_MODELS",
+    )
+    click_group.add_argument(
+        "--click_model_gamma",
+        type=float,
+        default=0.9,
+        help="For the dbn click model, the probability a user who wasn't satisfied keeps reading down the results, in (0, 1]",
+    )
+    click_group.add_argument(
+        "--click_model_iterations",
+        type=int,
+        default=50,
+        help="For the pbm click model, the number of EM iterations to fit it with",
     )
     click_group.add_argument(
         "--downsample",
@@ -288,6 +406,11 @@ if __name__ == "__main__":
         type=int,
         help="The total number of rows from the input file to put in the test split.  Helpful for testing code, but likely won't produce good results since it won't have insights into clicks.  See --xgb_test_num_queries.",
     )
+    split_group.add_argument(
+        "--split_chunksize",
+        type=int,
+        help="If set, split --split_input in a streaming fashion, reading this many rows at a time.  Use this when the click logs don't fit in memory.",
+    )
 
     # Some handy utilities
     util_group = parser.add_argument_group("Utilities")
@@ -304,7 +427,23 @@ if __name__ == "__main__":
     util_group.add_argument(
         "--verify_products",
         action="store_true",
-        help="Looks through all SKUs in --all_clicks and reports the ones that aren't in the index. Argument is where to output the items to under --output. WARNING: This is slow.",
+        help="Looks through all SKUs in --all_clicks and reports the ones that aren't in the index. Argument is where to output the items to under --output. Uses batched _mget requests, see --verify_batch_size and --verify_workers.",
+    )
+    util_group.add_argument(
+        "--prior_index",
+        help="If set, the directory under --output_dir to save the click prior index to and load it from.  The index is built from --train_file for --xgb_test and --analyze, and from --all_clicks for --lookup_query, and is rebuilt whenever it was built from another file or those files change.",
+    )
+    util_group.add_argument(
+        "--verify_batch_size",
+        type=int,
+        default=1000,
+        help="With --verify_products, the number of SKUs to look up per _mget request",
+    )
+    util_group.add_argument(
+        "--verify_workers",
+        type=int,
+        default=4,
+        help="With --verify_products, the number of _mget requests to run at the same time",
     )
     util_group.add_argument(
         "--verify_file",
@@ -340,6 +479,9 @@ if __name__ == "__main__":
     output_dir = args.output_dir
     if os.path.isdir(output_dir) == False:
         os.mkdir(output_dir)
+    training_buffer_file = "%s/training.xgb.buffer" % output_dir
+    # If we build the training DMatrix in this run, we can hand it straight to training
+    dtrain = None
 
     ltr_store_name = (
         args.ltr_store
@@ -353,15 +495,27 @@ if __name__ == "__main__":
     if args.split_input:
         # Split based on date.  All of our train data will be before a given date, and all test data will be after.
         # This simulates the real world and allows us to safely use prior clicks in our baseline retrieval and models
-        data_prepper.create_splits(
-            args.split_input,
-            args.split_train,
-            args.split_test,
-            output_dir,
-            args.split_train_rows,
-            args.split_test_rows,
-            args.verify_file,
-        )
+        if args.split_chunksize:
+            data_prepper.create_splits_streaming(
+                args.split_input,
+                args.split_train,
+                args.split_test,
+                output_dir,
+                args.split_train_rows,
+                args.split_test_rows,
+                args.verify_file,
+                chunksize=args.split_chunksize,
+            )
+        else:
+            data_prepper.create_splits(
+                args.split_input,
+                args.split_train,
+                args.split_test,
+                output_dir,
+                args.split_train_rows,
+                args.split_test_rows,
+                args.verify_file,
+            )
 
     # Create the LTR Store
     if args.create_ltr_store:
@@ -395,7 +549,19 @@ if __name__ == "__main__":
             rsp = ltr.post_featureset(featureset_path, the_feature_set, auth)
             print("Featureset Creation: %s" % rsp)
     # Upload an LTR model
-    if args.upload_ltr_model:
+    # With --xgb_latency_budget, check what the model would cost in the rescore window before we replace the old one
+    upload_ltr_model = args.upload_ltr_model
+    if upload_ltr_model and args.xgb_latency_budget is not None:
+        upload_ltr_model = te.check_model_cost(
+            "%s.ltr" % args.xgb_model,
+            pd.read_csv(args.xgb_cost_data or "%s/training.xgb.csv" % output_dir),
+            window_sizes=args.xgb_cost_windows,
+            node_ns=args.xgb_node_ns,
+            latency_budget=args.xgb_latency_budget,
+        )
+        if not upload_ltr_model:
+            print("Not uploading %s.ltr" % args.xgb_model)
+    if upload_ltr_model:
         # delete any old model first
         ltr.delete_model(
             urljoin(ltr_model_path + "/", "_model/{}".format(args.xgb_model_name)),
@@ -405,9 +571,7 @@ if __name__ == "__main__":
             ltr_model_path + "/", "_featureset/{}".format(feat_name)
         )
         model_path = urljoin(featureset_path + "/", "_createmodel")
-        os_model_file = "%s.ltr" % args.xgb_model
-        with open(os_model_file) as model_file:
-            ltr.upload_model(model_path, json.load(model_file), auth)
+        ltr.upload_model_file(model_path, "%s.ltr" % args.xgb_model, auth)
 
     ######
     #
@@ -488,6 +652,8 @@ if __name__ == "__main__":
     # Finally, we output two files: 1) training.xgb -- the file to feed to XGB for training
     # 2) training.xgb.csv -- a CSV version of the training data that is easier to work with in Pandas than the XGB file.
     #       This CSV file can be useful for debugging purposes.
+    # With --xgb_training_format binary (or both), we skip (or add to) the text file and write training.xgb.buffer,
+    # an XGB binary DMatrix built directly from the feature matrix, which XGB can load without parsing.
     #
     #####
     if args.create_xgb_training and args.impressions_file:
@@ -505,11 +671,49 @@ if __name__ == "__main__":
             # We need our featureset
             with open(args.featureset) as json_file:
                 the_feature_set = json.load(json_file)
-                # Log our features for the training set
-                print("Logging features")
-                features_df = data_prepper.log_features(
-                    impressions_df, terms_field=args.ltr_terms_field
-                )
+                if args.local_features:
+                    products = lf.load_product_table(
+                        "%s/%s" % (output_dir, args.local_features),
+                        opensearch,
+                        index_name,
+                        the_feature_set,
+                    )
+                    engine = lf.LocalFeatureEngine(the_feature_set, products)
+                    log_features = lambda df: engine.log_features(
+                        df, workers=args.local_features_workers
+                    )
+                else:
+                    # Log our features for the training set
+                    print("Logging features")
+                    log_features = lambda df: data_prepper.log_features(
+                        df, terms_field=args.ltr_terms_field
+                    )
+                if args.feature_cache:
+                    feature_cache = fc.FeatureCache(
+                        "%s/%s" % (output_dir, args.feature_cache),
+                        the_feature_set,
+                        fc.index_version(opensearch, index_name),
+                        source="local" if args.local_features else "opensearch",
+                    )
+                    features_df = feature_cache.log_features(
+                        impressions_df, log_features
+                    )
+                else:
+                    features_df = log_features(impressions_df)
+                if args.local_features and args.local_features_parity > 0:
+                    parity_df = lf.check_parity(
+                        engine,
+                        features_df,
+                        impressions_df,
+                        lambda sample: data_prepper.log_features(
+                            sample, terms_field=args.ltr_terms_field
+                        ),
+                        num_queries=args.local_features_parity,
+                    )
+                    print(parity_df)
+                    parity_df.to_csv(
+                        "%s/local_features_parity.csv" % output_dir, index=False
+                    )
                 # Calculate some stats so we can normalize values.
                 # Since LTR only supports min/max, mean/std. dev and sigmoid, we can only do that
                 if args.normalize_json:
@@ -540,17 +744,28 @@ if __name__ == "__main__":
                     train_features_df,
                     args.click_model,
                     downsample=args.downsample,
+                    gamma=args.click_model_gamma,
+                    iterations=args.click_model_iterations,
                 )
                 # Now write out in XGB/SVM Rank format
                 print("NAN counts: %s" % train_features_df.isna().any().count())
                 train_features_df = train_features_df.fillna(0)
                 train_features_df = train_features_df.sample(frac=1)  # shuffle
                 train_features_df.to_csv("%s/training.xgb.csv" % output_dir)
-                ltr.write_training_file(
-                    train_features_df,
-                    "%s/training.xgb" % output_dir,
-                    "%s/%s" % (output_dir, args.xgb_feat_map),
-                )
+                if args.xgb_training_format in ("text", "both"):
+                    ltr.write_training_file(
+                        train_features_df,
+                        "%s/training.xgb" % output_dir,
+                        "%s/%s" % (output_dir, args.xgb_feat_map),
+                    )
+                else:
+                    ltr.write_feature_map(
+                        train_features_df, "%s/%s" % (output_dir, args.xgb_feat_map)
+                    )
+                if args.xgb_cache or args.xgb_training_format in ("binary", "both"):
+                    dtrain = xgbu.write_training_buffer(
+                        train_features_df, training_buffer_file
+                    )
         else:
             print("Unable to create training file, no ranks/features data available.")
 
@@ -560,29 +775,56 @@ if __name__ == "__main__":
     # build a model by iterating --xgb_rounds using the --xgb_conf (see https://xgboost.readthedocs.io/en/stable/python/python_intro.html#setting-parameters)
     # Once training is complete, dump out the model as JSON and in the OpenSearch LTR model format (which has weird escaping: https://elasticsearch-learning-to-rank.readthedocs.io/en/latest/training-models.html)
     # Also save in XGB binary format.
+    # With --xgb_cache, the parsed training data is kept in training.xgb.buffer and reused on later runs.
     #
     #############
-    if args.xgb:
+    if args.xgb and not args.xgb_sweep:
         # Defaults
 
-        bst, xgb_params = xgbu.train(args.xgb, args.xgb_rounds, args.xgb_conf)
-        print("Dumping out model using feature map: %s" % args.xgb_feat_map)
-        model = bst.get_dump(
-            fmap=("%s/%s" % (output_dir, args.xgb_feat_map)),
-            dump_format="json",
+        bst, xgb_params = xgbu.train(
+            dtrain if dtrain is not None else args.xgb,
+            args.xgb_rounds,
+            args.xgb_conf,
+            cache_file=training_buffer_file if args.xgb_cache else None,
         )
-        # Write out both the raw and the LTR ready model to disk
-        # Create our metadata for uploading the model
-        model_name = args.xgb_model_name
-        ltr.write_opensearch_ltr_model(
-            model_name,
-            model,
+        print("Exporting model using feature map: %s" % args.xgb_feat_map)
+        # Write out both the raw and the LTR ready model to disk.  The LTR model is written tree by tree straight
+        # from the booster's arrays, optionally pruned to --xgb_max_trees and with rounded thresholds.
+        xgbu.export_ltr_model(
+            bst,
+            args.xgb_model_name,
             "%s/%s" % (output_dir, args.xgb_model),
+            "%s/%s" % (output_dir, args.xgb_feat_map),
             objective=xgb_params.get("objective", "reg:logistic"),
+            max_trees=args.xgb_max_trees,
+            threshold_digits=args.xgb_threshold_digits,
         )
         print("Saving XGB Binary model to %s/%s" % (output_dir, args.xgb_model))
         bst.save_model("%s/%s" % (output_dir, args.xgb_model))
 
+    # Sweep a grid of XGB params.  Every model trains off the same cached binary buffer and is scored on the same held
+    # out queries, without going to OpenSearch.  Writes a leaderboard, best NDCG@--precision first, to --xgb_sweep_output
+    if args.xgb_sweep:
+        sweep_buffer_file = training_buffer_file
+        if dtrain is None and args.xgb:
+            sweep_buffer_file, _ = xgbu.training_buffer(args.xgb, training_buffer_file)
+        leaderboard_df = xgbu.sweep(
+            sweep_buffer_file,
+            args.xgb_sweep,
+            xgb_conf=args.xgb_conf,
+            num_rounds=args.xgb_rounds,
+            holdout=args.xgb_sweep_holdout,
+            workers=args.xgb_sweep_workers,
+            k=args.precision,
+        )
+        print(
+            "Writing sweep leaderboard to %s/%s" % (output_dir, args.xgb_sweep_output)
+        )
+        leaderboard_df.to_csv(
+            "%s/%s" % (output_dir, args.xgb_sweep_output), index=False
+        )
+        print(leaderboard_df.head(10))
+
     # Output some useful XGB Plots using matplotlib: https://xgboost.readthedocs.io/en/stable/python/python_api.html#module-xgboost.plotting
     if args.xgb_plot:
         xgbu.plots(
@@ -592,6 +834,17 @@ if __name__ == "__main__":
             output_dir,
         )
 
+    # Score the training data (or --xgb_cost_data) with the LTR model locally to estimate how much it will cost to
+    # rescore a query for each --xgb_cost_windows window size.  See tree_eval.py
+    if args.xgb_cost:
+        te.check_model_cost(
+            "%s/%s.ltr" % (output_dir, args.xgb_model),
+            pd.read_csv(args.xgb_cost_data or "%s/training.xgb.csv" % output_dir),
+            window_sizes=args.xgb_cost_windows,
+            node_ns=args.xgb_node_ns,
+            latency_budget=args.xgb_latency_budget,
+        )
+
     ################
     #
     # Taking in the --xgb_test file and the --train_file (for accessing click priors), run --xgb_test_num_queries through
@@ -608,7 +861,11 @@ if __name__ == "__main__":
         test_data = pd.read_csv(args.xgb_test, parse_dates=["click_time", "query_time"])
         train_df = None
         # we use the training file for priors, but we must make sure we don't have leaks
-        if (
+        if args.train_file and args.prior_index:
+            train_df = PriorIndex.load_or_build(
+                "%s/%s/train" % (output_dir, args.prior_index), args.train_file
+            )
+        elif (
             args.train_file
         ):  # these should be pre-filtered, assuming we used our splitter, so let's not waste time filtering here
             train_df = pd.read_csv(
@@ -618,17 +875,35 @@ if __name__ == "__main__":
             print("You must provide the --train_file option")
             exit(2)
         # DataFrame: query, doc, rank, type, miss, score, new
-        results_df, no_results = su.evaluate_test_set(
-            test_data,
-            train_df,
-            opensearch,
-            args.xgb_model_name,
-            args.ltr_store,
-            args.index,
-            num_queries=args.xgb_test_num_queries,
-            main_query_weight=args.xgb_main_query_weight,
-            rescore_query_weight=args.xgb_rescore_query_weight,
-        )
+        if args.xgb_test_offline:
+            results_df, no_results = su.evaluate_test_set_offline(
+                test_data,
+                train_df,
+                opensearch,
+                xgbu.create_ltr_scorer(
+                    "%s/%s" % (output_dir, args.xgb_model),
+                    "%s/%s" % (output_dir, args.xgb_feat_map),
+                ),
+                feat_name,
+                args.ltr_store,
+                args.index,
+                num_queries=args.xgb_test_num_queries,
+                main_query_weight=args.xgb_main_query_weight,
+                rescore_query_weight=args.xgb_rescore_query_weight,
+                batch_size=args.xgb_test_batch_size,
+            )
+        else:
+            results_df, no_results = su.evaluate_test_set(
+                test_data,
+                train_df,
+                opensearch,
+                args.xgb_model_name,
+                args.ltr_store,
+                args.index,
+                num_queries=args.xgb_test_num_queries,
+                main_query_weight=args.xgb_main_query_weight,
+                rescore_query_weight=args.xgb_rescore_query_weight,
+            )
         print(
             "Writing results of test to %s"
             % "%s/%s"
@@ -662,10 +937,16 @@ if __name__ == "__main__":
             "%s/test.csv" % output_dir,
             parse_dates=["click_time", "query_time"],
         )
-        train_df = pd.read_csv(
-            "%s/%s" % (output_dir, args.train_file),
-            parse_dates=["click_time", "query_time"],
-        )
+        if args.prior_index:
+            train_df = PriorIndex.load_or_build(
+                "%s/%s/train" % (output_dir, args.prior_index),
+                "%s/%s" % (output_dir, args.train_file),
+            )
+        else:
+            train_df = pd.read_csv(
+                "%s/%s" % (output_dir, args.train_file),
+                parse_dates=["click_time", "query_time"],
+            )
 
         print("Analyzing results from %s/%s" % (output_dir, args.xgb_test_output))
         results_df = pd.read_csv("%s/%s" % (output_dir, args.xgb_test_output))
@@ -689,16 +970,27 @@ if __name__ == "__main__":
             precision=args.precision,
             analyze_explains=args.analyze_explains,
             max_explains=args.max_explains,
+            explain_workers=args.explain_workers,
+            explain_per_query=args.explain_per_query,
         )
     # Given a query in --all_clicks, output to the screen all of the documents that matched this query.  Can be useful for debugging.
     if args.lookup_query:
         query = args.lookup_query
+        all_clicks_priors = all_clicks_df
+        if args.prior_index:
+            all_clicks_priors = PriorIndex.load_or_build(
+                "%s/%s/all_clicks" % (output_dir, args.prior_index),
+                args.all_clicks,
+                all_clicks_df,
+            )
         su.lookup_query(
             query,
-            all_clicks_df,
+            all_clicks_priors,
             opensearch,
             index=index_name,
             explain=args.lookup_explain,
+            explain_workers=args.explain_workers,
+            explain_per_query=args.explain_per_query,
             source=[
                 "name",
                 "shortDescription",
@@ -718,19 +1010,15 @@ if __name__ == "__main__":
     # Loop through *ALL* unique SKUs from --all_clicks and validate they exist in the index by using the --lookup_product option to retrieve the document.
     # Outputs a data frame as CSV named validity.csv which tracks whether a SKU is in the index or not.  Can be used for filtering --all_clicks for training et. al.
     if args.verify_products:
-        skus = all_clicks_df["sku"].drop_duplicates()
-        print("Verifying %s skus.  This may take a while" % len(skus))
-        sku_tracker = []
-        valid_tracker = []
-        status = {"sku": sku_tracker, "status": valid_tracker}
-        for item in skus.iteritems():
-            doc = su.lookup_product(item[1], opensearch, index_name)
-            sku_tracker.append(item[1])
-            if doc is None:
-                valid_tracker.append(0)
-            else:
-                valid_tracker.append(1)
-        df = pd.DataFrame(status)
+        skus = all_clicks_df["sku"].dropna().drop_duplicates()
         output_file = "%s/%s" % (output_dir, args.verify_file)
-        print("Writing results to %s" % output_file)
-        df.to_csv(output_file, index=False)
+        print("Verifying %s skus, writing results to %s" % (len(skus), output_file))
+        num_valid = su.verify_products(
+            skus,
+            opensearch,
+            output_file,
+            index=index_name,
+            batch_size=args.verify_batch_size,
+            workers=args.verify_workers,
+        )
+        print("%s of %s skus are in the index" % (num_valid, len(skus)))
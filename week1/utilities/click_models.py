@@ -1,23 +1,32 @@
 # Implements various click models
+# Click models are registered in CLICK_MODELS by name.  A click model is a function that takes the impressions data
+# frame (plus any of the click model params it cares about) and returns an array with a grade between 0 and 1,
+# inclusive, for each row, along with the downsampler that suits the grades it produces.  Grades should be computed with
+# whole-column NumPy/Pandas operations, never a Python call per row.
+from collections import namedtuple
+
 import numpy as np
 import pandas as pd
 
+ClickModel = namedtuple("ClickModel", ["description", "grade", "downsample"])
+
+CLICK_MODELS = {}
+
+
+def register_click_model(name, description, downsample):
+    def register(grade):
+        CLICK_MODELS[name] = ClickModel(description, grade, downsample)
+        return grade
+
+    return register
+
 
 def binary_func(x):
-    if x > 0:
-        return 1
-    return 0
+    return np.where(x > 0, 1, 0)
 
 
 def step(x):
-    if x < 0.05:
-        return 0
-    elif x >= 0.05 and x < 0.10:
-        return 0.5
-    elif x >= 0.10 and x < 0.3:
-        return 0.75
-    else:
-        return 1
+    return np.select([x < 0.05, x < 0.10, x < 0.3], [0, 0.5, 0.75], default=1)
 
 
 # Given a click model type, transform the "grade" into an appropriate value between 0 and 1, inclusive
@@ -31,77 +40,36 @@ def apply_click_model(
     alpha=30,
     beta=70,
     quantiles=10,
+    gamma=0.9,
+    iterations=50,
 ):
-    if click_model_type == "binary":
-        print("Binary click model")
-        data_frame["grade"] = data_frame["clicks"].apply(lambda x: binary_func(x))
-        if downsample:
-            data_frame = down_sample_buckets(data_frame)
-    elif click_model_type == "ctr":
-        print("CTR click model")
-        data_frame["grade"] = (
-            data_frame["clicks"] / (data_frame["num_impressions"] + prior)
-        ).fillna(0)
-        if downsample:
-            data_frame = down_sample_continuous(data_frame)
-    elif click_model_type == "beta":
-        print("Beta click model")
-        clicks_alpha = data_frame["clicks"] + alpha
-        data_frame["grade"] = (
-            (clicks_alpha) / ((data_frame["num_impressions"] + beta) + (clicks_alpha))
-        ).fillna(0)
-        if downsample:
-            data_frame = down_sample_continuous(data_frame)
-    elif click_model_type == "quantiles":  # similar to step, but quantiles
-        print("CTR Quantiles click model")
-        data_frame["grade"] = (
-            pd.qcut(
-                (data_frame["clicks"] / (data_frame["num_impressions"] + prior)).fillna(
-                    0
-                ),
-                quantiles,
-                labels=False,
-            )
-            / quantiles
-        )
-        if downsample:
-            data_frame = down_sample_continuous(data_frame)
-    elif click_model_type == "beta_quantiles":  # similar to step, but quantiles
-        print("Beta quantiles click model")
-        clicks_alpha = data_frame["clicks"] + alpha
-        data_frame["grade"] = (
-            pd.qcut(
-                (
-                    (clicks_alpha)
-                    / ((data_frame["num_impressions"] + beta) + (clicks_alpha))
-                ).fillna(0),
-                quantiles,
-                labels=False,
-            )
-            / quantiles
-        )
-        if downsample:
-            data_frame = down_sample_continuous(data_frame)
-    elif click_model_type == "heuristic":
-        print("Heuristic click model")
-        data_frame["grade"] = (
-            (data_frame["clicks"] / (data_frame["num_impressions"] + prior)).fillna(0)
-            # .apply(lambda x: step(x))
-            .apply(step)
-        )
-        if downsample:
-            # print("Size pre-downsample: %s\nVal Counts: %s\n" % (len(data_frame), data_frame['grade'].value_counts()))
-            data_frame = down_sample_buckets(data_frame)
-            # print("Size post-downsample: %s\nVal Counts: %s\n" % (len(data_frame), data_frame['grade'].value_counts()))
+    click_model = CLICK_MODELS.get(click_model_type)
+    if click_model is None:
+        print("Unknown click model: %s" % click_model_type)
+        return data_frame
+    print(click_model.description)
+    data_frame["grade"] = click_model.grade(
+        data_frame,
+        prior=prior,
+        alpha=alpha,
+        beta=beta,
+        quantiles=quantiles,
+        gamma=gamma,
+        iterations=iterations,
+    )
+    if downsample:
+        data_frame = click_model.downsample(data_frame)
     return data_frame
 
 
+# Keep the same number of rows for each grade: shuffle, number the rows within each grade and keep the first n of each,
+# where n is the size of the smallest grade
 # https://stackoverflow.com/questions/55119651/downsampling-for-more-than-2-classes
 def down_sample_buckets(data_frame):
-    g = data_frame.groupby("grade", group_keys=False)
-    return pd.DataFrame(g.apply(lambda x: x.sample(g.size().min()))).reset_index(
-        drop=True
-    )
+    shuffled = data_frame.sample(frac=1)
+    min_size = shuffled["grade"].value_counts().min()
+    keep = shuffled.groupby("grade").cumcount().to_numpy() < min_size
+    return shuffled[keep].sort_values("grade", kind="stable").reset_index(drop=True)
 
 
 # Generate the probabilities for our grades and then use that to sample from
@@ -119,3 +87,218 @@ def down_sample_continuous(data_frame):
         print("Unable to downsample, keeping original:\n%s" % e)
         sample = data_frame  # data_frame.sort_values('grade').sample(frac=0.8, weights=sample_probs, replace=True)
     return sample
+
+
+def __ctr(data_frame, prior):
+    return (data_frame["clicks"] / (data_frame["num_impressions"] + prior)).fillna(0)
+
+
+def __beta(data_frame, alpha, beta):
+    clicks_alpha = data_frame["clicks"] + alpha
+    return (
+        (clicks_alpha) / ((data_frame["num_impressions"] + beta) + (clicks_alpha))
+    ).fillna(0)
+
+
+# Which quantile each value falls in, as a fraction.  Same buckets as pd.qcut(labels=False), but repeated edges (lots of
+# zero CTRs, say) just leave some buckets empty instead of raising an error.
+def __quantiles(values, quantiles):
+    edges = np.quantile(values, np.linspace(0, 1, quantiles + 1))
+    return np.digitize(values, edges[1:-1], right=True) / quantiles
+
+
+@register_click_model("ctr", "CTR click model", down_sample_continuous)
+def ctr_grades(data_frame, prior=1000, **params):
+    return __ctr(data_frame, prior).to_numpy()
+
+
+@register_click_model("binary", "Binary click model", down_sample_buckets)
+def binary_grades(data_frame, **params):
+    return binary_func(data_frame["clicks"].to_numpy())
+
+
+@register_click_model("beta", "Beta click model", down_sample_continuous)
+def beta_grades(data_frame, alpha=30, beta=70, **params):
+    return __beta(data_frame, alpha, beta).to_numpy()
+
+
+# similar to step, but quantiles
+@register_click_model("quantiles", "CTR Quantiles click model", down_sample_continuous)
+def quantile_grades(data_frame, prior=1000, quantiles=10, **params):
+    return __quantiles(__ctr(data_frame, prior).to_numpy(), quantiles)
+
+
+# similar to step, but quantiles
+@register_click_model(
+    "beta_quantiles", "Beta quantiles click model", down_sample_continuous
+)
+def beta_quantile_grades(data_frame, alpha=30, beta=70, quantiles=10, **params):
+    return __quantiles(__beta(data_frame, alpha, beta).to_numpy(), quantiles)
+
+
+@register_click_model("heuristic", "Heuristic click model", down_sample_buckets)
+def heuristic_grades(data_frame, prior=1000, **params):
+    return step(__ctr(data_frame, prior).to_numpy())
+
+
+#####
+#
+# Position aware click models.  The impressions are aggregated: each row is a query/doc pair shown at some rank, with
+# the number of times the query was seen (num_impressions) and the number of clicks the doc got (clicks).  These models
+# try to separate how attractive a doc is from how likely it was to be looked at in the first place given where it was
+# shown, and grade by the former.
+# Ranks are turned into 0-based positions within each query, so both the synthesized (1-based, by clicks) and the
+# retrieved (0-based, by score) impressions work.
+#
+#####
+def __positions(data_frame):
+    query_codes, _ = pd.factorize(data_frame["query_id"])
+    positions = (
+        data_frame.groupby(query_codes)["rank"].rank(method="dense").to_numpy(np.int64)
+        - 1
+    )
+    impressions = data_frame["num_impressions"].to_numpy(np.float64)
+    clicks = np.minimum(data_frame["clicks"].to_numpy(np.float64), impressions)
+    return query_codes, positions, clicks, impressions
+
+
+# Cascade model: the user reads down the results and clicks the first attractive one, then stops.  So a doc was looked
+# at every time the query was seen, minus the clicks on the docs above it, and its attractiveness is its clicks over
+# that (closed form, no fitting needed).
+@register_click_model("cascade", "Cascade click model", down_sample_continuous)
+def cascade_grades(data_frame, **params):
+    query_codes, positions, clicks, impressions = __positions(data_frame)
+    order = np.lexsort((positions, query_codes))
+    clicks_so_far = (
+        pd.Series(clicks[order]).groupby(query_codes[order]).cumsum().to_numpy()
+    )
+    clicks_above = np.empty(len(order))
+    clicks_above[order] = clicks_so_far - clicks[order]
+    examined = impressions - clicks_above
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.clip(np.where(examined > 0, clicks / examined, 0), 0, 1)
+
+
+# Position based model: a click happens when the user examines the position (with a probability that only depends on
+# the position) and the doc is attractive (with a probability that only depends on the query/doc).  Fitted with EM,
+# where the E step spreads the non-clicks between "not examined" and "not attractive".
+@register_click_model("pbm", "Position based click model", down_sample_continuous)
+def pbm_grades(data_frame, iterations=50, **params):
+    query_codes, positions, clicks, impressions = __positions(data_frame)
+    no_clicks = impressions - clicks
+    impressions_per_position = np.bincount(positions, weights=impressions)
+    attractiveness = np.full(len(positions), 0.5)
+    examination = np.full(len(impressions_per_position), 0.5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(iterations):
+            examined = examination[positions]
+            no_click_prob = 1 - examined * attractiveness
+            attractive_not_examined = (1 - examined) * attractiveness / no_click_prob
+            examined_not_attractive = examined * (1 - attractiveness) / no_click_prob
+            examination = np.where(
+                impressions_per_position > 0,
+                np.bincount(
+                    positions,
+                    weights=clicks + no_clicks * examined_not_attractive,
+                    minlength=len(examination),
+                )
+                / impressions_per_position,
+                0,
+            )
+            attractiveness = np.where(
+                impressions > 0,
+                (clicks + no_clicks * attractive_not_examined) / impressions,
+                0,
+            )
+    return np.clip(attractiveness, 0, 1)
+
+
+# Dynamic Bayesian Network model: like the cascade, but a user who clicks a doc is satisfied (and stops) with some
+# probability, and one who isn't satisfied keeps reading with probability gamma.  So the chance of examining a position
+# is the product of gamma * (1 - attractiveness * satisfaction) over the positions above it.
+# With aggregated impressions there are no click sequences, so there is nothing to tell one doc's satisfaction from its
+# neighbours'; like examination in the position based model, satisfaction is estimated per position, pooled over all
+# the queries, and docs are graded by their attractiveness.
+# Fitted with EM the same way as the position based model, except for where the examination comes from: the E step
+# spreads the non-clicks between "not examined" and "not attractive", which also gives the expected number of times
+# each position was examined; the M step re-estimates attractiveness from the former, and the satisfaction of a
+# position from how many of its clicks didn't carry on to the next position beyond the 1 - gamma that stop anyway.
+@register_click_model("dbn", "DBN click model", down_sample_continuous)
+def dbn_grades(data_frame, gamma=0.9, iterations=50, **params):
+    if not 0 < gamma <= 1:
+        raise ValueError(
+            "The DBN continuation probability gamma must be in (0, 1], got %s" % gamma
+        )
+    query_codes, positions, clicks, impressions = __positions(data_frame)
+    no_clicks = impressions - clicks
+    num_positions = positions.max(initial=0) + 1
+    # Docs tied for a position are examined together, so the examination chain steps over (query, position) groups.
+    # Sorted by query then position, a group's examination is the product over the groups before it in its query.
+    unique_keys, groups = np.unique(
+        query_codes.astype(np.int64) * num_positions + positions, return_inverse=True
+    )
+    num_groups = len(unique_keys)
+    group_positions = unique_keys % num_positions
+    group_queries = unique_keys // num_positions
+    first_group = np.searchsorted(group_queries, group_queries)
+    # Groups followed by the next position of the same query, which is where we learn about satisfaction
+    next_group = np.minimum(np.arange(1, num_groups + 1), max(num_groups - 1, 0))
+    has_next = (np.arange(num_groups) < num_groups - 1) & (
+        group_queries[next_group] == group_queries
+    )
+    group_clicks = np.bincount(groups, weights=clicks, minlength=num_groups)
+    group_rows = np.bincount(groups, minlength=num_groups)
+    attractiveness = np.full(len(positions), 0.5)
+    satisfaction = np.full(num_positions, 0.5)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for _ in range(iterations):
+            # E step
+            log_continue = np.bincount(
+                groups,
+                weights=np.log(
+                    np.maximum(1 - attractiveness * satisfaction[positions], 1e-12)
+                ),
+                minlength=num_groups,
+            )
+            before = np.cumsum(log_continue) - log_continue
+            examined = (
+                np.exp(before - before[first_group]) * gamma**group_positions
+            )[groups]
+            no_click_prob = 1 - examined * attractiveness
+            attractive_not_examined = (1 - examined) * attractiveness / no_click_prob
+            examined_not_attractive = examined * (1 - attractiveness) / no_click_prob
+            times_examined = (
+                np.bincount(
+                    groups,
+                    weights=clicks + no_clicks * examined_not_attractive,
+                    minlength=num_groups,
+                )
+                / group_rows
+            )
+            # M step
+            satisfied = np.bincount(
+                group_positions[has_next],
+                weights=(times_examined - times_examined[next_group] / gamma)[has_next],
+                minlength=num_positions,
+            )
+            clicked = np.bincount(
+                group_positions[has_next],
+                weights=group_clicks[has_next],
+                minlength=num_positions,
+            )
+            # The last position is never followed by another, so it gets the satisfaction of all the others
+            satisfaction = np.clip(
+                np.where(
+                    clicked > 0,
+                    satisfied / clicked,
+                    satisfied.sum() / clicked.sum() if clicked.sum() > 0 else 0.5,
+                ),
+                0,
+                1,
+            )
+            attractiveness = np.where(
+                impressions > 0,
+                (clicks + no_clicks * attractive_not_examined) / impressions,
+                0,
+            )
+    return np.clip(attractiveness, 0, 1)
@@ -6,12 +6,16 @@ from typing import Any, Dict, List
 import ltr_utils as lu
 import numpy as np
 import pandas as pd
+import prior_index as pi
 import query_utils as qu
 import requests
 from opensearchpy import RequestError
 
 # from importlib import reload
 
+# Sale/promotional queries look like: `LaborDay_HomeAppliances_20110902`
+JUNK_QUERY_REGEX = r"\w+_(\w+_)?[\w+|\d+]"
+
 
 class DataPrepper:
     opensearch = None
@@ -41,9 +45,7 @@ class DataPrepper:
     def filter_junk_clicks(self, clicks_df, verify_file, output_dir):
         # remove sale/promotional queries like: `LaborDay_HomeAppliances_20110902`
         print("Clicks pre filtering: %s" % len(clicks_df))
-        clicks_df = clicks_df[
-            clicks_df["query"].str.match("\w+_(\w+_)?[\w+|\d+]") == False
-        ]
+        clicks_df = self.__filter_promo_queries(clicks_df)
         # print("Clicks post filtering promos: %s" % len(clicks_df))
         verify_file_path = "%s/%s" % (output_dir, verify_file)
         print(
@@ -57,6 +59,29 @@ class DataPrepper:
         print("Clicks post filtering: %s" % len(clicks_df))
         return clicks_df
 
+    def __filter_promo_queries(self, clicks_df):
+        return clicks_df[clicks_df["query"].str.match(JUNK_QUERY_REGEX) == False]
+
+    # Load the SKUs marked as valid by --verify_products, or None if we don't have a verify file
+    def __load_valid_skus(self, verify_file, output_dir):
+        verify_file_path = "%s/%s" % (output_dir, verify_file)
+        if verify_file and os.path.exists(verify_file_path):
+            verify_df = pd.read_csv(verify_file_path)
+            return verify_df[verify_df["status"] == 1]["sku"].unique()
+        return None
+
+    # Read the click logs a chunk at a time, filtering out junk as we go
+    def __read_filtered_chunks(self, file_to_split, chunksize, valid_skus):
+        for chunk in pd.read_csv(
+            file_to_split,
+            parse_dates=["click_time", "query_time"],
+            chunksize=chunksize,
+        ):
+            chunk = self.__filter_promo_queries(chunk)
+            if valid_skus is not None:
+                chunk = chunk[chunk["sku"].isin(valid_skus)]
+            yield chunk
+
     def create_splits(
         self,
         file_to_split,
@@ -92,6 +117,92 @@ class DataPrepper:
         first.to_csv("%s/%s" % (output_dir, split_train), index=False)
         second.to_csv("%s/%s" % (output_dir, split_test), index=False)
 
+    # Same as create_splits, but never holds more than `chunksize` clicks in memory, so it works on click logs
+    # that are bigger than RAM.
+    # Pass 1 builds a histogram of click times bucketed at `time_resolution`.  This is our quantile sketch: its size
+    # depends on the time span of the logs, not on the number of clicks, and it gives us the median cut to within
+    # one bucket along with the exact number of clicks on each side of it.
+    # Pass 2 re-reads the logs and appends each chunk to the train or test file.  If --split_train_rows/--split_test_rows
+    # are set, we draw an exact uniform sample of that many rows by sampling each chunk in proportion to what is left.
+    def create_splits_streaming(
+        self,
+        file_to_split,
+        split_train,
+        split_test,
+        output_dir,
+        train_rows,
+        test_rows,
+        verify_file,
+        chunksize=1000000,
+        time_resolution="min",
+    ):
+        print(
+            "Streaming split: %s and writing train to: %s and test to: %s in %s, %s rows at a time"
+            % (file_to_split, split_train, split_test, output_dir, chunksize)
+        )
+        valid_skus = self.__load_valid_skus(verify_file, output_dir)
+        sketch = None
+        for chunk in self.__read_filtered_chunks(file_to_split, chunksize, valid_skus):
+            counts = chunk["click_time"].dt.floor(time_resolution).value_counts()
+            sketch = counts if sketch is None else sketch.add(counts, fill_value=0)
+        if sketch is None or sketch.sum() == 0:
+            print("No clicks left to split after filtering %s" % file_to_split)
+            return
+        sketch = sketch.sort_index()
+        cumulative = sketch.cumsum()
+        total = int(cumulative.iloc[-1])
+        cut_pos = int(np.searchsorted(cumulative.values, total / 2.0))
+        half = sketch.index[cut_pos]
+        num_first = int(cumulative.iloc[cut_pos])
+        num_second = total - num_first
+        print(
+            "Clicks post filtering: %s, splitting at %s into %s train and %s test clicks"
+            % (total, half, num_first, num_second)
+        )
+        rng = np.random.default_rng()
+        # for each side: [path, rows still to read, rows still to write, header written]
+        first = [
+            "%s/%s" % (output_dir, split_train),
+            num_first,
+            self.__num_rows_to_keep(train_rows, num_first),
+            False,
+        ]
+        second = [
+            "%s/%s" % (output_dir, split_test),
+            num_second,
+            self.__num_rows_to_keep(test_rows, num_second),
+            False,
+        ]
+        for chunk in self.__read_filtered_chunks(file_to_split, chunksize, valid_skus):
+            in_first = chunk["click_time"].dt.floor(time_resolution) <= half
+            self.__append_split_chunk(chunk[in_first], first, rng)
+            self.__append_split_chunk(chunk[~in_first], second, rng)
+
+    def __num_rows_to_keep(self, max_rows, num_rows):
+        if max_rows is not None and max_rows > 0:
+            return min(max_rows, num_rows)
+        return num_rows
+
+    # Write (a sample of) the chunk to this side of the split.  The number of rows we keep from the chunk is drawn from
+    # a hypergeometric distribution, which gives every row in the file the same chance of making it into the sample.
+    def __append_split_chunk(self, chunk, split, rng):
+        (path, rows_left, rows_wanted, header_written) = split
+        num_rows = len(chunk)
+        if num_rows == 0:
+            return
+        if rows_wanted < rows_left:
+            num_keep = rng.hypergeometric(num_rows, rows_left - num_rows, rows_wanted)
+            chunk = chunk.iloc[rng.permutation(num_rows)[:num_keep]]  # shuffle things
+        chunk.to_csv(
+            path,
+            mode="a" if header_written else "w",
+            header=not header_written,
+            index=False,
+        )
+        split[1] = rows_left - num_rows
+        split[2] = rows_wanted - len(chunk)
+        split[3] = True
+
     # Use the set of clicks and assume the clicks are in proportion to the actual rankings due to position bias
     #
     ## CAVEAT EMPTOR: WE ARE BUILDING A SYNTHETIC IMPRESSIONS DATA SET BECAUSE WE DON'T HAVE A PROPER ONE.
@@ -150,25 +261,15 @@ class DataPrepper:
         num_impressions = []
         product_names = []
         skus = []
-        query_gb = query_df.groupby("query")  # small
+        prior_index = pi.as_prior_index(query_df)  # small
         no_results = set()
-        for key in query_gb.groups.keys():
+        for key in sorted(prior_index.queries):
             query_id, query_counter = self.__get_query_id(
                 key, query_ids_map, query_counter
             )
             # print("Q[%s]: %s" % (query_id, key))
-            query_times_seen = 0  # careful here
-            prior_clicks_for_query = query_gb.get_group(key)
-            prior_doc_ids = None
-            prior_doc_id_weights = None
-            if prior_clicks_for_query is not None and len(prior_clicks_for_query) > 0:
-                prior_doc_ids = prior_clicks_for_query.sku.drop_duplicates()
-                prior_doc_id_weights = (
-                    prior_clicks_for_query.sku.value_counts()
-                )  # histogram gives us the click counts for all the doc_ids
-                query_times_seen = prior_clicks_for_query.sku.count()
-            click_prior_query = qu.create_prior_queries(
-                prior_doc_ids, prior_doc_id_weights, query_times_seen
+            click_prior_query, prior_skus, _, _, query_times_seen = prior_index.lookup(
+                key
             )
             query_obj = qu.create_query(
                 key,
@@ -193,9 +294,9 @@ class DataPrepper:
                     # we have a response with some hits
                     hits = response["hits"]["hits"]
                     # print(hits)
-                    skus_for_query = (
-                        prior_clicks_for_query.sku.drop_duplicates()
-                    )  # we are comparing skus later, so grab the Series now
+                    skus_for_query = set(
+                        prior_skus.tolist()
+                    )  # we are comparing skus later, so grab the set of clicked skus now
 
                     total_clicked_docs_per_query = 0
                     for (idx, hit) in enumerate(hits):
@@ -425,4 +526,4 @@ class DataPrepper:
 
     # Determine the number of clicks for this sku given a query (represented by the click group)
     def __num_clicks(self, all_skus_for_query, test_sku):
-        return all_skus_for_query[all_skus_for_query == test_sku].count()
+        return 1 if test_sku in all_skus_for_query else 0
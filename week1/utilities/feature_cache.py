@@ -0,0 +1,147 @@
+# A cache of logged LTR features, so re-running --create_xgb_training doesn't re-log features we already have.
+# The cache is content addressed: its key is a hash of the featureset, the index version (the index's uuid and doc
+# count) and where the features came from (OpenSearch or local_features), so changing any of those starts a new cache.
+# Within a cache, features are stored per query and sku.  If the featureset uses the click_prior_query param, the
+# features also depend on the clicks in the impressions, so we also keep a hash of each query's click prior query.
+# Only the queries in the impressions that aren't fully cached get logged.
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import query_utils as qu
+
+
+# Something that changes whenever the documents in the index do
+def index_version(opensearch, index):
+    uuid = opensearch.indices.get(index=index)[index]["settings"]["index"]["uuid"]
+    count = opensearch.count(index=index)["count"]
+    return "%s:%s" % (uuid, count)
+
+
+class FeatureCache:
+    def __init__(self, cache_dir, featureset, index_version, source="opensearch"):
+        key = json.dumps(
+            {"featureset": featureset, "index": index_version, "source": source},
+            sort_keys=True,
+        )
+        self.key = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        self.cache_dir = "%s/%s" % (cache_dir, self.key)
+        self.uses_prior = "click_prior_query" in json.dumps(featureset)
+        self.manifest = {"impressions": None, "features": []}
+        self.table = pd.DataFrame(
+            {
+                "query": pd.Series(dtype=object),
+                "sku": pd.Series(dtype=np.int64),
+                "prior": pd.Series(dtype=object),
+            }
+        )
+        if os.path.exists("%s/manifest.json" % self.cache_dir):
+            with open("%s/manifest.json" % self.cache_dir) as manifest_file:
+                self.manifest = json.load(manifest_file)
+            with np.load("%s/features.npz" % self.cache_dir) as columns:
+                table = {
+                    "query": columns["query"].astype(object),
+                    "sku": columns["sku"],
+                    "prior": columns["prior"].astype(object),
+                }
+                for idx, name in enumerate(self.manifest["features"]):
+                    table[name] = columns["f%s" % idx]
+            self.table = pd.DataFrame(table)
+            print(
+                "Loaded %s cached query/sku features from %s"
+                % (len(self.table), self.cache_dir)
+            )
+
+    # Returns the features for every query/sku in the impressions, in the same layout as DataPrepper.log_features,
+    # logging the queries we don't have with log_features (e.g. DataPrepper.log_features)
+    def log_features(self, impressions_df, log_features):
+        pairs = impressions_df[["query", "query_id", "sku"]].copy()
+        pairs["prior"] = self.__priors(impressions_df)
+        impressions_hash = self.__hash(pairs)
+        if impressions_hash != self.manifest["impressions"]:
+            cached = pd.merge(
+                pairs,
+                self.table[["query", "sku", "prior"]],
+                on=["query", "sku", "prior"],
+            )
+            cached_pairs = cached.groupby("query").size()
+            pair_counts = pairs.groupby("query").size()
+            missing = pair_counts.index[
+                cached_pairs.reindex(pair_counts.index, fill_value=0) < pair_counts
+            ]
+            print(
+                "%s of %s queries are cached, logging the other %s"
+                % (len(pair_counts) - len(missing), len(pair_counts), len(missing))
+            )
+            if len(missing) > 0:
+                missing_df = impressions_df[impressions_df["query"].isin(missing)]
+                self.__add(missing_df, pairs, log_features(missing_df))
+            self.manifest["impressions"] = impressions_hash
+            self.save()
+        else:
+            print("All features for these impressions are cached")
+        features_df = pd.merge(
+            pairs.drop_duplicates(["query_id", "sku"]),
+            self.table,
+            on=["query", "sku", "prior"],
+            how="inner",
+        ).drop(["query", "prior"], axis=1)
+        features_df.insert(0, "doc_id", features_df["sku"])
+        return features_df
+
+    def __add(self, missing_df, pairs, logged_df):
+        # drop anything we had for these queries, it's stale
+        self.table = self.table[~self.table["query"].isin(missing_df["query"])].copy()
+        # Keep the pairs that didn't get any features too (e.g. the doc isn't in the index), so we don't keep asking
+        logged_pairs = pairs[pairs["query"].isin(missing_df["query"])].drop_duplicates(
+            ["query", "sku"]
+        )
+        if logged_df is not None and len(logged_df) > 0:
+            logged_pairs = pd.merge(
+                logged_pairs,
+                logged_df.drop("doc_id", axis=1),
+                on=["query_id", "sku"],
+                how="left",
+            )
+        logged_df = logged_pairs.drop("query_id", axis=1)
+        for name in logged_df.columns:
+            if name not in self.table.columns:
+                self.table[name] = np.nan
+        self.table = pd.concat([self.table, logged_df], ignore_index=True)
+
+    def save(self):
+        if os.path.isdir(self.cache_dir) == False:
+            os.makedirs(self.cache_dir)
+        self.manifest["features"] = [
+            name for name in self.table.columns if name not in ("query", "sku", "prior")
+        ]
+        columns = {
+            "query": self.table["query"].astype(str).to_numpy(dtype=str),
+            "sku": self.table["sku"].to_numpy(dtype=np.int64),
+            "prior": self.table["prior"].astype(str).to_numpy(dtype=str),
+        }
+        for idx, name in enumerate(self.manifest["features"]):
+            columns["f%s" % idx] = self.table[name].to_numpy(dtype=np.float64)
+        print("Saving %s query/sku features to %s" % (len(self.table), self.cache_dir))
+        np.savez("%s/features.npz" % self.cache_dir, **columns)
+        with open("%s/manifest.json" % self.cache_dir, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file)
+
+    # A hash of each query's click prior query (the same one log_features uses), or "" if the featureset doesn't use it
+    def __priors(self, impressions_df):
+        if not self.uses_prior:
+            return ""
+        priors = {
+            query: hashlib.md5(
+                qu.create_prior_queries_from_group(group).encode("utf-8")
+            ).hexdigest()
+            for (query, group) in impressions_df.groupby("query")
+        }
+        return impressions_df["query"].map(priors)
+
+    def __hash(self, pairs):
+        return hashlib.sha1(
+            pd.util.hash_pandas_object(pairs, index=False).to_numpy().tobytes()
+        ).hexdigest()
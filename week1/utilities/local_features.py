@@ -0,0 +1,423 @@
+# Compute the LTR features in an LTR featureset (e.g. week1/conf/ltr_featureset.json) locally, from a table of products,
+# instead of logging them through OpenSearch one query at a time.
+#   * function_score features with field_value_factor functions are exact: they only depend on a field of the product.
+#   * match and match_phrase features are approximated with our own BM25 over the same fields, using an
+#     approximation of the english analyzer.  Scores won't match OpenSearch to the last digit (it scores per shard,
+#     encodes doc lengths lossily and has a more complete tokenizer), so check them with parity_report before trusting
+#     them.
+# Anything else (e.g. features that need the click_prior_query) is reported as unsupported and comes back missing.
+import math
+import os
+import re
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from nltk.stem import PorterStemmer
+from opensearchpy.helpers import scan
+
+# Lucene's english stop words
+STOP_WORDS = {
+    "a",
+    "an",
+    "and",
+    "are",
+    "as",
+    "at",
+    "be",
+    "but",
+    "by",
+    "for",
+    "if",
+    "in",
+    "into",
+    "is",
+    "it",
+    "no",
+    "not",
+    "of",
+    "on",
+    "or",
+    "such",
+    "that",
+    "the",
+    "their",
+    "then",
+    "there",
+    "these",
+    "they",
+    "this",
+    "to",
+    "was",
+    "will",
+    "with",
+}
+TOKEN_REGEX = re.compile(r"\w+(?:['.]\w+)*")
+# BM25 defaults
+K1 = 1.2
+B = 0.75
+
+stemmer = PorterStemmer(mode=PorterStemmer.ORIGINAL_ALGORITHM)
+stem_cache = {}
+
+
+# Roughly the english analyzer: tokenize, drop possessives, lowercase, remove stop words and Porter stem.
+# Returns (term, position) pairs.  Stop words still take up a position, like they do in Lucene, so phrases line up.
+def analyze(text):
+    analyzed = []
+    for position, token in enumerate(TOKEN_REGEX.findall(text.lower())):
+        if token.endswith("'s"):
+            token = token[:-2]
+        if token in STOP_WORDS:
+            continue
+        stemmed = stem_cache.get(token)
+        if stemmed is None:
+            stemmed = stemmer.stem(token)
+            stem_cache[token] = stemmed
+        analyzed.append((stemmed, position))
+    return analyzed
+
+
+# The product fields a featureset needs: (text fields, numeric fields)
+def featureset_fields(featureset):
+    text_fields = set()
+    numeric_fields = set()
+    for feature in featureset["featureset"]["features"]:
+        template = feature["template"]
+        for query_type in ["match", "match_phrase"]:
+            if query_type in template:
+                text_fields.update(template[query_type].keys())
+        func_temp = template.get("function_score")
+        if func_temp is not None:
+            for func in func_temp.get("functions", [func_temp]):
+                if "field_value_factor" in func:
+                    numeric_fields.add(func["field_value_factor"]["field"])
+    return sorted(text_fields), sorted(numeric_fields)
+
+
+# Pull the fields we need for every product out of the index into a data frame indexed by sku.  Text fields are joined
+# into a single string and numeric fields take their first value.
+def build_product_table(opensearch, index, featureset):
+    text_fields, numeric_fields = featureset_fields(featureset)
+    print(
+        "Building product table with %s from %s" % (text_fields + numeric_fields, index)
+    )
+    rows = []
+    for doc in scan(
+        opensearch,
+        index=index,
+        query={"_source": text_fields + numeric_fields, "query": {"match_all": {}}},
+    ):
+        source = doc["_source"]
+        row = {"sku": int(doc["_id"])}
+        for field in text_fields:
+            row[field] = " ".join(__as_list(source.get(field)))
+        for field in numeric_fields:
+            values = __as_list(source.get(field))
+            row[field] = float(values[0]) if len(values) > 0 else np.nan
+        rows.append(row)
+    return pd.DataFrame(rows, columns=["sku"] + text_fields + numeric_fields).set_index(
+        "sku"
+    )
+
+
+# Load the product table from product_table_file, or build it from the index and save it there if it doesn't exist
+def load_product_table(product_table_file, opensearch, index, featureset):
+    if os.path.exists(product_table_file):
+        print("Loading product table from %s" % product_table_file)
+        return pd.read_pickle(product_table_file)
+    products = build_product_table(opensearch, index, featureset)
+    print("Saving product table to %s" % product_table_file)
+    products.to_pickle(product_table_file)
+    return products
+
+
+def __as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+# An inverted-index-free BM25 over one analyzed text field.  The terms of every doc are stored back to back as term ids
+# with their positions, so scoring a doc is a scan over its own terms.
+class FieldIndex:
+    def __init__(self, texts):
+        self.vocab = {}
+        terms = []
+        positions = []
+        self.offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        for idx, text in enumerate(texts):
+            analyzed = analyze(text) if isinstance(text, str) else []
+            for term, position in analyzed:
+                terms.append(self.vocab.setdefault(term, len(self.vocab)))
+                positions.append(position)
+            self.offsets[idx + 1] = len(terms)
+        self.terms = np.array(terms, dtype=np.int32)
+        self.positions = np.array(positions, dtype=np.int32)
+        doc_lengths = np.diff(self.offsets)
+        self.num_docs = max(int((doc_lengths > 0).sum()), 1)
+        self.avg_length = max(doc_lengths.sum() / self.num_docs, 1)
+        # document frequency: count each (doc, term) pair once
+        doc_ids = np.repeat(np.arange(len(texts)), doc_lengths)
+        pairs = np.unique(doc_ids.astype(np.int64) * len(self.vocab) + self.terms)
+        self.doc_freqs = np.bincount(
+            pairs % max(len(self.vocab), 1), minlength=len(self.vocab)
+        )
+
+    def __query_terms(self, text):
+        return [
+            (self.vocab.get(term, -1), position) for (term, position) in analyze(text)
+        ]
+
+    def __idf(self, term_id):
+        doc_freq = self.doc_freqs[term_id] if term_id >= 0 else 0
+        return math.log(1 + (self.num_docs - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def __tf_norm(self, freq, doc_length):
+        return freq / (freq + K1 * (1 - B + B * doc_length / self.avg_length))
+
+    # A match query: the sum of the BM25 scores of the query terms
+    def match(self, doc_idx, text):
+        start, end = self.offsets[doc_idx], self.offsets[doc_idx + 1]
+        doc_terms = self.terms[start:end]
+        score = 0.0
+        for term_id, _ in self.__query_terms(text):
+            freq = np.count_nonzero(doc_terms == term_id)
+            if freq > 0:
+                score += self.__idf(term_id) * self.__tf_norm(freq, end - start)
+        return score
+
+    # A sloppy phrase query: every place the phrase occurs within slop adds 1 / (1 + distance) to the phrase frequency,
+    # which is scored with BM25 using the sum of the idfs of the terms
+    def match_phrase(self, doc_idx, text, slop=0):
+        query_terms = self.__query_terms(text)
+        if len(query_terms) == 0:
+            return 0.0
+        if len(query_terms) == 1:
+            return self.match(doc_idx, text)
+        start, end = self.offsets[doc_idx], self.offsets[doc_idx + 1]
+        doc_terms = self.terms[start:end]
+        doc_positions = self.positions[start:end]
+        # where each term could put the start of the phrase
+        starts = []
+        for term_id, query_position in query_terms:
+            found = doc_positions[doc_terms == term_id]
+            if len(found) == 0:
+                return 0.0
+            starts.append(found - (query_position - query_terms[0][1]))
+        freq = 0.0
+        for phrase_start in starts[0]:
+            closest = [
+                term_starts[np.argmin(np.abs(term_starts - phrase_start))]
+                for term_starts in starts[1:]
+            ]
+            distance = max(closest + [phrase_start]) - min(closest + [phrase_start])
+            if distance <= slop:
+                freq += 1.0 / (1 + distance)
+        if freq == 0:
+            return 0.0
+        idf = sum(self.__idf(term_id) for (term_id, _) in query_terms)
+        return idf * self.__tf_norm(freq, end - start)
+
+
+FIELD_VALUE_MODIFIERS = {
+    "none": lambda value: value,
+    "log": lambda value: np.log10(value),
+    "log1p": lambda value: np.log10(value + 1),
+    "log2p": lambda value: np.log10(value + 2),
+    "ln": lambda value: np.log(value),
+    "ln1p": lambda value: np.log1p(value),
+    "ln2p": lambda value: np.log(value + 2),
+    "square": lambda value: value * value,
+    "sqrt": lambda value: np.sqrt(value),
+    "reciprocal": lambda value: 1.0 / value,
+}
+
+
+class LocalFeatureEngine:
+    def __init__(self, featureset, products):
+        self.products = products
+        self.sku_idx = pd.Series(np.arange(len(products)), index=products.index)
+        self.features = featureset["featureset"]["features"]
+        self.feature_names = [feature["name"] for feature in self.features]
+        self.field_indexes = {}
+        self.static_values = {}  # features that only depend on the doc
+        self.unsupported = []
+        text_fields, _ = featureset_fields(featureset)
+        for field in text_fields:
+            print("Analyzing %s for %s products" % (field, len(products)))
+            self.field_indexes[field] = FieldIndex(products[field].tolist())
+        for feature in self.features:
+            if "function_score" in feature["template"]:
+                values = self.__function_score(feature["template"]["function_score"])
+                if values is not None:
+                    self.static_values[feature["name"]] = values
+                    continue
+            elif self.__text_query(feature["template"]) is not None:
+                continue
+            self.unsupported.append(feature["name"])
+        if len(self.unsupported) > 0:
+            print(
+                "These features can't be computed locally and will be missing: %s"
+                % self.unsupported
+            )
+
+    # field_value_factor functions on a match_all query, multiplied together, like the function_score defaults
+    def __function_score(self, func_temp):
+        query = func_temp.get("query", {"match_all": {}})
+        if "match_all" not in query:
+            return None
+        if func_temp.get("score_mode", "multiply") != "multiply" or func_temp.get(
+            "boost_mode", "multiply"
+        ) not in ("multiply", "replace"):
+            return None
+        values = np.ones(len(self.products))
+        for func in func_temp.get("functions", [func_temp]):
+            if "field_value_factor" not in func or "filter" in func:
+                return None
+            fvf = func["field_value_factor"]
+            modifier = FIELD_VALUE_MODIFIERS.get(fvf.get("modifier", "none"))
+            if modifier is None:
+                return None
+            field_values = self.products[fvf["field"]].to_numpy(dtype=np.float64)
+            if "missing" in fvf:
+                field_values = np.where(
+                    np.isnan(field_values), fvf["missing"], field_values
+                )
+            values = values * (
+                modifier(fvf.get("factor", 1.0) * field_values)
+                * func.get("weight", 1.0)
+            )
+        return values * func_temp.get("boost", 1.0)
+
+    # Returns (query type, field, keywords template, slop) for the match and match_phrase queries we can compute
+    def __text_query(self, template):
+        for query_type in ["match", "match_phrase"]:
+            if query_type in template and len(template[query_type]) == 1:
+                field, params = list(template[query_type].items())[0]
+                if isinstance(params, str):
+                    params = {"query": params}
+                if params.get("query") == "{{keywords}}" and set(params.keys()) <= {
+                    "query",
+                    "slop",
+                }:
+                    return query_type, field, params.get("slop", 0)
+        return None
+
+    # The feature values for one query and its docs, as a dict of feature name to array of values
+    def query_features(self, query, skus):
+        doc_idxs = self.sku_idx.reindex(skus).to_numpy()
+        known = ~np.isnan(doc_idxs)
+        doc_idxs = np.where(known, doc_idxs, 0).astype(np.int64)
+        values = {}
+        for feature in self.features:
+            name = feature["name"]
+            if name in self.static_values:
+                feature_values = self.static_values[name][doc_idxs]
+            elif name in self.unsupported:
+                feature_values = np.full(len(skus), np.nan)
+            else:
+                query_type, field, slop = self.__text_query(feature["template"])
+                field_index = self.field_indexes[field]
+                if query_type == "match":
+                    feature_values = np.array(
+                        [field_index.match(doc_idx, query) for doc_idx in doc_idxs]
+                    )
+                else:
+                    feature_values = np.array(
+                        [
+                            field_index.match_phrase(doc_idx, query, slop)
+                            for doc_idx in doc_idxs
+                        ]
+                    )
+            values[name] = np.where(known, feature_values, np.nan)
+        return values
+
+    # Same output as DataPrepper.log_features: one row per query_id/sku with a column per feature.  Queries are spread
+    # over workers processes, which share the engine.
+    def log_features(self, train_data_df, workers=None):
+        groups = [
+            (group["query_id"].iloc[0], query, group["sku"].tolist())
+            for (query, group) in train_data_df.groupby("query")
+        ]
+        print("Computing features locally for %s queries" % len(groups))
+        if workers == 1:
+            frames = [_features_for_group(self, group) for group in groups]
+        else:
+            with Pool(
+                workers, initializer=_init_feature_worker, initargs=(self,)
+            ) as pool:
+                frames = pool.map(_compute_feature_group, groups, chunksize=64)
+        if len(frames) == 0:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+
+def _features_for_group(engine, group):
+    query_id, query, skus = group
+    frame = pd.DataFrame(engine.query_features(query, skus))
+    frame.insert(0, "sku", skus)
+    frame.insert(0, "query_id", query_id)
+    frame.insert(0, "doc_id", skus)
+    return frame.astype({"doc_id": "int64", "query_id": "int64", "sku": "int64"})
+
+
+_feature_engine = None
+
+
+def _init_feature_worker(engine):
+    global _feature_engine
+    _feature_engine = engine
+
+
+def _compute_feature_group(group):
+    return _features_for_group(_feature_engine, group)
+
+
+# Compare locally computed features to ones logged through OpenSearch for the same query_id/sku pairs.
+# Returns one row per feature with the error stats and how many values agree to within rel_tol.
+def parity_report(local_df, logged_df, feature_names, rel_tol=0.01):
+    joined = pd.merge(
+        local_df, logged_df, on=["query_id", "sku"], suffixes=("_local", "_logged")
+    )
+    rows = []
+    for name in feature_names:
+        local = joined["%s_local" % name].to_numpy(dtype=np.float64)
+        logged = joined["%s_logged" % name].fillna(0).to_numpy(dtype=np.float64)
+        present = ~np.isnan(local)
+        errors = np.abs(local[present] - logged[present])
+        rows.append(
+            {
+                "feature": name,
+                "num_pairs": int(present.sum()),
+                "mean_abs_error": errors.mean() if len(errors) > 0 else np.nan,
+                "max_abs_error": errors.max() if len(errors) > 0 else np.nan,
+                "within_tolerance": (
+                    np.mean(errors <= rel_tol * np.maximum(np.abs(logged[present]), 1))
+                    if len(errors) > 0
+                    else np.nan
+                ),
+                "correlation": __correlation(local[present], logged[present]),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+# Pearson correlation, or NaN if either side is constant
+def __correlation(local, logged):
+    if len(local) < 2 or np.std(local) == 0 or np.std(logged) == 0:
+        return np.nan
+    return np.corrcoef(local, logged)[0, 1]
+
+
+# Log the features for a random sample of num_queries queries through OpenSearch with log_features (e.g.
+# DataPrepper.log_features) and compare them with the ones we computed locally
+def check_parity(engine, local_df, train_data_df, log_features, num_queries=100):
+    queries = train_data_df["query"].drop_duplicates()
+    sample = train_data_df[
+        train_data_df["query"].isin(queries.sample(n=min(num_queries, len(queries))))
+    ]
+    print("Logging features for %s queries to check parity" % sample["query"].nunique())
+    return parity_report(local_df, log_features(sample), engine.feature_names)
@@ -1,5 +1,8 @@
+import itertools
 import json
+import os
 
+import numpy as np
 import requests
 
 
@@ -144,6 +147,20 @@ def create_feature_log_query(
     }
 
 
+# We don't want to write everything out, some items we've been tracking are reserved or not needed for the model
+TRAINING_EXCLUSIONS = {
+    "query_id",
+    "doc_id",
+    "rank",
+    "query",
+    "sku",
+    "product_name",
+    "grade",
+    "clicks",
+    "num_impressions",
+}
+
+
 # Item is a Pandas namedtuple
 def get_features(item, exclusions, col_names):
     features = {}
@@ -160,6 +177,34 @@ def get_features(item, exclusions, col_names):
     return features
 
 
+# Same rules as get_features, but works on the column names alone so we can pick out all the feature columns up front.
+# Returns (column name, feature name) pairs in the order they get written to the training file
+def get_feature_columns(col_names, exclusions=TRAINING_EXCLUSIONS):
+    col_names = list(col_names)
+    feature_cols = []
+    for col_name in col_names:
+        if col_name not in exclusions and "%s_norm" % col_name not in col_names:
+            feature_cols.append((col_name, col_name.replace("_norm", "")))
+    return feature_cols
+
+
+# Pull the features, grades and query ids out of the training data as arrays so XGB can be fed without a text file.
+# Rows are (stably) sorted by query id, since XGB needs the rows for a query to be contiguous.
+# Column 0 of the feature matrix is left empty (missing) so that column i lines up with feature i in the
+# one-based SVMRank file and the feature map.
+def get_training_matrix(train_data):
+    feature_cols = get_feature_columns(train_data.keys())
+    order = np.argsort(train_data["query_id"].to_numpy(), kind="stable")
+    features = np.full(
+        (len(train_data), len(feature_cols) + 1), np.nan, dtype=np.float32
+    )
+    for idx, (col_name, _) in enumerate(feature_cols):
+        features[:, idx + 1] = train_data[col_name].to_numpy(dtype=np.float32)[order]
+    grades = train_data["grade"].to_numpy(dtype=np.float32)[order]
+    qids = train_data["query_id"].to_numpy()[order]
+    return features, grades, qids, [feat_name for (_, feat_name) in feature_cols]
+
+
 def to_xgb_format(qid, doc_id, rank, query_str, product_name, grade, features):
     if features is not None:
         featuresAsStrs = [
@@ -177,78 +222,99 @@ def to_xgb_format(qid, doc_id, rank, query_str, product_name, grade, features):
     )
 
 
-def write_training_file(train_data, output_file, feat_map):
+# Writes the same lines as to_xgb_format, but pulls whole columns out of the data frame up front and formats each row
+# with a single format string, writing out chunk_size rows at a time.
+def write_training_file(train_data, output_file, feat_map, chunk_size=100000):
     print("Writing XGB Training file to %s" % (output_file))
-    col_names = train_data.keys()
-    # We don't want to write everything out, some items we've been tracking are reserved or not needed for the model
-    exclusions = {
-        "query_id",
-        "doc_id",
-        "rank",
-        "query",
-        "sku",
-        "product_name",
-        "grade",
-        "clicks",
-        "num_impressions",
-    }
-    with open(output_file, "bw") as output:
-        for item in train_data.itertuples(
-            index=False
-        ):  # skip the first 'index' element from the DF
-            # Pull out the specific items from the Pandas named tuple.  The rest goes in the features map.
-            # if there is a norm version, take that
-            #
-            features = get_features(item, exclusions, col_names)
-            xgb_format = to_xgb_format(
-                item.query_id,
-                item.doc_id,
-                item.rank,
-                item.query,
-                item.product_name,
-                item.grade,
-                features,
-            )
-            output.write(bytes(xgb_format + "\n", "utf-8"))
+    feature_cols = get_feature_columns(train_data.keys())
+    line_format = "%%.4f\tqid:%%s\t%s # %%s\t%%s\t%%s\t%%s\n" % "\t".join(
+        "%s:%%.4f" % (idx + 1) for idx in range(len(feature_cols))
+    )
+    columns = (
+        [train_data["grade"].tolist(), train_data["query_id"].tolist()]
+        + [train_data[col_name].tolist() for (col_name, _) in feature_cols]
+        + [
+            train_data["doc_id"].tolist(),
+            train_data["rank"].tolist(),
+            # the comment can't have line breaks in it
+            train_data["query"].astype(str).str.replace("\n", "").tolist(),
+            train_data["product_name"].astype(str).str.replace("\n", "").tolist(),
+        ]
+    )
+    rows = zip(*columns)
+    with open(output_file, "bw", buffering=1 << 20) as output:
+        lines = [line_format % row for row in itertools.islice(rows, chunk_size)]
+        while len(lines) > 0:
+            output.write("".join(lines).encode("utf-8"))
+            lines = [line_format % row for row in itertools.islice(rows, chunk_size)]
     # We need to write out the feature map, probably more needed here
     if feat_map:
-        print("Writing feature map to %s" % feat_map)
-        with open(feat_map, "w") as feat_map_file:
-            item = train_data.iloc[1:2]
-            features = get_features(item, exclusions, col_names)
-            feat_map_file.write("0\tna\tq\n")
-            for idx, feat in enumerate(features.keys()):
-                # https://docs.rs/xgboost/0.1.4/xgboost/struct.FeatureMap.html are the only docs I can find on the format
-                if feat != "onSale":
-                    feat_map_file.write(
-                        "{}\t{}\tq\n".format(idx + 1, feat)
-                    )  # idx+2 b/c we are one-based for this
-                else:  # Kludgy way of handling onSale being at some point.  For now, write it out as 'q'
-                    # Bug in LTR prevents 'indicator'/boolean features, so model as q for now by
-                    # encoding onSale as a percentage discount
-                    feat_map_file.write(
-                        "{}\t{}\tq\n".format(idx + 1, feat)
-                    )  # make the q an i
+        write_feature_map(train_data, feat_map)
+
+
+def write_feature_map(train_data, feat_map):
+    print("Writing feature map to %s" % feat_map)
+    with open(feat_map, "w") as feat_map_file:
+        feat_map_file.write("0\tna\tq\n")
+        for idx, (_, feat) in enumerate(get_feature_columns(train_data.keys())):
+            # https://docs.rs/xgboost/0.1.4/xgboost/struct.FeatureMap.html are the only docs I can find on the format
+            if feat != "onSale":
+                feat_map_file.write(
+                    "{}\t{}\tq\n".format(idx + 1, feat)
+                )  # idx+2 b/c we are one-based for this
+            else:  # Kludgy way of handling onSale being at some point.  For now, write it out as 'q'
+                # Bug in LTR prevents 'indicator'/boolean features, so model as q for now by
+                # encoding onSale as a percentage discount
+                feat_map_file.write(
+                    "{}\t{}\tq\n".format(idx + 1, feat)
+                )  # make the q an i
+
 
+# Returns the feature names in a feature map, in index order (index 0 is the unused 'na' feature)
+def read_feature_map(feat_map):
+    feature_names = []
+    with open(feat_map) as feat_map_file:
+        for line in feat_map_file:
+            feature_names.append(line.split("\t")[1])
+    return feature_names
 
+
+# What a derived file (an XGB binary buffer, a click prior index) was built from: the path, size and modification time
+# of the source file, or None if there is no such file.  Any XGB URI parameters, e.g. training.xgb?format=libsvm, are
+# dropped first.
+def source_stamp(source_file):
+    source_file = source_file.split("?")[0]
+    if not os.path.exists(source_file):
+        return None
+    stat = os.stat(source_file)
+    return {
+        "path": os.path.abspath(source_file),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+
+
+# Writes the LTR model document one tree at a time.  model is any iterable of per tree JSON strings, e.g. from
+# bst.get_dump(dump_format="json") or xgb_utils.tree_to_ltr_json.  The definition is itself a JSON string inside the
+# document, so each tree gets escaped on its way in.  JSON escapes character by character, so escaping tree by tree
+# gives the same document as escaping the whole definition at once, without ever holding all of it in memory.
+# Returns the size of the written file in bytes.
 def write_opensearch_ltr_model(
     model_name, model, model_file, objective="rank:pairwise"
 ):
-    model_str = "[" + ",".join(list(model)) + "]"
-    # print(model_str)
-    os_model = {
-        "model": {
-            "name": model_name,
-            "model": {
-                "type": "model/xgboost+json",
-                "definition": '{"objective":"%s", "splits": %s}'
-                % (objective, model_str),
-            },
-        }
-    }
     print("Saving XGB LTR-ready model to %s.ltr" % model_file)
     with open("%s.ltr" % model_file, "w") as ltr_model:
-        ltr_model.write(json.dumps(os_model))
+        ltr_model.write(
+            '{"model": {"name": %s, "model": {"type": "model/xgboost+json", "definition": '
+            % json.dumps(model_name)
+        )
+        ltr_model.write(json.dumps('{"objective":"%s", "splits": [' % objective)[:-1])
+        for idx, tree in enumerate(model):
+            if idx > 0:
+                ltr_model.write(",")
+            ltr_model.write(json.dumps(tree)[1:-1])
+        ltr_model.write(']}"}}}')
+    return os.path.getsize("%s.ltr" % model_file)
 
 
 def create_ltr_store(ltr_model_path, auth, delete_old=True):
@@ -288,6 +354,22 @@ def delete_model(model_path, auth):
     return response
 
 
+# Upload a model written by write_opensearch_ltr_model, streaming the file rather than loading and re-serializing it
+def upload_model_file(model_path, model_file, auth):
+    print("Uploading model %s to %s" % (model_file, model_path))
+    headers = {"Content-Type": "application/json"}
+    with open(model_file, "rb") as data:
+        response = requests.post(
+            model_path,
+            data=data,
+            headers=headers,
+            auth=auth,
+            verify=False,
+        )
+    print("\tUpload Model Response: %s: %s" % (response.status_code, response.text))
+    return response
+
+
 def upload_model(model_path, os_model, auth):
     print("Uploading model to %s" % model_path)
     headers = {"Content-Type": "application/json"}
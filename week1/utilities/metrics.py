@@ -0,0 +1,146 @@
+# IR metrics over the results data frames written by search_utils.evaluate_test_set and friends.
+# Everything is computed for all the ranking types at once: each (type, query) pair gets a slot in a flat array and the
+# per query metrics are accumulated with np.bincount, so there is no filtering of the results per type.
+# A result is relevant if it was "found", i.e. it was clicked for that query in the test set.
+import math
+
+import numpy as np
+import pandas as pd
+
+METRICS = ["mrr", "precision", "ndcg", "recall"]
+
+# Poisson(1) quantiles for every 16 bit uniform, so bootstrap weights can be drawn with a table lookup
+POISSON_TABLE = np.searchsorted(
+    np.cumsum([math.exp(-1) / math.factorial(k) for k in range(20)]),
+    (np.arange(1 << 16) + 0.5) / (1 << 16),
+).astype(np.float32)
+
+
+# Returns a data frame indexed by (type, query) with the MRR, P@k, NDCG@k and recall@k of every query.
+# no_results maps a type to the queries that returned nothing for it (as returned by evaluate_test_set, or the
+# .no_results data frame); those queries score zero for that type.  Every type is scored over the queries that
+# returned results for any type plus its own zero results queries.
+# If the results have a num_relevant column (the number of clicked skus for the query in the test set), NDCG and recall
+# are computed against it.  Otherwise we only know about the relevant docs something retrieved, so we use the number of
+# distinct found skus across all types.
+def per_query_metrics(results, no_results=None, k=10):
+    type_codes, types = pd.factorize(results["type"])
+    query_codes, queries = pd.factorize(results["query"])
+    if no_results is None:
+        no_results = {}
+    elif isinstance(no_results, pd.DataFrame):
+        # The .no_results file has a column per type, padded with NaN
+        no_results = {col: no_results[col].dropna().tolist() for col in no_results}
+    no_results = {
+        query_type: pd.Series(missing).dropna().tolist()
+        for (query_type, missing) in no_results.items()
+    }
+    extra_types = [t for t in no_results.keys() if t not in set(types)]
+    types = list(types) + extra_types
+    missing_queries = pd.Index(
+        [q for missing in no_results.values() for q in missing]
+    ).unique()
+    num_result_queries = len(queries)
+    queries = pd.Index(queries).append(missing_queries.difference(queries, sort=False))
+    num_types, num_queries = len(types), len(queries)
+
+    ranks = results["rank"].to_numpy(dtype=np.int64)
+    found = results["found"].to_numpy(dtype=bool)
+    slots = type_codes * num_queries + query_codes
+    if "num_relevant" in results:
+        num_relevant = np.zeros(num_queries)
+        num_relevant[query_codes] = results["num_relevant"].to_numpy()
+    else:
+        found_pairs = pd.DataFrame(
+            {"query": query_codes[found], "sku": results["sku"].to_numpy()[found]}
+        ).drop_duplicates()
+        num_relevant = np.bincount(found_pairs["query"], minlength=num_queries)
+
+    found_slots, found_ranks = slots[found], ranks[found]
+    size = num_types * num_queries
+    # Reciprocal rank of the first relevant result in each slot
+    order = np.lexsort((found_ranks, found_slots))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = found_slots[order][1:] != found_slots[order][:-1]
+    mrr = np.zeros(size)
+    mrr[found_slots[order][first]] = 1.0 / found_ranks[order][first]
+    top_k = found_ranks <= k
+    hits = np.bincount(found_slots[top_k], minlength=size)
+    dcg = np.bincount(
+        found_slots[top_k],
+        weights=1.0 / np.log2(found_ranks[top_k] + 1),
+        minlength=size,
+    )
+    # Ideal DCG for every possible number of relevant docs in the top k
+    ideal = np.concatenate([[0.0], np.cumsum(1.0 / np.log2(np.arange(2, k + 2)))])
+    relevant = np.tile(num_relevant, num_types)
+    idcg = ideal[np.minimum(relevant, k).astype(np.int64)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ndcg = np.where(idcg > 0, dcg / idcg, 0.0)
+        recall = np.where(relevant > 0, hits / relevant, 0.0)
+
+    # Which (type, query) slots we score: queries with results for any type, plus each type's zero results queries
+    scored = np.zeros((num_types, num_queries), dtype=bool)
+    scored[:, :num_result_queries] = True
+    for query_type, missing in no_results.items():
+        scored[types.index(query_type), queries.get_indexer(missing)] = True
+    scored = scored.ravel()
+    index = pd.MultiIndex.from_arrays(
+        [
+            np.repeat(np.array(types, dtype=object), num_queries)[scored],
+            np.tile(np.asarray(queries, dtype=object), num_types)[scored],
+        ],
+        names=["type", "query"],
+    )
+    return pd.DataFrame(
+        {
+            "mrr": mrr[scored],
+            "precision": hits[scored] / k,
+            "ndcg": ndcg[scored],
+            "recall": recall[scored],
+        },
+        index=index,
+    )
+
+
+# Bootstrap the mean of each metric per type.  Returns a data frame indexed by type with a column for each metric and a
+# low/high column for each confidence interval.  We use the Poisson bootstrap: each query gets a Poisson(1) weight per
+# sample instead of being drawn with replacement, which turns every block of samples into a single matrix multiply.
+# Samples are drawn in blocks so memory stays bounded no matter how many queries there are.
+def summarize(per_query, num_samples=1000, confidence=0.95, seed=42):
+    rng = np.random.default_rng(seed)
+    alpha = (1 - confidence) / 2
+    rows = {}
+    for query_type, type_metrics in per_query.groupby(level="type", sort=False):
+        values = type_metrics[METRICS].to_numpy()
+        num_queries = len(values)
+        row = dict(zip(METRICS, values.mean(axis=0)))
+        if num_samples > 0 and num_queries > 0:
+            block = max(1, 10000000 // num_queries)
+            means = []
+            for start in range(0, num_samples, block):
+                weights = POISSON_TABLE[
+                    rng.integers(
+                        0,
+                        1 << 16,
+                        size=(min(block, num_samples - start), num_queries),
+                        dtype=np.uint16,
+                    )
+                ]
+                totals = np.maximum(weights.sum(axis=1, keepdims=True), 1)
+                means.append(weights @ values.astype(np.float32) / totals)
+            low, high = np.quantile(np.concatenate(means), [alpha, 1 - alpha], axis=0)
+            for idx, metric in enumerate(METRICS):
+                row["%s_low" % metric] = low[idx]
+                row["%s_high" % metric] = high[idx]
+        row["num_queries"] = num_queries
+        rows[query_type] = row
+    return pd.DataFrame.from_dict(rows, orient="index")
+
+
+def evaluate(results, no_results=None, k=10, num_samples=1000, confidence=0.95):
+    return summarize(
+        per_query_metrics(results, no_results, k),
+        num_samples=num_samples,
+        confidence=confidence,
+    )
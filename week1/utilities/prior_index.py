@@ -0,0 +1,177 @@
+# A precomputed index of click priors.
+# Rather than grouping the training clicks and building a click prior query every time we look at a query, we do it
+# once for every query in the click logs and store the results as flat arrays:
+#   * the click prior query string, ready to pass to create_query/create_simple_baseline
+#   * the clicked skus, their click counts and their weights (clicks / times the query was seen)
+# The index can be saved to a directory and memory mapped back in, so every tool can share it without loading the
+# click logs at all.
+import json
+import os
+from collections import namedtuple
+
+import ltr_utils as lu
+import numpy as np
+import pandas as pd
+
+Prior = namedtuple(
+    "Prior", ["click_prior_query", "skus", "clicks", "weights", "times_seen"]
+)
+
+NO_PRIOR = Prior(
+    "", np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0), 0
+)
+
+
+class PriorIndex:
+    def __init__(self, queries, offsets, skus, clicks, weights, prior_offsets, priors):
+        self.queries = queries
+        self.query_ids = {query: idx for (idx, query) in enumerate(queries)}
+        self.offsets = offsets  # skus for query i are skus[offsets[i]:offsets[i + 1]]
+        self.skus = skus
+        self.clicks = clicks
+        self.weights = weights
+        self.prior_offsets = prior_offsets  # same idea, but byte offsets into priors
+        self.priors = priors  # all the click prior queries, UTF-8 encoded, back to back
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __contains__(self, query):
+        return query in self.query_ids
+
+    # Build the index from click logs (or anything else with a query and a sku column, one row per click)
+    @classmethod
+    def build(cls, clicks_df):
+        clicks_df = clicks_df[["query", "sku"]].dropna()
+        codes, queries = pd.factorize(clicks_df["query"])
+        # Count the clicks per query/sku pair.  With sort=False the pairs come out in the order they were first
+        # clicked, and a stable sort by query keeps that order within each query, which is the order
+        # create_prior_queries has always written the skus in.
+        counts = (
+            pd.DataFrame({"query": codes, "sku": clicks_df["sku"].to_numpy(np.int64)})
+            .groupby(["query", "sku"], sort=False)
+            .size()
+            .reset_index(name="clicks")
+        )
+        order = np.argsort(counts["query"].to_numpy(), kind="stable")
+        query_codes = counts["query"].to_numpy()[order]
+        skus = counts["sku"].to_numpy()[order]
+        clicks = counts["clicks"].to_numpy(np.int64)[order]
+        times_seen = np.bincount(codes, minlength=len(queries))
+        weights = np.maximum(clicks / times_seen[query_codes], 0.001)
+        offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(query_codes, minlength=len(queries)))
+        # Same format as query_utils.create_prior_queries
+        pair_strs = [
+            "%s^%.3f  " % pair for pair in zip(skus.tolist(), weights.tolist())
+        ]
+        encoded = [
+            "".join(pair_strs[offsets[i] : offsets[i + 1]]).encode("utf-8")
+            for i in range(len(queries))
+        ]
+        prior_offsets = np.zeros(len(queries) + 1, dtype=np.int64)
+        prior_offsets[1:] = np.cumsum([len(prior) for prior in encoded])
+        priors = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(list(queries), offsets, skus, clicks, weights, prior_offsets, priors)
+
+    def lookup(self, query):
+        idx = self.query_ids.get(query)
+        if idx is None:
+            return NO_PRIOR
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        click_prior_query = bytes(
+            self.priors[self.prior_offsets[idx] : self.prior_offsets[idx + 1]]
+        ).decode("utf-8")
+        return Prior(
+            click_prior_query,
+            self.skus[start:end],
+            self.clicks[start:end],
+            self.weights[start:end],
+            int(self.clicks[start:end].sum()),
+        )
+
+    # Save the index to index_dir.  If it was built from a clicks file, its path, size and modification time go in the
+    # manifest, so load_or_build can tell whether the index is still for that file.  The manifest is written last, so
+    # an index that wasn't saved all the way doesn't have one.
+    def save(self, index_dir, clicks_file=None):
+        print("Saving click prior index for %s queries to %s" % (len(self), index_dir))
+        manifest_file = "%s/manifest.json" % index_dir
+        if os.path.exists(manifest_file):
+            os.remove(manifest_file)
+        if os.path.isdir(index_dir) == False:
+            os.makedirs(index_dir)
+        with open("%s/queries.json" % index_dir, "w") as queries_file:
+            json.dump(self.queries, queries_file)
+        for name in ["offsets", "skus", "clicks", "weights", "prior_offsets"]:
+            np.save("%s/%s.npy" % (index_dir, name), getattr(self, name))
+        with open("%s/priors.bin" % index_dir, "wb") as priors_file:
+            priors_file.write(self.priors.tobytes())
+        with open(manifest_file, "w") as output:
+            json.dump(
+                {
+                    "num_queries": len(self),
+                    "source": (
+                        lu.source_stamp(clicks_file)
+                        if clicks_file is not None
+                        else None
+                    ),
+                },
+                output,
+            )
+
+    # Memory map a saved index.  Only the list of queries is actually read in.
+    @classmethod
+    def load(cls, index_dir):
+        print("Loading click prior index from %s" % index_dir)
+        with open("%s/queries.json" % index_dir) as queries_file:
+            queries = json.load(queries_file)
+        arrays = [
+            np.load("%s/%s.npy" % (index_dir, name), mmap_mode="r")
+            for name in ["offsets", "skus", "clicks", "weights", "prior_offsets"]
+        ]
+        priors_file = "%s/priors.bin" % index_dir
+        if os.path.getsize(priors_file) > 0:
+            priors = np.memmap(priors_file, dtype=np.uint8, mode="r")
+        else:  # can't memory map an empty file
+            priors = np.empty(0, dtype=np.uint8)
+        return cls(queries, *arrays[:4], arrays[4], priors)
+
+    # Load the index from index_dir if it was built from clicks_file as it is now (same path, size and modification
+    # time, see save), else build it from the click logs (clicks_df if we already have them in memory, otherwise
+    # clicks_file) and save it to index_dir
+    @classmethod
+    def load_or_build(cls, index_dir, clicks_file, clicks_df=None):
+        try:
+            with open("%s/manifest.json" % index_dir) as manifest_file:
+                source = json.load(manifest_file)["source"]
+        except (OSError, ValueError, KeyError):
+            source = None
+        stamp = lu.source_stamp(clicks_file)
+        if source is not None and source == stamp:
+            return cls.load(index_dir)
+        # Without the clicks file there's nothing to rebuild from, so go with an index built from it back when
+        if (
+            stamp is None
+            and source is not None
+            and source["path"] == os.path.abspath(clicks_file)
+        ):
+            print("%s is gone, using the click prior index built from it" % clicks_file)
+            return cls.load(index_dir)
+        if source is not None:
+            print(
+                "Click prior index in %s was built from %s, rebuilding it from %s"
+                % (index_dir, source["path"], clicks_file)
+            )
+        if clicks_df is None:
+            print("Building click prior index from %s" % clicks_file)
+            clicks_df = pd.read_csv(clicks_file, usecols=["query", "sku"])
+        prior_index = cls.build(clicks_df)
+        prior_index.save(index_dir, clicks_file)
+        return prior_index
+
+
+# Lets the tools take either click logs or a ready made index
+def as_prior_index(prior_clicks):
+    if prior_clicks is None or isinstance(prior_clicks, PriorIndex):
+        return prior_clicks
+    return PriorIndex.build(prior_clicks)
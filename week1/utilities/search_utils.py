@@ -2,9 +2,12 @@
 
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import ltr_utils as lu
+import metrics
 import pandas as pd
+import prior_index as pi
 import query_utils as qu
 from opensearchpy import NotFoundError
 
@@ -13,7 +16,7 @@ from opensearchpy import NotFoundError
 
 def evaluate_test_set(
     test_data,
-    prior_clicks_df,
+    prior_clicks,
     opensearch,
     xgb_model_name,
     ltr_store,
@@ -33,7 +36,7 @@ def evaluate_test_set(
         precision = size
     test_data = test_data.sample(frac=1).reset_index(drop=True)  # shuffle things
     query_gb = test_data.groupby("query", sort=False)  # small
-    prior_clicks_gb = prior_clicks_df.groupby(["query"])  # large
+    prior_index = pi.as_prior_index(prior_clicks)  # large
     source = ["sku", "name"]
 
     no_simple = []
@@ -62,6 +65,7 @@ def evaluate_test_set(
         "found": found,
         "new": new,
         "score": score,
+        "num_relevant": [],  # how many skus were clicked for the query in the test set
     }
 
     print("Running %s test queries." % num_queries)
@@ -80,27 +84,7 @@ def evaluate_test_set(
         # this is the set of skus that were clicked w/o dupes
         # since we are using prior clicks to learn from and boost, we cannot use them for judgment
         test_skus_for_query = test_clicks_for_query.sku.drop_duplicates()
-        prior_doc_ids = None
-        prior_doc_id_weights = None
-        query_times_seen = 0  # careful here
-        prior_clicks_for_query = None
-        seen = False
-        try:
-            prior_clicks_for_query = prior_clicks_gb.get_group(key)
-            if prior_clicks_for_query is not None and len(prior_clicks_for_query) > 0:
-                prior_doc_ids = prior_clicks_for_query.sku.drop_duplicates()
-                prior_doc_id_weights = (
-                    prior_clicks_for_query.sku.value_counts()
-                )  # histogram gives us the click counts for all the doc_ids
-                query_times_seen = prior_clicks_for_query.sku.count()
-                seen = True
-        except KeyError as ke:
-            # nothing to do here, we just haven't seen this query before in our training set
-            pass
-
-        click_prior_query = qu.create_prior_queries(
-            prior_doc_ids, prior_doc_id_weights, query_times_seen
-        )
+        click_prior_query, seen = __get_click_prior(prior_index, key)
         simple_query_obj = qu.create_simple_baseline(
             key,
             click_prior_query,
@@ -193,6 +177,183 @@ def evaluate_test_set(
     return pd.DataFrame(results), no_results
 
 
+# Look up the prior clicks for a query in the training set and turn them into a click prior query.
+# Returns the prior query and whether or not we saw the query in training
+def __get_click_prior(prior_index, key):
+    prior = prior_index.lookup(key)
+    return prior.click_prior_query, prior.times_seen > 0
+
+
+# Same output as evaluate_test_set, but instead of running four queries per test query, we retrieve the candidates
+# for the simple and hand tuned queries once, log their LTR features once and then apply the model locally to
+# simulate the LTR rescore.  Queries and feature logging are sent batch_size test queries at a time using msearch.
+# ltr_scorer is a function that takes a data frame of logged features (one column per feature name) and returns
+# the model score for each row, e.g. xgb_utils.create_ltr_scorer
+def evaluate_test_set_offline(
+    test_data,
+    prior_clicks,
+    opensearch,
+    ltr_scorer,
+    featureset_name,
+    ltr_store,
+    index,
+    num_queries=100,
+    size=500,
+    rescore_size=500,
+    precision=10,
+    main_query_weight=1,
+    rescore_query_weight=2,
+    batch_size=50,
+):
+    if precision > size:
+        print(
+            "Precision can't be greater than the fetch size, changing the precision to be same as size"
+        )
+        precision = size
+    test_data = test_data.sample(frac=1).reset_index(drop=True)  # shuffle things
+    query_gb = test_data.groupby("query", sort=False)  # small
+    prior_index = pi.as_prior_index(prior_clicks)  # large
+    no_results = {
+        "simple": [],
+        "ltr_simple": [],
+        "hand_tuned": [],
+        "ltr_hand_tuned": [],
+    }
+    results = {
+        "query": [],
+        "sku": [],
+        "rank": [],
+        "type": [],
+        "found": [],
+        "new": [],
+        "score": [],
+        "num_relevant": [],
+    }
+    keys = list(query_gb.groups.keys())[:num_queries]
+    print("Running %s test queries offline, %s at a time." % (len(keys), batch_size))
+    for start in range(0, len(keys), batch_size):
+        print("Progress[%s]: %s" % (start, keys[start]))
+        batch = []
+        searches = []
+        for key in keys[start : start + batch_size]:
+            click_prior_query, seen = __get_click_prior(prior_index, key)
+            test_skus_for_query = set(query_gb.get_group(key).sku.drop_duplicates())
+            batch.append((key, click_prior_query, seen, test_skus_for_query))
+            searches.append({"index": index})
+            searches.append(
+                qu.create_simple_baseline(
+                    key,
+                    click_prior_query,
+                    filters=None,
+                    size=size,
+                    highlight=False,
+                    include_aggs=False,
+                    source=["sku"],
+                )
+            )
+            searches.append({"index": index})
+            searches.append(
+                qu.create_query(
+                    key,
+                    click_prior_query,
+                    filters=None,
+                    size=size,
+                    highlight=False,
+                    include_aggs=False,
+                    source=["sku"],
+                )
+            )
+        responses = opensearch.msearch(body=searches)["responses"]
+        # Log the features for every doc any of our queries retrieved, once per test query
+        hits_by_query = []
+        feature_logs = []
+        for idx, (key, click_prior_query, seen, test_skus) in enumerate(batch):
+            simple_hits = __get_hits(responses[2 * idx], key)
+            hand_tuned_hits = __get_hits(responses[2 * idx + 1], key)
+            hits_by_query.append((simple_hits, hand_tuned_hits))
+            doc_ids = list(
+                {hit["_id"] for hit in simple_hits}
+                | {hit["_id"] for hit in hand_tuned_hits}
+            )
+            feature_logs.append({"index": index})
+            feature_logs.append(
+                lu.create_feature_log_query(
+                    key,
+                    doc_ids,
+                    click_prior_query,
+                    featureset_name,
+                    ltr_store,
+                    size=max(len(doc_ids), 1),
+                )
+            )
+        log_responses = opensearch.msearch(body=feature_logs)["responses"]
+        # Score everything in the batch with a single call to the model
+        features = []
+        for idx, (key, _, _, _) in enumerate(batch):
+            for hit in __get_hits(log_responses[idx], key):
+                feature_row = {"query_idx": idx, "doc_id": hit["_id"]}
+                for feature in hit["fields"]["_ltrlog"][0]["log_entry"]:
+                    feature_row[feature["name"]] = feature.get("value", 0)
+                features.append(feature_row)
+        features_df = pd.DataFrame(features).fillna(0)
+        ltr_scores = {}
+        if len(features_df) > 0:
+            for query_idx, doc_id, ltr_score in zip(
+                features_df["query_idx"], features_df["doc_id"], ltr_scorer(features_df)
+            ):
+                ltr_scores[(query_idx, doc_id)] = ltr_score
+        for idx, (key, _, seen, test_skus) in enumerate(batch):
+            for hits, query_type in zip(hits_by_query[idx], ["simple", "hand_tuned"]):
+                if len(hits) == 0:
+                    no_results[query_type].append(key)
+                    no_results["ltr_%s" % query_type].append(key)
+                    continue
+                skus = [int(hit["_source"]["sku"][0]) for hit in hits]
+                scores = [hit["_score"] for hit in hits]
+                __record_hits(key, query_type, skus, scores, test_skus, seen, results)
+                # Simulate the rescore: the top rescore_size docs get the weighted sum of the query and model
+                # scores and are re-sorted, the rest keep their place after the window
+                window_scores = [
+                    main_query_weight * hit["_score"]
+                    + rescore_query_weight * ltr_scores.get((idx, hit["_id"]), 0)
+                    for hit in hits[:rescore_size]
+                ]
+                window_order = sorted(
+                    range(len(window_scores)), key=lambda i: -window_scores[i]
+                )
+                __record_hits(
+                    key,
+                    "ltr_%s" % query_type,
+                    [skus[i] for i in window_order] + skus[rescore_size:],
+                    [window_scores[i] for i in window_order] + scores[rescore_size:],
+                    test_skus,
+                    seen,
+                    results,
+                )
+
+    return pd.DataFrame(results), no_results
+
+
+def __get_hits(response, key):
+    if "error" in response:
+        print("Error for query %s: %s" % (key, response["error"]))
+        return []
+    return response["hits"]["hits"]
+
+
+# Add one ranking for a query to our results
+def __record_hits(key, query_type, skus, scores, test_skus, seen, results):
+    for i, (sku, score) in enumerate(zip(skus, scores)):
+        results["query"].append(key)
+        results["type"].append(query_type)
+        results["new"].append(not seen)
+        results["sku"].append(sku)
+        results["rank"].append(i + 1)
+        results["score"].append(score)
+        results["found"].append(sku in test_skus)
+        results["num_relevant"].append(len(test_skus))
+
+
 def write_diffs(to_compare_set, to_compare_results, ltr_results, ltr_set, od):
     diff = to_compare_set.symmetric_difference(ltr_set)
     if len(diff) > 0:
@@ -244,6 +405,7 @@ def __judge_hits(
                 results["sku"].append(sku)
                 results["rank"].append(i + 1)
                 results["score"].append(hit["_score"])
+                results["num_relevant"].append(len(all_skus_for_query))
                 if all_skus_for_query[all_skus_for_query == sku].count() > 0:
                     results["found"].append(True)
                 else:
@@ -254,26 +416,18 @@ def __judge_hits(
             no_results.append(key)
 
 
-# Precision is the number of relevant (in our case clicked) out of the number of retrieved
+# Precision is the number of relevant (in our case clicked) out of the number of retrieved.
+# Note: this counts results at ranks 1 through precision.  It used to stop at precision - 1.
 def calculate_precision(results, type, num_queries_no_results, precision=10):
     num_q_total = len(results["query"].unique()) + num_queries_no_results
-    typed_results = results[
-        (results["type"] == type)
-        & (results["found"] == True)
-        & (results["rank"] < precision)
-    ]
-    counts = typed_results.groupby("query")["rank"].count()
-    precisions = counts / precision
-    return precisions.sum() / num_q_total  # average
+    per_query = metrics.per_query_metrics(results, {type: []}, k=precision)
+    return per_query.loc[type]["precision"].sum() / num_q_total  # average
 
 
 def calculate_mrr(results, type, num_queries_no_results):
     num_q_total = len(results["query"].unique()) + num_queries_no_results
-    typed_results = results[(results["type"] == type) & (results["found"] == True)]
-    gb = typed_results.groupby(["query"])
-    min_ranks = gb["rank"].min()
-    r_ranks = 1 / min_ranks
-    return r_ranks.sum() / num_q_total
+    per_query = metrics.per_query_metrics(results, {type: []})
+    return per_query.loc[type]["mrr"].sum() / num_q_total
 
 
 def analyze_results(
@@ -290,88 +444,48 @@ def analyze_results(
     precision=10,
     analyze_explains=False,
     max_explains=100,
+    explain_workers=8,
+    explain_per_query=False,
 ):
     print(
         "Queries not seen during training: [%s]\n%s\n\n"
         % (len(new_queries_df), new_queries_df)
     )
     # MRR: mean reciprocal rank, closer to 1 is better, closer to zero is worse
-
-    print(
-        "Simple MRR is %.3f"
-        % (calculate_mrr(results_df, "simple", len(no_results_df["simple"])))
-    )
-    print(
-        "LTR Simple MRR is %.3f"
-        % (calculate_mrr(results_df, "ltr_simple", len(no_results_df["ltr_simple"])))
-    )
-    print(
-        "Hand tuned MRR is %.3f"
-        % (calculate_mrr(results_df, "hand_tuned", len(no_results_df["hand_tuned"])))
-    )
-    print(
-        "LTR Hand Tuned MRR is %.3f"
-        % (
-            calculate_mrr(
-                results_df,
-                "ltr_hand_tuned",
-                len(no_results_df["ltr_hand_tuned"]),
-            )
-        )
-    )
     # Caveat emmptor: precision is hard to define here, we're inferring a prior click as meaning the result is relevant.
     # This is self-serving, but really this whole thing is just trying to learn clicks
-    print("")
-    print(
-        "Simple p@%s is %.3f"
-        % (
-            precision,
-            calculate_precision(
-                results_df, "simple", len(no_results_df["simple"]), precision
-            ),
-        )
-    )
-    print(
-        "LTR simple p@%s is %.3f"
-        % (
-            precision,
-            calculate_precision(
-                results_df,
-                "ltr_simple",
-                len(no_results_df["ltr_simple"]),
-                precision,
-            ),
-        )
-    )
-    print(
-        "Hand tuned p@%s is %.3f"
-        % (
-            precision,
-            calculate_precision(
-                results_df,
-                "hand_tuned",
-                len(no_results_df["hand_tuned"]),
-                precision,
-            ),
-        )
-    )
-    print(
-        "LTR hand tuned p@%s is %.3f"
-        % (
-            precision,
-            calculate_precision(
-                results_df,
-                "ltr_hand_tuned",
-                len(no_results_df["ltr_hand_tuned"]),
-                precision,
-            ),
-        )
-    )
+    summary = metrics.evaluate(results_df, no_results_df, k=precision)
+    type_names = {
+        "simple": "Simple",
+        "ltr_simple": "LTR Simple",
+        "hand_tuned": "Hand tuned",
+        "ltr_hand_tuned": "LTR Hand Tuned",
+    }
+    for metric, metric_name in [
+        ("mrr", "MRR"),
+        ("precision", "p@%s" % precision),
+        ("ndcg", "NDCG@%s" % precision),
+        ("recall", "recall@%s" % precision),
+    ]:
+        for query_type in summary.index:
+            row = summary.loc[query_type]
+            print(
+                "%s %s is %.3f (95%% CI %.3f - %.3f)"
+                % (
+                    type_names.get(query_type, query_type),
+                    metric_name,
+                    row[metric],
+                    row["%s_low" % metric],
+                    row["%s_high" % metric],
+                )
+            )
+        print("")
     # Do some comparisons between the sets
-    simple_df = results_df[results_df["type"] == "simple"]
-    ltr_simple_df = results_df[results_df["type"] == "ltr_simple"]
-    hand_tuned_df = results_df[results_df["type"] == "hand_tuned"]
-    ltr_hand_tuned_df = results_df[results_df["type"] == "ltr_hand_tuned"]
+    typed_results = dict(tuple(results_df.groupby("type", sort=False)))
+    simple_df = typed_results.get("simple", results_df[:0])
+    ltr_simple_df = typed_results.get("ltr_simple", results_df[:0])
+    hand_tuned_df = typed_results.get("hand_tuned", results_df[:0])
+    ltr_hand_tuned_df = typed_results.get("ltr_hand_tuned", results_df[:0])
     # Do some merging so we can compare
     simple_join = pd.merge(
         simple_df,
@@ -420,6 +534,7 @@ def analyze_results(
     if os.path.isdir(analysis_output_dir) == False:
         os.mkdir(analysis_output_dir)
     # OUtput our analysis
+    summary.to_csv("%s/metrics.csv" % analysis_output_dir, index_label="type")
     simple_better.to_csv("%s/simple_better.csv" % analysis_output_dir, index=False)
     ltr_simple_better.to_csv(
         "%s/ltr_simple_better.csv" % analysis_output_dir, index=False
@@ -438,7 +553,7 @@ def analyze_results(
     ltr_ht_top_20 = ltr_ht_better[ltr_ht_better["rank_ltr"] < 20]
     ltr_ht_top_20.to_csv("%s/ht_ltr_better_r20.csv" % analysis_output_dir, index=False)
     if analyze_explains:
-        train_gb = train_df.groupby("query")
+        prior_index = pi.as_prior_index(train_df)
         print("Comparing simple vs LTR explains")
         simple_ltr_explains = compare_explains(
             simple_better,
@@ -447,8 +562,10 @@ def analyze_results(
             index,
             ltr_model_name,
             ltr_store_name,
-            train_gb,
+            prior_index,
             max_explains,
+            workers=explain_workers,
+            per_query=explain_per_query,
         )
         simple_ltr_explains.to_csv(
             "%s/analysis/simple_ltr_explains.csv" % output_dir, index=False
@@ -461,15 +578,19 @@ def analyze_results(
             index,
             ltr_model_name,
             ltr_store_name,
-            train_gb,
+            prior_index,
             max_explains,
+            workers=explain_workers,
+            per_query=explain_per_query,
         )
         ht_ltr_explains.to_csv(
             "%s/analysis/hand_tuned_ltr_explains.csv" % output_dir, index=False
         )
 
 
-# loop through, run the explain and extract the scores
+# Run the explains for the (query, sku) pairs in the joined dataframe, workers at a time, and extract the scores.
+# With per_query, we run one search per query with explain turned on, restricted to the skus we want explained, instead
+# of one explain call per pair.
 # The dataframe is a joined one
 def compare_explains(
     join,
@@ -478,82 +599,138 @@ def compare_explains(
     index,
     ltr_model_name,
     ltr_store_name,
-    train_gb,
+    prior_index,
     max_explains=100,
+    workers=8,
+    per_query=False,
 ):
-
-    query = []
-    sku = []
-    scores = []  # the top level score
-    results = {"query": query, "sku": sku, "score": scores}
-    ctr = 0
-    for item in join.itertuples():
-        ctr += 1
-        if ctr % 10 == 0:
-            print("Progress[%s]: %s" % (ctr, item.query))
-        if max_explains == ctr:
-            break
-        click_prior_query = ""
-        try:
-            prior_clicks_for_query = train_gb.get_group(item.query)
-            if prior_clicks_for_query is not None and len(prior_clicks_for_query) > 0:
-                prior_doc_ids = prior_clicks_for_query.sku.drop_duplicates()
-                prior_doc_id_weights = (
-                    prior_clicks_for_query.sku.value_counts()
-                )  # histogram gives us the click counts for all the doc_ids
-                query_times_seen = prior_clicks_for_query.sku.count()
-                click_prior_query = qu.create_prior_queries(
-                    prior_doc_ids, prior_doc_id_weights, query_times_seen
-                )
-        except KeyError as ke:
-            pass  # just means we can't find this query in the priors, which is OK
-
+    pairs = join[["query", "sku"]][:max_explains]
+    num_clauses = 0
+    explain_requests = []
+    for query, query_pairs in pairs.groupby("query", sort=False):
+        click_prior_query = prior_index.lookup(query).click_prior_query
         query_obj, num_shoulds = get_explain_query_for_type(
-            item.query, type, click_prior_query, ltr_model_name, ltr_store_name
+            query, type, click_prior_query, ltr_model_name, ltr_store_name
         )
         if click_prior_query is None or click_prior_query == "":
-            num_shoulds += 1  # if click prior is empty, then num shoulds will always be one less than a query with a valid click prior, which will throw off our parallel arrays
-        # print("Explain query %s" % query_obj)
-        response = opensearch.explain(index, item.sku, body=query_obj)
-        # get the top level scores by description
-        if response:
-            details = response["explanation"]["details"]
-            query.append(item.query)
-            sku.append(item.sku)
-            scores.append(response["explanation"]["value"])
-            for idx, val in enumerate(details):
-                feat_name = "clause_%s" % idx
-                arry = results.get(feat_name, None)
-                if arry is None:
-                    arry = []
-                    results[feat_name] = arry
-                # clauses.append()
-                # values.append("%s" % (val["value"]))
-                arry.append(val["value"])
-                if val["description"].find("LtrModel:") >= 0:
-                    ltr_details = val["details"]
-                    for ltr_detail in ltr_details:
-                        #'description': 'Feature 2(manufacturer_match): [no match, default value 0.0 used]',
-                        feat_name = ltr_detail["description"].split(":")[0]
-                        arry = results.get(feat_name, None)
-                        if arry is None:
-                            arry = []
-                            results[feat_name] = arry
-                        arry.append(ltr_detail["value"])
-            if num_shoulds > len(
-                details
-            ):  # this means not all clauses had explanations
-                for i in range(len(details), num_shoulds):
-                    feat_name = "clause_%s" % i
-                    arry = results.get(feat_name, None)
-                    if arry is None:
-                        arry = []
-                        results[feat_name] = arry
-                    arry.append(0)
+            num_shoulds += 1  # if click prior is empty, then num shoulds will always be one less than a query with a valid click prior
+        num_clauses = max(num_clauses, num_shoulds)
+        explain_requests.append((query, query_obj, query_pairs["sku"].tolist()))
+    print(
+        "Collecting explains for %s query/sku pairs across %s queries"
+        % (len(pairs), len(explain_requests))
+    )
+    explanations = collect_explains(
+        explain_requests, opensearch, index, workers=workers, per_query=per_query
+    )
+    rows = []
+    for query, sku, explanation in explanations:
+        row = {"query": query, "sku": sku}
+        row.update(parse_explanation(explanation, num_clauses))
+        rows.append(row)
+    # Every row has the same columns: the top level score, one per top level clause and one per LTR feature,
+    # in feature order.  Anything missing from an explanation didn't contribute, so it's a zero.
+    clauses = ["clause_%s" % idx for idx in range(num_clauses)]
+    features = sorted(
+        {col for row in rows for col in row.keys()}
+        - set(["query", "sku", "score"] + clauses),
+        key=__feature_number,
+    )
+    return pd.DataFrame(
+        rows, columns=["query", "sku", "score"] + clauses + features
+    ).fillna(0)
+
+
+# Run explains for a list of (query, query object, skus) requests, at most workers requests at a time.
+# Returns a list of (query, sku, explanation) for every sku we got an explanation for.
+def collect_explains(requests, opensearch, index, workers=8, per_query=False):
+    if per_query:
+        tasks = requests
+        explain = __explain_query
+    else:
+        tasks = [
+            (query, query_obj, [sku])
+            for (query, query_obj, skus) in requests
+            for sku in skus
+        ]
+        explain = __explain_pair
+    explanations = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(explain, opensearch, index, query, query_obj, skus)
+            for (query, query_obj, skus) in tasks
+        ]
+        for ctr, future in enumerate(futures):
+            if ctr % 100 == 0:
+                print("Progress[%s]" % ctr)
+            explanations.extend(future.result())
+    return explanations
+
+
+def __explain_pair(opensearch, index, query, query_obj, skus):
+    sku = skus[0]
+    try:
+        response = opensearch.explain(index, sku, body=query_obj)
+    except NotFoundError:
+        response = None
+    if response:
+        return [(query, sku, response["explanation"])]
+    print("No response for q: %s & sku: %s" % (query, sku))
+    return []
+
+
+# Explain all the skus for a query with a single search.  We wrap the query in a bool so we can filter down to our skus
+# without changing the scores, then unwrap its explanation so it looks like the one the explain API would return.
+def __explain_query(opensearch, index, query, query_obj, skus):
+    search = {
+        "size": len(skus),
+        "explain": True,
+        "_source": False,
+        "query": {
+            "bool": {
+                "must": [query_obj["query"]],
+                "filter": [{"ids": {"values": [str(sku) for sku in skus]}}],
+            }
+        },
+    }
+    explanations = {}
+    try:
+        response = opensearch.search(body=search, index=index)
+    except Exception as e:
+        print(e, search)
+    else:
+        for hit in response["hits"]["hits"]:
+            explanations[hit["_id"]] = hit["_explanation"]["details"][0]
+    results = []
+    for sku in skus:
+        explanation = explanations.get(str(sku))
+        if explanation is not None:
+            results.append((query, sku, explanation))
         else:
-            print("No response for q: %s & sku: %s" % (item.query, item.sku))
-    results_df = pd.DataFrame(results)
-    return results_df
+            print("No response for q: %s & sku: %s" % (query, sku))
+    return results
+
+
+# Flatten an explanation into the top level score, the value of each top level clause (zero if a clause didn't match)
+# and the value of every LTR feature, keyed by its description, e.g. 'Feature 2(manufacturer_match)'
+def parse_explanation(explanation, num_clauses=0):
+    row = {"score": explanation["value"]}
+    for idx in range(num_clauses):
+        row["clause_%s" % idx] = 0
+    for idx, val in enumerate(explanation["details"]):
+        row["clause_%s" % idx] = val["value"]
+        if val["description"].find("LtrModel:") >= 0:
+            for ltr_detail in val["details"]:
+                #'description': 'Feature 2(manufacturer_match): [no match, default value 0.0 used]',
+                row[ltr_detail["description"].split(":")[0]] = ltr_detail["value"]
+    return row
+
+
+def __feature_number(feat_name):
+    try:
+        return (int(feat_name.split("(")[0].replace("Feature", "")), feat_name)
+    except ValueError:
+        return (-1, feat_name)
 
 
 def get_feat_names(details):
@@ -609,41 +786,98 @@ def lookup_product(sku, opensearch, index="bbuy_products", source=None):
         return None
 
 
+# Check which of the skus are in the index, batch_size skus per _mget and workers requests at a time.
+# Writes a sku,status CSV to output_file as the batches come back (status is 1 if the sku is in the index, else 0) and
+# returns the number of valid skus
+def verify_products(
+    skus, opensearch, output_file, index="bbuy_products", batch_size=1000, workers=4
+):
+    skus = list(skus)
+    batches = [skus[i : i + batch_size] for i in range(0, len(skus), batch_size)]
+    num_valid = 0
+    with open(output_file, "w") as output, ThreadPoolExecutor(
+        max_workers=workers
+    ) as executor:
+        output.write("sku,status\n")
+        # map hands the batches back in order, so the file comes out in the same order as skus
+        for ctr, (batch, found) in enumerate(
+            zip(
+                batches,
+                executor.map(
+                    lambda batch: __mget_found(batch, opensearch, index), batches
+                ),
+            )
+        ):
+            if ctr % 50 == 0:
+                print(
+                    "Progress[%s]: %s of %s skus" % (ctr, ctr * batch_size, len(skus))
+                )
+            output.write(
+                "".join(
+                    "%s,%s\n" % (sku, 1 if is_found else 0)
+                    for (sku, is_found) in zip(batch, found)
+                )
+            )
+            output.flush()
+            num_valid += sum(found)
+    return num_valid
+
+
+# Returns whether each of the skus was found, without fetching any of the documents
+def __mget_found(skus, opensearch, index):
+    response = opensearch.mget(
+        body={"ids": [str(sku) for sku in skus]}, index=index, _source=False
+    )
+    return [doc.get("found", False) for doc in response["docs"]]
+
+
 def lookup_query(
     query,
-    all_clicks_df,
+    all_clicks,
     opensearch,
     explain=False,
     index="bbuy_products",
     source=None,
+    explain_workers=8,
+    explain_per_query=False,
 ):
-    gb = all_clicks_df.groupby("query")
-    if gb is not None:
-        click_group = gb.get_group(query)
-        if len(click_group) > 0:
-            print("Query: %s has %s clicked docs" % (query, len(click_group)))
-            for item in click_group.itertuples():
-                sku = item.sku
-                try:
-                    doc = lookup_product(sku, opensearch, index=index, source=source)
-                except NotFoundError as ne:
-                    print("Couldn't find doc: %s" % sku)
-                else:
-                    print(json.dumps(doc, indent=4))
-                    if explain:
-                        query_obj = qu.create_query(
-                            query,
-                            None,
-                            include_aggs=False,
-                            highlight=False,
-                            source=source,
-                        )
-                        query_obj.pop("size")
-                        query_obj.pop("sort")
-                        query_obj.pop("_source")
-                        print("Explain query %s" % query_obj)
-                        response = opensearch.explain(index, sku, body=query_obj)
-                        print(json.dumps(response, indent=4))
+    prior = pi.as_prior_index(all_clicks).lookup(query)
+    if prior.times_seen > 0:
+        print("Query: %s has %s clicked docs" % (query, prior.times_seen))
+        explanations = {}
+        if explain:
+            query_obj = qu.create_query(
+                query,
+                prior.click_prior_query,
+                None,
+                include_aggs=False,
+                highlight=False,
+                source=source,
+            )
+            query_obj.pop("size")
+            query_obj.pop("sort")
+            query_obj.pop("_source", None)
+            print("Explain query %s" % query_obj)
+            explanations = {
+                sku: explanation
+                for (_, sku, explanation) in collect_explains(
+                    [(query, query_obj, prior.skus.tolist())],
+                    opensearch,
+                    index,
+                    workers=explain_workers,
+                    per_query=explain_per_query,
+                )
+            }
+        for sku, clicks in zip(prior.skus.tolist(), prior.clicks.tolist()):
+            print("SKU: %s has %s clicks" % (sku, clicks))
+            try:
+                doc = lookup_product(sku, opensearch, index=index, source=source)
+            except NotFoundError as ne:
+                print("Couldn't find doc: %s" % sku)
+            else:
+                print(json.dumps(doc, indent=4))
+                if sku in explanations:
+                    print(json.dumps(explanations[sku], indent=4))
 
-        else:
-            print("No clicks for query %s" % query)
+    else:
+        print("No clicks for query %s" % query)
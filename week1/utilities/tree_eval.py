@@ -0,0 +1,201 @@
+# Scores docs locally with an LTR model file (as written by ltr_utils.write_opensearch_ltr_model), the way the LTR
+# plugin's xgboost model does in an sltr rescore, and estimates what scoring costs, so we can tell how expensive a model
+# is going to be in the rescore window before it is uploaded.
+# All the trees are flattened into one set of node arrays.  Every doc walks every tree at once: each step moves all the
+# (doc, tree) pairs that haven't reached a leaf yet one level down, so the Python loop only runs as many times as the
+# trees are deep.
+import json
+
+import ltr_utils as ltr
+import numpy as np
+import pandas as pd
+
+
+class ForestModel:
+    def __init__(
+        self,
+        feature_names,
+        objective,
+        roots,
+        feature,
+        threshold,
+        yes,
+        no,
+        missing,
+        value,
+    ):
+        self.feature_names = feature_names  # the column order score() expects
+        self.objective = objective
+        self.roots = roots  # the node index of the root of each tree
+        # One entry per node.  feature is -1 for leaves, value is the leaf value
+        self.feature = feature
+        self.threshold = threshold
+        self.yes = yes
+        self.no = no
+        self.missing = missing
+        self.value = value
+        self.max_depth = 0
+
+    # Load a .ltr model file.  Features are numbered in the order they first show up in the splits, unless
+    # feature_names (e.g. from ltr_utils.read_feature_map) gives the order.
+    @classmethod
+    def load(cls, ltr_model_file, feature_names=None):
+        print("Loading LTR model from %s" % ltr_model_file)
+        with open(ltr_model_file) as model_file:
+            os_model = json.load(model_file)
+        definition = json.loads(os_model["model"]["model"]["definition"])
+        feature_ids = {}
+        for name in feature_names or []:
+            feature_ids.setdefault(name, len(feature_ids))
+        roots, nodes = [], []
+        max_depth = 0
+        for tree in definition["splits"]:
+            offset = len(nodes)
+            roots.append(offset)
+            # node ids can have gaps if XGB pruned the tree, so give every id up to the biggest one a slot
+            tree_nodes = {}
+            stack = [(tree, 0)]
+            while len(stack) > 0:
+                node, depth = stack.pop()
+                tree_nodes[node["nodeid"]] = node
+                max_depth = max(max_depth, depth)
+                for child in node.get("children", []):
+                    stack.append((child, depth + 1))
+            for node_id in range(max(tree_nodes.keys()) + 1):
+                node = tree_nodes.get(node_id, {"leaf": 0.0})
+                if "leaf" in node:
+                    nodes.append((-1, 0.0, 0, 0, 0, node["leaf"]))
+                else:
+                    nodes.append(
+                        (
+                            feature_ids.setdefault(node["split"], len(feature_ids)),
+                            node["split_condition"],
+                            offset + node["yes"],
+                            offset + node["no"],
+                            offset + node.get("missing", node["yes"]),
+                            0.0,
+                        )
+                    )
+        columns = list(zip(*nodes)) if len(nodes) > 0 else [[]] * 6
+        model = cls(
+            list(feature_ids.keys()),
+            definition.get("objective", "reg:linear"),
+            np.array(roots, dtype=np.int64),
+            np.array(columns[0], dtype=np.int64),
+            np.array(columns[1], dtype=np.float32),
+            np.array(columns[2], dtype=np.int64),
+            np.array(columns[3], dtype=np.int64),
+            np.array(columns[4], dtype=np.int64),
+            np.array(columns[5], dtype=np.float64),
+        )
+        model.max_depth = max_depth
+        print(
+            "Loaded %s trees, %s nodes, max depth %s, over %s features"
+            % (len(roots), len(nodes), max_depth, len(model.feature_names))
+        )
+        return model
+
+    # Pull our features out of a data frame of logged features (like training.xgb.csv), in feature_names order.
+    # Features the data frame doesn't have are missing (NaN).
+    def feature_matrix(self, features_df):
+        columns = {
+            feat_name: col_name
+            for (col_name, feat_name) in ltr.get_feature_columns(features_df.keys())
+        }
+        features = np.full(
+            (len(features_df), len(self.feature_names)), np.nan, dtype=np.float32
+        )
+        for idx, name in enumerate(self.feature_names):
+            if name in columns:
+                features[:, idx] = features_df[columns[name]].to_numpy(dtype=np.float32)
+        return features
+
+    # Returns the score of each row of the feature matrix and the number of nodes (splits plus leaves) it went through
+    # to get it.  Rows are scored batch_size pairs of (doc, tree) at a time, to bound memory.
+    def score(self, features, batch_size=4000000):
+        features = np.asarray(features, dtype=np.float32)
+        num_docs, num_trees = len(features), len(self.roots)
+        scores = np.zeros(num_docs)
+        nodes_visited = np.zeros(num_docs, dtype=np.int64)
+        docs_per_batch = max(1, batch_size // max(num_trees, 1))
+        for start in range(0, num_docs, docs_per_batch):
+            batch = features[start : start + docs_per_batch]
+            nodes = np.tile(self.roots, len(batch))
+            depths = np.ones(len(nodes), dtype=np.int64)
+            active = np.flatnonzero(self.feature[nodes] >= 0)
+            while len(active) > 0:
+                node = nodes[active]
+                values = batch[active // num_trees, self.feature[node]]
+                nodes[active] = np.where(
+                    np.isnan(values),
+                    self.missing[node],
+                    np.where(
+                        values < self.threshold[node], self.yes[node], self.no[node]
+                    ),
+                )
+                depths[active] += 1
+                active = active[self.feature[nodes[active]] >= 0]
+            scores[start : start + len(batch)] = (
+                self.value[nodes].reshape(len(batch), num_trees).sum(axis=1)
+            )
+            nodes_visited[start : start + len(batch)] = depths.reshape(
+                len(batch), num_trees
+            ).sum(axis=1)
+        if self.objective in ("reg:logistic", "binary:logistic"):
+            scores = 1.0 / (1.0 + np.exp(-scores))
+        return scores, nodes_visited
+
+
+# Estimated cost of rescoring a query for each window size: every doc in the window goes through the trees, so the
+# cost is the window size times the nodes visited per doc, times what a node costs (node_ns nanoseconds).
+# mean_ms uses the mean nodes visited per doc, so it's the expected cost of a query.  p99_doc_bound_ms uses the 99th
+# percentile per doc as if every doc in the window hit it, so it's a worst case bound, not a per query percentile.
+def rescore_cost(nodes_visited, window_sizes=(100, 250, 500, 1000), node_ns=5.0):
+    mean_nodes = float(np.mean(nodes_visited)) if len(nodes_visited) > 0 else 0.0
+    p99_nodes = (
+        float(np.quantile(nodes_visited, 0.99)) if len(nodes_visited) > 0 else 0.0
+    )
+    return pd.DataFrame(
+        {
+            "window_size": list(window_sizes),
+            "mean_nodes_per_doc": mean_nodes,
+            "p99_nodes_per_doc": p99_nodes,
+            "mean_ms": [w * mean_nodes * node_ns / 1e6 for w in window_sizes],
+            "p99_doc_bound_ms": [w * p99_nodes * node_ns / 1e6 for w in window_sizes],
+        }
+    )
+
+
+# Load the model, score the logged features in features_df with it and print the estimated rescore cost per window
+# size.  If latency_budget (milliseconds) is set, returns False if the p99_doc_bound_ms cost at
+# budget_window_size is over it.
+def check_model_cost(
+    ltr_model_file,
+    features_df,
+    window_sizes=(100, 250, 500, 1000),
+    node_ns=5.0,
+    latency_budget=None,
+    budget_window_size=500,
+):
+    model = ForestModel.load(ltr_model_file)
+    _, nodes_visited = model.score(model.feature_matrix(features_df))
+    window_sizes = sorted(set(window_sizes) | {budget_window_size})
+    cost_df = rescore_cost(nodes_visited, window_sizes, node_ns)
+    print("Estimated rescore cost over %s docs:" % len(features_df))
+    print(cost_df.to_string(index=False))
+    if latency_budget is None:
+        return True
+    bound_ms = cost_df.loc[
+        cost_df["window_size"] == budget_window_size, "p99_doc_bound_ms"
+    ].iloc[0]
+    if bound_ms > latency_budget:
+        print(
+            "Model %s is over the latency budget: a worst case of %.2f ms at window size %s, budget %.2f ms"
+            % (ltr_model_file, bound_ms, budget_window_size, latency_budget)
+        )
+        return False
+    print(
+        "Model %s is within the latency budget: a worst case of %.2f ms at window size %s, budget %.2f ms"
+        % (ltr_model_file, bound_ms, budget_window_size, latency_budget)
+    )
+    return True
@@ -1,6 +1,13 @@
 # Utilities for working with XG Boost
+import itertools
 import json
+import multiprocessing
+import os
+import time
 
+import ltr_utils as ltr
+import numpy as np
+import pandas as pd
 import xgboost as xgb
 from matplotlib import pyplot as plt
 from xgboost import plot_importance, plot_tree
@@ -28,16 +35,85 @@ def plots(xgb_model, xgb_model_name, xgb_feat_map, xgb_plot):
         print("Unable to plot our models")
 
 
-# xgb_train_data is a string path to our training file
-def train(xgb_train_data, num_rounds=5, xgb_conf=None):
+def load_params(xgb_conf=None):
     xgb_params = {"objective": "reg:logistic"}
-    bst = None
     if xgb_conf is not None:
         with open(xgb_conf) as json_file:
             xgb_params = json.load(json_file)
+    return xgb_params
+
+
+# What a binary buffer was built from (see ltr_utils.source_stamp) is kept in a .source file next to the buffer
+def _write_source_stamp(buffer_file, source_file=None):
+    stamp_file = "%s.source" % buffer_file
+    if source_file is None:
+        if os.path.exists(stamp_file):
+            os.remove(stamp_file)
+        return
+    with open(stamp_file, "w") as output:
+        json.dump(ltr.source_stamp(source_file), output)
+
+
+def _read_source_stamp(buffer_file):
+    try:
+        with open("%s.source" % buffer_file) as stamp_file:
+            return json.load(stamp_file)
+    except (OSError, ValueError):
+        return None
+
+
+# Path of an XGB binary buffer with the training data in the xgb_train_data file (SVMRank text or binary buffer),
+# along with the DMatrix if it had to be parsed to get there (None otherwise).
+# cache_file is reused only if it was built from that very file, as recorded in its .source file, and rebuilt otherwise,
+# so repeated runs with different params don't pay to parse the text file again, but never pick up another data set.
+def training_buffer(xgb_train_data, cache_file):
+    if os.path.abspath(xgb_train_data.split("?")[0]) == os.path.abspath(cache_file):
+        return cache_file, None
+    if os.path.exists(cache_file):
+        stamp = _read_source_stamp(cache_file)
+        if stamp is not None and stamp == ltr.source_stamp(xgb_train_data):
+            print("Using cached XGB binary buffer %s" % cache_file)
+            return cache_file, None
+        print(
+            "XGB binary buffer %s was built from %s, rebuilding from %s"
+            % (
+                cache_file,
+                stamp["path"] if stamp is not None else "unknown data",
+                xgb_train_data,
+            )
+        )
+    dtrain = xgb.DMatrix(xgb_train_data)
+    print("Caching XGB binary buffer to %s" % cache_file)
+    dtrain.save_binary(cache_file)
+    _write_source_stamp(cache_file, xgb_train_data)
+    return cache_file, dtrain
+
+
+# Load training data for XGB.  xgb_train_data is either a DMatrix, which we use as is, or a path to a training file
+# (SVMRank text or XGB binary buffer).  If cache_file is set, the data is loaded through a binary buffer there (see
+# training_buffer).
+def load_training_data(xgb_train_data, cache_file=None):
+    if isinstance(xgb_train_data, xgb.DMatrix):
+        return xgb_train_data
+    if cache_file is None:
+        return xgb.DMatrix(xgb_train_data)
+    buffer_file, dtrain = training_buffer(xgb_train_data, cache_file)
+    if dtrain is None:
+        print("Loading XGB binary buffer from %s" % buffer_file)
+        dtrain = xgb.DMatrix(buffer_file)
+    return dtrain
+
+
+# xgb_train_data is a string path to our training file (text or binary buffer) or an in-memory DMatrix
+def train(xgb_train_data, num_rounds=5, xgb_conf=None, cache_file=None):
+    xgb_params = load_params(xgb_conf)
+    bst = None
+    source = xgb_train_data
+    if isinstance(xgb_train_data, xgb.DMatrix):
+        source = "in-memory DMatrix"
     print(
         "Training XG Boost on %s for %s rounds with params: %s"
-        % (xgb_train_data, num_rounds, xgb_params)
+        % (source, num_rounds, xgb_params)
     )
     ##### Step 3.a
     # print("IMPLEMENT ME: train()")
@@ -47,5 +123,321 @@ def train(xgb_train_data, num_rounds=5, xgb_conf=None):
     #   The DMatrix is a 8761 x 8 matrix
     #   Columns consist of (assuming the case of 7 features: feature_index:feature_value)
     #       0.0000 1:12.4681       2:12.4681       3:0.0000        4:10.8821       5:13.7044       6:2.7000        7:75.0000
-    bst = xgb.train(xgb_params, xgb.DMatrix(xgb_train_data), num_boost_round=num_rounds)
+    dtrain = load_training_data(xgb_train_data, cache_file)
+    bst = xgb.train(xgb_params, dtrain, num_boost_round=num_rounds)
     return bst, xgb_params
+
+
+# Build a DMatrix straight from the training data frame, skipping the SVMRank text file entirely.
+# Feature columns line up with the feature map written by ltr_utils.write_feature_map
+def create_dmatrix(train_data):
+    features, grades, qids, _ = ltr.get_training_matrix(train_data)
+    dmatrix = xgb.DMatrix(features, label=grades)
+    # qids are sorted, so the counts come back in the same order as the rows
+    _, group_sizes = np.unique(qids, return_counts=True)
+    dmatrix.set_group(group_sizes)
+    return dmatrix
+
+
+# Save the training data in XGB's binary buffer format, which loads without any parsing.  The buffer is built straight
+# from the data frame (rows sorted by qid, full precision features), so it doesn't hold quite the same data as a
+# training.xgb text file written from the same frame: it is recorded as built from no file, and --xgb with a text file
+# always rebuilds it.
+def write_training_buffer(train_data, output_file):
+    print("Writing XGB binary training buffer to %s" % output_file)
+    dmatrix = create_dmatrix(train_data)
+    dmatrix.save_binary(output_file)
+    _write_source_stamp(output_file)
+    return dmatrix
+
+
+# Load a saved XGB model and return a function that scores a data frame of logged LTR features (one column per
+# feature name, as returned by the LTR logging ext) the same way the LTR plugin would in a rescore.
+# The plugin only adds up the leaves of the trees and applies the sigmoid for logistic objectives, so we take XGB's
+# base score back out of the prediction.
+def create_ltr_scorer(xgb_model, xgb_feat_map):
+    bst = xgb.Booster()
+    bst.load_model(xgb_model)
+    feature_names = ltr.read_feature_map(xgb_feat_map)
+    learner = json.loads(bst.save_config())["learner"]
+    objective = learner["objective"]["name"]
+    # newer versions of XGB store the base score as a vector, e.g. '[5E-1]'
+    base_score = float(
+        str(learner["learner_model_param"]["base_score"]).strip("[]").split(",")[0]
+    )
+    logistic = objective in ("reg:logistic", "binary:logistic")
+    base_margin = np.log(base_score / (1 - base_score)) if logistic else base_score
+    print(
+        "Scoring offline with %s, objective: %s, features: %s"
+        % (xgb_model, objective, feature_names[1:])
+    )
+
+    def score(features_df):
+        features = np.full(
+            (len(features_df), len(feature_names)), np.nan, dtype=np.float32
+        )
+        for idx, feat in enumerate(feature_names):
+            if idx > 0 and feat in features_df:
+                features[:, idx] = features_df[feat].to_numpy(dtype=np.float32)
+        margin = bst.predict(xgb.DMatrix(features), output_margin=True) - base_margin
+        if logistic:
+            return 1.0 / (1.0 + np.exp(-margin))
+        return margin
+
+    return score
+
+
+# The trees of a booster as NumPy arrays, read straight from its JSON model rather than from a text dump per tree.
+# Each tree is a dict of node arrays: left and right (the child node ids, -1 for leaves), feature (the split feature
+# index, which lines up with the feature map), condition (the split threshold, or the value of a leaf), default_left
+# (whether missing values go left) and cover (the hessian of the training rows that reached the node)
+def load_trees(bst):
+    model = json.loads(bst.save_raw("json"))["learner"]["gradient_booster"]["model"]
+    trees = []
+    for tree in model["trees"]:
+        trees.append(
+            {
+                "left": np.array(tree["left_children"], dtype=np.int32),
+                "right": np.array(tree["right_children"], dtype=np.int32),
+                "feature": np.array(tree["split_indices"], dtype=np.int32),
+                "condition": np.array(tree["split_conditions"], dtype=np.float32),
+                "default_left": np.array(tree["default_left"], dtype=bool),
+                "cover": np.array(tree["sum_hessian"], dtype=np.float64),
+            }
+        )
+    return trees
+
+
+# How expensive a tree is to score: its number of nodes and the expected number of splits a doc goes through on its
+# way to a leaf, weighting every split by the share of the training data that reached it
+def tree_cost(tree):
+    splits = tree["left"] >= 0
+    root_cover = tree["cover"][0]
+    if root_cover <= 0:
+        return len(splits), float(splits.sum())
+    return len(splits), float(tree["cover"][splits].sum() / root_cover)
+
+
+# Writes a tree in the JSON format the LTR plugin reads, the same as bst.get_dump(fmap, dump_format="json").
+# If threshold_digits is set, split thresholds are rounded to that many significant digits, which shrinks the model,
+# but can move a threshold past some feature values and so change the score of the docs that have them.
+def tree_to_ltr_json(tree, feature_names, threshold_digits=None):
+    threshold_format = "%%.%sg" % (threshold_digits or 9)
+    left, right, condition = tree["left"], tree["right"], tree["condition"]
+
+    def node_json(node, depth):
+        if left[node] < 0:
+            return '{"nodeid":%d,"leaf":%.9g}' % (node, condition[node])
+        missing = left[node] if tree["default_left"][node] else right[node]
+        return (
+            '{"nodeid":%d,"depth":%d,"split":%s,"split_condition":%s,"yes":%d,"no":%d,"missing":%d,"children":[%s,%s]}'
+            % (
+                node,
+                depth,
+                json.dumps(feature_names[tree["feature"][node]]),
+                threshold_format % condition[node],
+                left[node],
+                right[node],
+                missing,
+                node_json(left[node], depth + 1),
+                node_json(right[node], depth + 1),
+            )
+        )
+
+    return node_json(0, 0)
+
+
+# Streams the booster to the OpenSearch LTR model file, optionally keeping only the first max_trees trees (the first
+# rounds of boosting do most of the work) and rounding thresholds to threshold_digits.  Prints how much smaller and
+# cheaper to score the exported model is than the whole one.
+def export_ltr_model(
+    bst,
+    model_name,
+    model_file,
+    feat_map,
+    objective,
+    max_trees=None,
+    threshold_digits=None,
+):
+    feature_names = ltr.read_feature_map(feat_map)
+    trees = load_trees(bst)
+    exported = trees[:max_trees] if max_trees else trees
+    model_size = ltr.write_opensearch_ltr_model(
+        model_name,
+        (tree_to_ltr_json(tree, feature_names, threshold_digits) for tree in exported),
+        model_file,
+        objective=objective,
+    )
+    costs = np.array([tree_cost(tree) for tree in trees]).reshape(-1, 2)
+    print(
+        "Exported %s of %s trees, %d of %d nodes, %.1f of %.1f expected splits per doc, %s bytes"
+        % (
+            len(exported),
+            len(trees),
+            costs[: len(exported), 0].sum(),
+            costs[:, 0].sum(),
+            costs[: len(exported), 1].sum(),
+            costs[:, 1].sum(),
+            model_size,
+        )
+    )
+    if len(exported) < len(trees) or threshold_digits:
+        # what the whole model at full precision would have taken, counted without writing it out
+        full_size = model_size + sum(
+            len(json.dumps(tree_to_ltr_json(tree, feature_names))) - 1 for tree in trees
+        )
+        full_size -= sum(
+            len(json.dumps(tree_to_ltr_json(tree, feature_names, threshold_digits))) - 1
+            for tree in exported
+        )
+        print(
+            "The full model would be %s bytes, the export is %.1f%% of that"
+            % (full_size, 100.0 * model_size / full_size)
+        )
+    return model_size
+
+
+# Offline ranking quality for a set of predictions, with no need to go to OpenSearch.
+# group_ptr holds the row offsets of each query group, the same as DMatrix.get_uint_info("group_ptr").
+# Returns the mean NDCG@k and MRR over the groups that have at least one non-zero grade.  For MRR the relevant doc of a
+# query is its highest graded one, so MRR works the same across all our click models.
+def rank_metrics(labels, preds, group_ptr, k=10):
+    group_ptr = np.asarray(group_ptr, dtype=np.int64)
+    group_sizes = np.diff(group_ptr)
+    num_groups = len(group_sizes)
+    group_ids = np.repeat(np.arange(num_groups), group_sizes)
+    labels = np.asarray(labels, dtype=np.float64)
+    # position of each row within its group, once the group is sorted
+    positions = np.arange(len(labels)) - np.repeat(group_ptr[:-1], group_sizes)
+    discounts = np.where(positions < k, 1.0 / np.log2(positions + 2), 0.0)
+    by_pred = np.lexsort((-np.asarray(preds), group_ids))
+    by_label = np.lexsort((-labels, group_ids))
+    gains = np.power(2.0, labels) - 1
+    dcg = np.bincount(
+        group_ids, weights=gains[by_pred] * discounts, minlength=num_groups
+    )
+    idcg = np.bincount(
+        group_ids, weights=gains[by_label] * discounts, minlength=num_groups
+    )
+    has_relevant = idcg > 0
+    ndcg = (
+        np.mean(dcg[has_relevant] / idcg[has_relevant]) if has_relevant.any() else 0.0
+    )
+    best_labels = labels[by_label][np.minimum(group_ptr[:-1], len(labels) - 1)]
+    is_best = labels[by_pred] == best_labels[group_ids]
+    first_best = np.full(num_groups, np.inf)
+    np.minimum.at(first_best, group_ids[is_best], positions[is_best])
+    # Groups without a non-zero grade have no relevant doc at all, so leave them out like for NDCG
+    mrr = np.mean(1.0 / (first_best[has_relevant] + 1)) if has_relevant.any() else 0.0
+    return ndcg, mrr
+
+
+# Each sweep worker loads the DMatrix once and keeps it around for all the models it trains
+_sweep_data = None
+
+
+def _init_sweep_worker(buffer_file, holdout, seed):
+    global _sweep_data
+    dmatrix = xgb.DMatrix(buffer_file)
+    _sweep_data = split_by_group(dmatrix, holdout, seed)
+
+
+# Split a DMatrix into train and held out DMatrices, keeping all the rows of a query group on the same side.
+# DMatrix.slice doesn't support query groups, so we rebuild both sides from the underlying sparse matrix.
+def split_by_group(dmatrix, holdout=0.2, seed=42):
+    group_ptr = dmatrix.get_uint_info("group_ptr").astype(np.int64)
+    if len(group_ptr) < 2:  # no query groups, so every row is its own group
+        group_ptr = np.arange(dmatrix.num_row() + 1)
+    group_sizes = np.diff(group_ptr)
+    features = dmatrix.get_data()
+    labels = dmatrix.get_label()
+    rng = np.random.default_rng(seed)
+    in_holdout = rng.random(len(group_sizes)) < holdout
+    row_in_holdout = np.repeat(in_holdout, group_sizes)
+    splits = []
+    for group_mask, row_mask in (
+        (~in_holdout, ~row_in_holdout),
+        (in_holdout, row_in_holdout),
+    ):
+        split = xgb.DMatrix(features[row_mask], label=labels[row_mask])
+        split.set_group(group_sizes[group_mask])
+        splits.append(split)
+    return splits[0], splits[1]
+
+
+def _train_and_evaluate(job):
+    xgb_params, num_rounds, k = job
+    dtrain, dholdout = _sweep_data
+    start = time.perf_counter()
+    bst = xgb.train(xgb_params, dtrain, num_boost_round=num_rounds)
+    train_secs = time.perf_counter() - start
+    ndcg, mrr = rank_metrics(
+        dholdout.get_label(),
+        bst.predict(dholdout),
+        dholdout.get_uint_info("group_ptr"),
+        k=k,
+    )
+    return {
+        "params": json.dumps(xgb_params, sort_keys=True),
+        "num_rounds": num_rounds,
+        "ndcg@%s" % k: ndcg,
+        "mrr": mrr,
+        "train_secs": train_secs,
+    }
+
+
+# Train one model per combination of the parameter grid in a process pool, scoring each on the same held out
+# set of query groups.  The grid is a JSON dict of param name -> list of values, e.g.
+#   {"eta": [0.1, 0.3], "max_depth": [3, 6], "num_rounds": [5, 20]}
+# where num_rounds is optional and overrides the num_rounds argument. Any other params come from xgb_conf.
+# All workers read the same binary buffer, so the training data is only ever parsed once.
+# Returns the leaderboard as a DataFrame, best NDCG first.
+def sweep(
+    buffer_file,
+    sweep_grid,
+    xgb_conf=None,
+    num_rounds=5,
+    holdout=0.2,
+    workers=None,
+    k=10,
+    seed=42,
+):
+    base_params = load_params(xgb_conf)
+    with open(sweep_grid) as json_file:
+        grid = json.load(json_file)
+    workers = workers or os.cpu_count()
+    names = list(grid.keys())
+    jobs = []
+    for values in itertools.product(*[grid[name] for name in names]):
+        xgb_params = dict(base_params)
+        xgb_params.update(zip(names, values))
+        rounds = xgb_params.pop("num_rounds", num_rounds)
+        # one thread per model unless told otherwise, the pool is what uses all the cores
+        xgb_params.setdefault("nthread", 1)
+        jobs.append((xgb_params, rounds, k))
+    print(
+        "Sweeping %s XGB models over %s workers using %s, holding out %s of the queries"
+        % (len(jobs), workers, buffer_file, holdout)
+    )
+    with multiprocessing.Pool(
+        processes=workers,
+        initializer=_init_sweep_worker,
+        initargs=(buffer_file, holdout, seed),
+    ) as pool:
+        results = []
+        for result in pool.imap_unordered(_train_and_evaluate, jobs):
+            print(
+                "NDCG@%s: %.4f\tMRR: %.4f\trounds: %s\tparams: %s"
+                % (
+                    k,
+                    result["ndcg@%s" % k],
+                    result["mrr"],
+                    result["num_rounds"],
+                    result["params"],
+                )
+            )
+            results.append(result)
+    leaderboard = pd.DataFrame(results)
+    return leaderboard.sort_values(["ndcg@%s" % k, "mrr"], ascending=False).reset_index(
+        drop=True
+    )
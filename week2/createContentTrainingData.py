@@ -1,22 +1,51 @@
 import argparse
+import functools
 import glob
-import itertools
+import mmap
 import multiprocessing
 import os
 import random
 import re
+import sys
+import tempfile
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from typing import Generator, List, Tuple
+from typing import Dict, Generator, List, Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from nltk.stem import SnowballStemmer
 from tqdm import tqdm
 
+# The category taxonomy lives with the other shared scripts in the top level utilities
+#   directory; importing it has no side effects
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "utilities")
+)
+from category_taxonomy import CATEGORIES_FILE, Taxonomy
+
 # Contants
 COLNAME_CATEGORY: str = "category_code"
 COLNAME_PROD_NAME: str = "normalized_product_name"
 COLNAME_N_PROD_PER_CATEGORY: str = "n_products_per_category"
+COLNAME_ORIGINAL_CATEGORY: str = "original_category_code"
+PRODUCT_START_TAG: bytes = b"<product>"
+PRODUCT_END_TAG: bytes = b"</product>"
+WRITE_BUFFER_SIZE: int = 1 << 22
+
+
+# One stemmer per process; building one per token is most of the cost of stemming
+STEMMER: SnowballStemmer = SnowballStemmer("english")
+
+
+@functools.lru_cache(maxsize=None)
+def stem(token: str) -> str:
+    """Snowball stem of a token, memoized
+
+    Product names repeat the same tokens over and over, so each distinct
+    token is only stemmed once per worker
+    """
+    return STEMMER.stem(token)
 
 
 def transform_name(product_name: str) -> str:
@@ -46,10 +75,7 @@ def transform_name(product_name: str) -> str:
     # 2. Apply Snowball stemmer
     # TODO: Ask instructors about why Snowball stemmer
     #   --a more aggressive stemmer is picked over Porter stemmer
-    tokens: List[str] = [
-        SnowballStemmer("english").stem(token)
-        for token in product_name_processed.split()
-    ]
+    tokens: List[str] = [stem(token) for token in product_name_processed.split()]
 
     return " ".join(tokens)
 
@@ -103,6 +129,12 @@ general.add_argument(
     help="Method used to prune category taxonomy (default to 'filter').",
 )
 
+general.add_argument(
+    "--categories",
+    default=CATEGORIES_FILE,
+    help="The category taxonomy XML, used by --pruning_method rollup",
+)
+
 args = parser.parse_args()
 output_file = args.output
 path = Path(output_file)
@@ -147,17 +179,11 @@ def filter_category_by_n_products(
     #   ``min_products`` cutoff
     # The cutoff is to ensure each class label has sufficient
     #   data coverage for ML classification
+    n_products_per_category: pd.Series = df_all_labels.groupby(COLNAME_CATEGORY)[
+        COLNAME_PROD_NAME
+    ].nunique()
     list_category_keeper: List[str] = list(
-        df_all_labels.groupby(COLNAME_CATEGORY)
-        .agg(
-            **{
-                COLNAME_N_PROD_PER_CATEGORY: pd.NamedAgg(
-                    column=COLNAME_PROD_NAME, aggfunc=lambda x: len(set(x))
-                )
-            }
-        )
-        .query(f"{COLNAME_N_PROD_PER_CATEGORY} >= {min_products}")
-        .index
+        n_products_per_category.index[n_products_per_category >= min_products]
     )
 
     # Apply category pruning
@@ -169,69 +195,267 @@ def filter_category_by_n_products(
     return df_all_labels
 
 
+def rollup_category_by_n_products(
+    df_all_labels: pd.DataFrame, taxonomy: Taxonomy, min_products: int = 1
+) -> pd.DataFrame:
+    """Roll categories with fewer than ``min_products`` up into their parents
+
+    Works bottom-up over the taxonomy's parent array, one depth at a time, on the
+    distinct (category, product name) code pairs rather than on the rows: every
+    category at a depth with too few distinct products passes its pairs to its
+    parent, and the pairs are deduped again so parents count distinct products
+    across all their children.  Each row's category is then remapped to where it
+    ended up in one step.  Categories still short of ``min_products`` at the root
+    are filtered out, the same as ``filter_category_by_n_products``.
+    Categories that aren't in the taxonomy are never rolled up.
+
+    Parameters
+    ----------
+    df_all_labels: pd.DataFrame
+        | Complete set of labelled data (category id vs. product title)
+    taxonomy: Taxonomy
+        | Category taxonomy the category ids come from
+    min_products: int, default = 1
+        | n_products per category cutoff
+
+    Returns
+    -------
+    pd.DataFrame
+        | labelled data after category rollup
+
+    """
+    category_codes, categories = pd.factorize(df_all_labels[COLNAME_CATEGORY])
+    name_codes, names = pd.factorize(df_all_labels[COLNAME_PROD_NAME])
+    # Categories not in the taxonomy get their own slots after the taxonomy's
+    taxonomy_index = taxonomy.index_of(categories)
+    unknown = taxonomy_index < 0
+    taxonomy_index[unknown] = len(taxonomy.ids) + np.arange(unknown.sum())
+    parents = np.append(taxonomy.parents, np.full(unknown.sum(), -1))
+    depths = np.append(taxonomy.depths, np.zeros(unknown.sum(), dtype=np.int32))
+
+    # Distinct (category, name) pairs, deduped through single int64 codes
+    n_names = max(len(names), 1)
+    pair_categories, pair_names = np.divmod(
+        pd.unique(taxonomy_index[category_codes] * n_names + name_codes), n_names
+    )
+    rolled_to = np.arange(len(parents))
+    for depth in range(int(depths.max(initial=0)), 0, -1):
+        n_products = np.bincount(pair_categories, minlength=len(parents))
+        at_depth = np.flatnonzero((depths == depth) & (n_products > 0))
+        rollup = at_depth[n_products[at_depth] < min_products]
+        if len(rollup) == 0:
+            continue
+        rolled_to[rollup] = parents[rollup]
+        # Only the pairs of the rolled up categories and of their parents can
+        #   turn into duplicates
+        touched_categories = np.zeros(len(parents), dtype=bool)
+        touched_categories[rollup] = True
+        touched_categories[parents[rollup]] = True
+        touched = touched_categories[pair_categories]
+        merged_categories, merged_names = np.divmod(
+            pd.unique(
+                rolled_to[pair_categories[touched]] * n_names + pair_names[touched]
+            ),
+            n_names,
+        )
+        pair_categories = np.concatenate([pair_categories[~touched], merged_categories])
+        pair_names = np.concatenate([pair_names[~touched], merged_names])
+    # Follow the rollups up to where each category ended up
+    resolved = rolled_to[rolled_to]
+    while (resolved != rolled_to[resolved]).any():
+        resolved = rolled_to[resolved]
+    n_products = np.bincount(pair_categories, minlength=len(parents))
+    row_categories = resolved[taxonomy_index[category_codes]]
+    keep = n_products[row_categories] >= min_products
+    category_ids = np.append(
+        taxonomy.ids, np.asarray(categories, dtype=object)[unknown]
+    )
+    df_all_labels = df_all_labels[keep].copy()
+    df_all_labels[COLNAME_CATEGORY] = category_ids[row_categories[keep]]
+    return df_all_labels
+
+
+def _label_product(product: ET.Element) -> Optional[Tuple[str, str]]:
+    """(category, normalized name) label of a product, or None if it has none
+
+    Products need a non-empty name and a leaf category, and must not be under
+    music or movies (abcat0600000)
+    """
+    name: Optional[str] = product.findtext("name")
+    category_path: Optional[ET.Element] = product.find("categoryPath")
+    if not name or category_path is None or len(category_path) < 2:
+        return None
+    leaf: ET.Element = category_path[-1]
+    if (
+        leaf[0].text is None
+        or category_path[0][0].text != "cat00000"
+        or category_path[1][0].text == "abcat0600000"
+    ):
+        return None
+    # Choose last element in categoryPath as the leaf categoryId or name
+    if names_as_labels and pruning_method != "rollup":
+        cat = leaf[1].text.replace(" ", "_")
+    else:
+        cat = leaf[0].text
+    # Replace newline chars with spaces so fastText doesn't complain
+    return cat, transform_name(name.replace("\n", " "))
+
+
+def _iterparse_sampled_products(filename: str) -> Generator[ET.Element, None, None]:
+    for _, element in ET.iterparse(filename):
+        if element.tag == "product":
+            if random.random() <= sample_rate:
+                yield element
+            element.clear()
+
+
+def _sampled_products(filename: str) -> Generator[ET.Element, None, None]:
+    """Stream the sampled products of a product XML file
+
+    Product elements are never nested, so we find each one's bytes with a plain
+    search over the memory mapped file and only parse the ones that are sampled:
+    unsampled products are never parsed at all.  If the file doesn't have any
+    ``<product>`` tags (e.g. they have attributes), we fall back to ``iterparse``.
+    """
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, "rb") as xml_file, mmap.mmap(
+        xml_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        start = data.find(PRODUCT_START_TAG)
+        if start < 0:
+            yield from _iterparse_sampled_products(filename)
+            return
+        while start >= 0:
+            end = data.find(PRODUCT_END_TAG, start)
+            if end < 0:
+                break
+            end += len(PRODUCT_END_TAG)
+            if random.random() <= sample_rate:
+                yield ET.fromstring(data[start:end])
+            start = data.find(PRODUCT_START_TAG, end)
+
+
 def _label_filename(filename):
-    tree = ET.parse(filename)
-    root = tree.getroot()
     labels = []
-    for child in root:
-        if random.random() > sample_rate:
-            continue
-        # Check to make sure category name is valid and not in music or movies
-        if (
-            child.find("name") is not None
-            and child.find("name").text is not None
-            and child.find("categoryPath") is not None
-            and len(child.find("categoryPath")) > 0
-            and child.find("categoryPath")[len(child.find("categoryPath")) - 1][0].text
-            is not None
-            and child.find("categoryPath")[0][0].text == "cat00000"
-            and child.find("categoryPath")[1][0].text != "abcat0600000"
-        ):
-            # Choose last element in categoryPath as the leaf categoryId or name
-            if names_as_labels:
-                cat = child.find("categoryPath")[len(child.find("categoryPath")) - 1][
-                    1
-                ].text.replace(" ", "_")
-            else:
-                cat = child.find("categoryPath")[len(child.find("categoryPath")) - 1][
-                    0
-                ].text
-            # Replace newline chars with spaces so fastText doesn't complain
-            name = child.find("name").text.replace("\n", " ")
-            labels.append((cat, transform_name(name)))
+    for product in _sampled_products(filename):
+        label = _label_product(product)
+        if label is not None:
+            labels.append(label)
     return labels
 
 
-if __name__ == "__main__":
-
-    files: List[str] = glob.glob(f"{directory}/*.xml")
+def _category_labels(df_pairs: pd.DataFrame) -> Dict[str, str]:
+    """fastText label of each category that survives pruning
 
-    print("Writing results to %s" % output_file)
+    Parameters
+    ----------
+    df_pairs: pd.DataFrame
+        | Distinct (category, product name hash) pairs
 
-    with multiprocessing.Pool() as p:
+    Returns
+    -------
+    Dict[str, str]
+        | ``__label__`` label for each kept category, keyed by the category
+        the products were extracted with (rollup may change it)
 
-        all_labels: Generator[List[List[Tuple[str, str]]], None, None] = tqdm(
-            p.imap_unordered(_label_filename, files), total=len(files)
+    """
+    df_pairs[COLNAME_ORIGINAL_CATEGORY] = df_pairs[COLNAME_CATEGORY]
+    # Prune taxonomy tree using selected method (filter or rollup)
+    if pruning_method == "filter":
+        df_pairs = filter_category_by_n_products(df_pairs, min_products=min_products)
+    elif pruning_method == "rollup":
+        taxonomy = Taxonomy.load(args.categories)
+        df_pairs = rollup_category_by_n_products(
+            df_pairs, taxonomy, min_products=min_products
         )
-
-        # Package category vs. product name data into pandas dataframe
-        #   ``itertools.chain.from_iterable(all_labels)`` is to flatten
-        #   nested iterable content list(list())
-        df_all_labels: pd.DataFrame = pd.DataFrame(
-            itertools.chain.from_iterable(all_labels),
-            columns=[COLNAME_CATEGORY, COLNAME_PROD_NAME],
+        # Rollup needs category ids, so names are only swapped in afterwards
+        if names_as_labels:
+            category_names = pd.Series(taxonomy.names, index=taxonomy.ids).str.replace(
+                " ", "_"
+            )
+            df_pairs[COLNAME_CATEGORY] = (
+                df_pairs[COLNAME_CATEGORY]
+                .map(category_names)
+                .fillna(df_pairs[COLNAME_CATEGORY])
+            )
+    df_categories = df_pairs.drop_duplicates(COLNAME_ORIGINAL_CATEGORY)
+    return dict(
+        zip(
+            df_categories[COLNAME_ORIGINAL_CATEGORY],
+            df_categories[COLNAME_CATEGORY].map("__label__{}".format),
         )
+    )
 
-        # Prune taxonomy tree using selected method (filter or rollup)
-        if pruning_method == "filter":
-            df_all_labels = filter_category_by_n_products(
-                df_all_labels, min_products=min_products
-            )
 
-        # Add __label__ to category codes values
-        df_all_labels[COLNAME_CATEGORY] = df_all_labels[COLNAME_CATEGORY].map(
-            "__label__{}".format
-        )
+if __name__ == "__main__":
+
+    files: List[str] = glob.glob(f"{directory}/*.xml")
+
+    print("Writing results to %s" % output_file)
+
+    # Two passes, so memory doesn't grow with the catalog:
+    # 1. Extract the labels file by file, spooling them to a temporary file as they
+    #   come and keeping only the distinct (category code, product name hash)
+    #   pairs needed to count products per category
+    # 2. Stream the spool back, writing out the rows whose category survives
+    #   pruning (under its rolled up label, if any)
+    # The spool goes in a temporary directory next to the output, so it is removed
+    #   even if a pass fails
+    with tempfile.TemporaryDirectory(dir=output_dir) as spool_dir:
+        spool_file: str = os.path.join(spool_dir, "labels.spool")
+        category_codes: Dict[str, int] = {}
+        pair_chunks: List[pd.DataFrame] = []
+        with multiprocessing.Pool() as p, open(
+            spool_file, "w", buffering=WRITE_BUFFER_SIZE
+        ) as spool:
+
+            all_labels: Generator[List[Tuple[str, str]], None, None] = tqdm(
+                p.imap_unordered(_label_filename, files), total=len(files)
+            )
+            for labels in all_labels:
+                if len(labels) == 0:
+                    continue
+                spool.write("".join([f"{cat}\t{name}\n" for (cat, name) in labels]))
+                pair_chunks.append(
+                    pd.DataFrame(
+                        {
+                            COLNAME_CATEGORY: np.array(
+                                [
+                                    category_codes.setdefault(cat, len(category_codes))
+                                    for (cat, _) in labels
+                                ],
+                                dtype=np.int32,
+                            ),
+                            COLNAME_PROD_NAME: pd.util.hash_array(
+                                np.array([name for (_, name) in labels], dtype=object)
+                            ),
+                        }
+                    ).drop_duplicates()
+                )
 
-        # Write to ``output_file`` as tab-separated csv file (headerless)
-        df_all_labels.to_csv(output_file, index=False, header=False, sep="\t")
+        df_pairs: pd.DataFrame = pd.concat(
+            pair_chunks
+            or [pd.DataFrame({COLNAME_CATEGORY: [], COLNAME_PROD_NAME: []}, dtype=int)],
+            ignore_index=True,
+        ).drop_duplicates()
+        df_pairs[COLNAME_CATEGORY] = np.array(
+            list(category_codes.keys()), dtype=object
+        )[df_pairs[COLNAME_CATEGORY].to_numpy(dtype=np.int64)]
+        category_labels: Dict[str, str] = _category_labels(df_pairs)
+        del df_pairs, pair_chunks
+
+        # Write to ``output_file`` as tab-separated rows of label and product name
+        with open(spool_file) as spool, open(
+            output_file, "w", buffering=WRITE_BUFFER_SIZE
+        ) as output:
+            lines: List[str] = spool.readlines(WRITE_BUFFER_SIZE)
+            while len(lines) > 0:
+                rows: List[str] = []
+                for line in lines:
+                    cat, name = line.split("\t", 1)
+                    label: Optional[str] = category_labels.get(cat)
+                    if label is not None:
+                        rows.append(f"{label}\t{name}")
+                output.write("".join(rows))
+                lines = spool.readlines(WRITE_BUFFER_SIZE)
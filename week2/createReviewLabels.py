@@ -1,11 +1,24 @@
 import argparse
+import glob
+import html
+import mmap
+import multiprocessing
 import os
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
 from pathlib import Path
 
+from tqdm import tqdm
 
-def transform_training_data(title, comment):
+REVIEW_START_TAG = b"<review>"
+REVIEW_END_TAG = b"</review>"
+
+
+# Transforms the titles and comments of a whole file's reviews at once, returning the training text of each review
+def transform_training_data(titles, comments):
     # IMPLEMENT
-    return title + " " + comment
+    return [title + " " + comment for (title, comment) in zip(titles, comments)]
 
 
 # Directory for review data
@@ -20,6 +33,12 @@ general.add_argument(
     default="/workspace/datasets/fasttext/output.fasttext",
     help="the file to output to",
 )
+general.add_argument(
+    "--processes",
+    default=multiprocessing.cpu_count(),
+    type=int,
+    help="The number of processes extracting reviews (default is the number of cores)",
+)
 
 args = parser.parse_args()
 output_file = args.output
@@ -32,20 +51,106 @@ if args.input:
     directory = args.input
 
 
-print("Writing results to %s" % output_file)
-with open(output_file, "w") as output:
-    for filename in os.listdir(directory):
-        if filename.endswith(".xml"):
-            with open(os.path.join(directory, filename)) as xml_file:
-                for line in xml_file:
-                    if "<rating>" in line:
-                        rating = line[12:15]
-                    elif "<title>" in line:
-                        title = line[11 : len(line) - 9]
-                    elif "<comment>" in line:
-                        comment = line[13 : len(line) - 11]
-                    elif "</review>" in line:
-                        output.write(
-                            "__label__%s %s\n"
-                            % (rating, transform_training_data(title, comment))
-                        )
+# fastText reads one example per line
+def _one_line(text):
+    return (text or "").replace("\r", " ").replace("\n", " ")
+
+
+def _iterparse_reviews(filename):
+    for _, element in ET.iterparse(filename):
+        if element.tag == "review":
+            yield (
+                (element.findtext("rating") or "").strip(),
+                _one_line(element.findtext("title")),
+                _one_line(element.findtext("comment")),
+            )
+            element.clear()
+
+
+# Text of the first <tag>...</tag> in a review's bytes, entities decoded, or "" if it isn't there
+def _tag_text(review, start_tag, end_tag):
+    start = review.find(start_tag)
+    if start < 0:
+        return ""
+    start += len(start_tag)
+    end = review.find(end_tag, start)
+    if end < 0:
+        return ""
+    text = review[start:end].decode("utf-8")
+    return html.unescape(text) if "&" in text else text
+
+
+# Stream the (rating, title, comment) of every review in a review file.  Reviews are never nested, so we find each
+# one's bytes with a plain search over the memory mapped file and pull the three tags out of them the same way, without
+# building any elements.  Files that don't fit that shape (no bare <review> tags, or CDATA sections) go through
+# iterparse instead.
+def _reviews(filename):
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename, "rb") as xml_file, mmap.mmap(
+        xml_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        start = data.find(REVIEW_START_TAG)
+        if start < 0 or data.find(b"<![CDATA[") >= 0:
+            yield from _iterparse_reviews(filename)
+            return
+        while start >= 0:
+            end = data.find(REVIEW_END_TAG, start)
+            if end < 0:
+                raise ET.ParseError("unclosed %s" % REVIEW_START_TAG.decode())
+            review = data[start:end]
+            yield (
+                _tag_text(review, b"<rating>", b"</rating>").strip(),
+                _one_line(_tag_text(review, b"<title>", b"</title>")),
+                _one_line(_tag_text(review, b"<comment>", b"</comment>")),
+            )
+            start = data.find(REVIEW_START_TAG, end)
+
+
+# Extract the labels of one review file and write them to its shard file, transforming the whole file's reviews in one
+# batch.  Reviews without a rating are skipped.  Returns the number of labels written.
+def _write_review_labels(file_and_shard):
+    filename, shard_file = file_and_shard
+    ratings, titles, comments = [], [], []
+    try:
+        for rating, title, comment in _reviews(filename):
+            if rating:
+                ratings.append(rating)
+                titles.append(title)
+                comments.append(comment)
+    except ET.ParseError as e:
+        print(
+            "Unable to parse %s, keeping the reviews before the error:\n%s"
+            % (filename, e)
+        )
+    with open(shard_file, "w") as shard:
+        shard.writelines(
+            "__label__%s %s\n" % (rating, text)
+            for (rating, text) in zip(
+                ratings, transform_training_data(titles, comments)
+            )
+        )
+    return len(ratings)
+
+
+if __name__ == "__main__":
+    files = sorted(glob.glob(os.path.join(directory, "*.xml")))
+    print("Writing results to %s" % output_file)
+    # Every file is extracted to its own shard by the pool, then the shards are merged in file order, so the output
+    # doesn't depend on which worker finishes first
+    with tempfile.TemporaryDirectory(dir=output_dir) as shard_dir:
+        shard_files = [
+            os.path.join(shard_dir, "%s.fasttext" % idx) for idx in range(len(files))
+        ]
+        with multiprocessing.Pool(args.processes) as p:
+            num_labels = sum(
+                tqdm(
+                    p.imap(_write_review_labels, zip(files, shard_files)),
+                    total=len(files),
+                )
+            )
+        with open(output_file, "wb") as output:
+            for shard_file in shard_files:
+                with open(shard_file, "rb") as shard:
+                    shutil.copyfileobj(shard, output, 1 << 22)
+    print("Wrote %s labels from %s files" % (num_labels, len(files)))
@@ -6,6 +6,7 @@ from dataclasses import dataclass
 from typing import List, Tuple
 
 import fasttext
+import numpy as np
 import pandas as pd
 
 arg_parser = argparse.ArgumentParser(description="Options for generating synonyms")
@@ -18,8 +19,19 @@ arg_parser.add_argument(
         "Synonyms have cosine similarity higher than this ``min_similarity``",
     ),
 )
+arg_parser.add_argument(
+    "--k",
+    type=int,
+    default=10,
+    help="Number of nearest neighbours considered as synonyms of each word",
+)
 args = arg_parser.parse_args()
 
+# Most similarity scores computed at once, i.e. query words per block times
+#   vocabulary size, so a block stays around 256MB of float32 whatever the
+#   vocabulary size
+MAX_BLOCK_SCORES: int = 1 << 26
+
 
 @dataclass
 class IOPathsTemplate:
@@ -44,10 +56,73 @@ IO_PATHS: IOPathsTemplate = IOPathsTemplate()
 COLNAMES: ColNamesTemplate = ColNamesTemplate()
 
 
-def generate_synonyms_file(min_similarity: float) -> None:
+def unit_vectors(vectors: np.ndarray) -> np.ndarray:
+    """Scale each row to unit length, leaving all-zero rows as they are"""
+    norms: np.ndarray = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def nearest_neighbors(
+    model: fasttext.FastText._FastText, words: List[str], k: int = 10
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Top ``k`` cosine neighbours of each word among the model vocabulary
+
+    Same neighbours as ``model.get_nearest_neighbors`` gives word by word,
+    but all the vocabulary vectors are normalized into one matrix once, and
+    the similarities of a whole block of words are scored with one matrix
+    multiply.  Blocks are sized by ``MAX_BLOCK_SCORES``.
+
+    Parameters
+    ----------
+    model: fasttext.FastText._FastText
+        | Trained embedding model
+    words: List[str]
+        | Query words; words out of the vocabulary get their vector from
+        their subwords, like ``get_nearest_neighbors``
+    k: int, default = 10
+        | Number of neighbours per word
+
+    Returns
+    -------
+    Tuple[List[str], np.ndarray, np.ndarray]
+        | Vocabulary, and for each query word the vocabulary index and cosine
+        similarity of its neighbours (``len(words)`` x ``k``), most similar
+        first.  A word is never its own neighbour.
+
+    """
+    vocabulary: List[str] = model.get_words()
+    vocabulary_vectors: np.ndarray = unit_vectors(
+        np.stack([model.get_word_vector(word) for word in vocabulary])
+    )
+    word_vectors: np.ndarray = unit_vectors(
+        np.stack([model.get_word_vector(word) for word in words])
+    )
+    # Vocabulary index of each query word, -1 if out of the vocabulary
+    word_ids: np.ndarray = np.array([model.get_word_id(word) for word in words])
+    k = min(k, len(vocabulary) - 1)
+
+    neighbors: np.ndarray = np.empty((len(words), k), dtype=np.int64)
+    similarities: np.ndarray = np.empty((len(words), k), dtype=np.float32)
+    block_size: int = max(1, MAX_BLOCK_SCORES // len(vocabulary))
+    for start in range(0, len(words), block_size):
+        end: int = min(start + block_size, len(words))
+        scores: np.ndarray = word_vectors[start:end] @ vocabulary_vectors.T
+        # A word is not its own synonym
+        in_vocabulary: np.ndarray = np.flatnonzero(word_ids[start:end] >= 0)
+        scores[in_vocabulary, word_ids[start:end][in_vocabulary]] = -np.inf
+        # Partition out the top k first, then only sort those
+        top_k: np.ndarray = np.argpartition(scores, -k, axis=1)[:, -k:]
+        top_k_scores: np.ndarray = np.take_along_axis(scores, top_k, axis=1)
+        order: np.ndarray = np.argsort(-top_k_scores, axis=1, kind="stable")
+        neighbors[start:end] = np.take_along_axis(top_k, order, axis=1)
+        similarities[start:end] = np.take_along_axis(top_k_scores, order, axis=1)
+    return vocabulary, neighbors, similarities
+
+
+def generate_synonyms_file(min_similarity: float, k: int = 10) -> None:
     """Generates headerless, single-column, comma-separated synonyms file
 
-    | Input file: 1_000 most frequent words loaded from
+    | Input file: most frequent words (e.g. 1_000 or 100_000) loaded from
     ``/workspace/datasets/fasttext/top_words.txt``
     | Output file: headerless, single-column synonyms file stored at
     ``/workspace/datasets/fasttext/synonyms.csv``
@@ -67,6 +142,8 @@ def generate_synonyms_file(min_similarity: float) -> None:
     ----------
     min_similarity: float
         | Only treat words with cosine similarity >= min_similarity as synonyms
+    k: int, default = 10
+        | Number of nearest neighbours of each word considered as synonyms
 
     Example Usages
     ---------------
@@ -122,28 +199,25 @@ def generate_synonyms_file(min_similarity: float) -> None:
     df_top_words: pd.DataFrame = pd.read_csv(
         IO_PATHS.INPUT_TOP_WORDS, header=None, sep="\t", names=[COLNAMES.WORD]
     )
-    df_synonyms: pd.DataFrame = pd.DataFrame(columns=[COLNAMES.SYNONYMS])
-
-    for __, row in df_top_words.iterrows():
-
-        word_origin: str = row[COLNAMES.WORD]
-        list_similarity_vs_word: List[Tuple[float, str]] = model.get_nearest_neighbors(
-            word_origin
+    words: List[str] = df_top_words[COLNAMES.WORD].astype(str).tolist()
+    vocabulary, neighbors, similarities = nearest_neighbors(model, words, k=k)
+
+    # Only treat words with cosine similarity (relative to word_origin)
+    #   larger than ``min_similarity`` as synonyms
+    is_synonym: np.ndarray = similarities >= min_similarity
+    synonyms: List[str] = [
+        ",".join(
+            [word_origin] + [vocabulary[idx] for idx in neighbors[row][is_synonym[row]]]
         )
-
-        # Only treat words with cosine similarity (relative to word_origin)
-        #   larger than ``min_similarity`` as synonyms
-        synonyms: List[str] = [word_origin] + [
-            entry[1] for entry in list_similarity_vs_word if entry[0] >= min_similarity
-        ]
-        if len(synonyms) > 1:
-            df_synonyms = df_synonyms.append(
-                pd.DataFrame({COLNAMES.SYNONYMS: ",".join(synonyms)}, index=[0])
-            )
+        for (row, word_origin) in enumerate(words)
+        if is_synonym[row].any()
+    ]
 
     # Generates synonyms.csv
-    df_synonyms.to_csv(IO_PATHS.OUTPUT_SYNONYMS, header=None, index=False, sep="\t")
+    pd.DataFrame({COLNAMES.SYNONYMS: synonyms}).to_csv(
+        IO_PATHS.OUTPUT_SYNONYMS, header=None, index=False, sep="\t"
+    )
 
 
 if __name__ == "__main__":
-    generate_synonyms_file(min_similarity=args.min_similarity)
+    generate_synonyms_file(min_similarity=args.min_similarity, k=args.k)
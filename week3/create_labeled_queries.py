@@ -1,7 +1,5 @@
 import argparse
-import csv
 import os
-import xml.etree.ElementTree as ET
 
 # Useful if you want to perform stemming.
 # import nltk
@@ -9,9 +7,12 @@ import numpy as np
 import pandas as pd
 
 from utils import logger
-from utils.constants import COLNAMES
-from utils.normalize_query import normalize_query_multiprocessor
-from utils.rollup_category import recursive_rollup_category
+from utils.normalize_query import (
+    N_PROCESSORS,
+    normalize_query_multiprocessor,
+)
+from utils.rollup_category import rollup_category_map
+from utils.taxonomy import Taxonomy
 
 # stemmer = nltk.stem.PorterStemmer()
 
@@ -21,6 +22,10 @@ queries_file_name = r"/workspace/datasets/train.csv"
 # output_file_name = r"/workspace/datasets/labeled_query_data.txt"
 output_file_name = r"/workspace/datasets/fasttext/labeled_queries.txt"
 
+# Rows of the query log read at a time, and size of the output write buffer
+CHUNK_SIZE = 500000
+WRITE_BUFFER_SIZE = 1 << 22
+
 parser = argparse.ArgumentParser(description="Process arguments.")
 general = parser.add_argument_group("general")
 general.add_argument(
@@ -31,6 +36,16 @@ general.add_argument(
 general.add_argument(
     "--output", default=output_file_name, help="the file to output to"
 )
+general.add_argument(
+    "--workers",
+    type=int,
+    default=N_PROCESSORS,
+    help=(
+        "Most processes to normalize queries with (default is one less than "
+        "the number of cores); fewer are used for chunks with too few unique "
+        "queries to be worth it"
+    ),
+)
 
 args = parser.parse_args()
 output_file_name = args.output
@@ -38,29 +53,13 @@ output_file_name = args.output
 if args.min_queries:
     min_queries = int(args.min_queries)
 
-# The root category, named Best Buy with id cat00000, doesn't have a parent.
-root_category_id = "cat00000"
-
-tree = ET.parse(categories_file_name)
-root = tree.getroot()
-
-# Parse the category XML file to map each category id to its parent category id in a dataframe.
-categories, categories_names = [], []
-parents = []
-for child in root:
-    id = child.find("id").text
-    cat_path = child.find("path")
-    cat_path_ids = [cat.find("id").text for cat in cat_path]
-    cat_path_names = [cat.find("name").text for cat in cat_path]
-    leaf_id = cat_path_ids[-1]
-    leaf_name = cat_path_names[-1]
-    if leaf_id != root_category_id:
-        categories.append(leaf_id)
-        categories_names.append(leaf_name)
-        parents.append(cat_path_ids[-2])
-parents_df = pd.DataFrame(
-    list(zip(categories, parents)), columns=["category", "parent"]
-)
+# Load the category tree, parsing the category XML file only if its cached
+#   arrays are out of date.  Map each category id to its parent category id
+#   in a dataframe.
+taxonomy = Taxonomy.load(categories_file_name)
+parents_df = taxonomy.parents_df()
+categories = parents_df["category"]
+categories_names = taxonomy.names[taxonomy.parents >= 0]
 
 # Add auxiliary CSV with category code vs. category name records
 # Example: $ head -n 4 product_category_names.csv
@@ -77,44 +76,64 @@ categories_df.to_csv(
     "/workspace/datasets/fasttext/product_category_names.csv", index=False
 )
 
-# Read the training data into pandas, only keeping queries with non-root categories in our category tree.
-df = pd.read_csv(queries_file_name)[["category", "query"]]
-df = df[df["category"].isin(categories)]
-# NOTE: Duplicated rows are preserved to reflect the true traffic!
-
-# IMPLEMENT ME: Convert queries to lowercase,
-#   and optionally implement other normalization, like stemming.
-df = normalize_query_multiprocessor(df)
+# Read the training data in two passes, so memory doesn't grow with the size
+#   of the query log:
+# 1. Count the queries of each category, only keeping queries with non-root
+#   categories in our category tree, and work out the rollup from the counts
+# 2. Stream the queries again a chunk at a time, normalizing them and writing
+#   them out under their rolled up category
+# NOTE: Duplicated rows are counted to reflect the true traffic!
+n_queries_per_category = pd.Series(dtype=np.int64)
+for df_chunk in pd.read_csv(
+    queries_file_name, usecols=["category"], chunksize=CHUNK_SIZE
+):
+    n_queries_per_category = n_queries_per_category.add(
+        df_chunk.loc[
+            df_chunk["category"].isin(categories), "category"
+        ].value_counts(),
+        fill_value=0,
+    )
 
 
 # IMPLEMENT ME: Roll up categories to ancestors to
 #   satisfy the minimum number of queries per category.
 logger.info(
     "Query dataframe has %s unique categories before applying rollup",
-    df[COLNAMES.THIS_CATEGORY].nunique(),
+    len(n_queries_per_category),
 )
 logger.info(
     "Apply category rollup with min_n_queries_this_category = %s", min_queries
 )
-df = recursive_rollup_category(
-    df, df_category_tree=parents_df, min_n_queries_this_category=min_queries
+rolled_up_categories = rollup_category_map(
+    n_queries_per_category.astype(np.int64),
+    df_category_tree=parents_df,
+    min_n_queries_this_category=min_queries,
 )
 logger.info(
     "Query dataframe has %s unique categories after applying rollup",
-    df[COLNAMES.THIS_CATEGORY].nunique(),
+    rolled_up_categories.nunique(),
 )
 
 
-# Create labels in fastText format.
-df["label"] = "__label__" + df["category"]
-# Output labeled query data as a space-separated file, making sure that every category is in the taxonomy.
-df = df[df["category"].isin(categories)]
-df["output"] = df["label"] + " " + df["query"]
-df[["output"]].to_csv(
-    output_file_name,
-    header=False,
-    sep="|",
-    escapechar="\\",
-    quoting=csv.QUOTE_NONE,
-    index=False,
-)
+# Output labeled query data in fastText format, one space-separated label and
+#   query per line, making sure that every category is in the taxonomy.
+with open(output_file_name, "w", buffering=WRITE_BUFFER_SIZE) as output_file:
+    for df in pd.read_csv(
+        queries_file_name,
+        usecols=["category", "query"],
+        chunksize=CHUNK_SIZE,
+    ):
+        df = df[df["category"].isin(categories)]
+        # IMPLEMENT ME: Convert queries to lowercase,
+        #   and optionally implement other normalization, like stemming.
+        df = normalize_query_multiprocessor(df, n_processors=args.workers)
+        df["category"] = df["category"].map(rolled_up_categories)
+        df = df[df["category"].isin(categories) & df["query"].notna()]
+        output_file.write(
+            "".join(
+                [
+                    f"__label__{category} {query}\n"
+                    for (category, query) in zip(df["category"], df["query"])
+                ]
+            )
+        )
@@ -1,9 +1,15 @@
 import argparse
 import os
 import sys
-import xml.etree.ElementTree as ET
 from pathlib import Path
 
+import pandas as pd
+
+from utils.taxonomy import Taxonomy
+
+# Prefix of the labels fastText predicts
+LABEL_PREFIX = "__label__"
+
 # Location for category data
 categoriesFilename = "/workspace/datasets/product_data/categories/categories_0001_abcat0010000_to_pcmcat99300050000.xml"
 parser = argparse.ArgumentParser(description="Leaves to paths.")
@@ -17,6 +23,33 @@ general.add_argument(
     "--max_depth", default=0, type=int, help="the file to output to"
 )
 
+batch = parser.add_argument_group("batch")
+batch.add_argument(
+    "--leaves",
+    help="Resolve all the leaf ids in this file at once instead of reading stdin line by line. "
+    "Either one id per line, or a CSV with --column",
+)
+batch.add_argument(
+    "--column",
+    help="With --leaves, the CSV column holding the leaf ids. "
+    "The input rows are written back out with the paths added as --path_column",
+)
+batch.add_argument(
+    "--path_column",
+    default="category_path",
+    help="With --column, the name of the column to write the paths to",
+)
+batch.add_argument(
+    "--output",
+    help="With --leaves, the file to write to (default is stdout)",
+)
+batch.add_argument(
+    "--chunk_size",
+    default=1000000,
+    type=int,
+    help="With --leaves, the number of leaf ids to resolve at a time",
+)
+
 args = parser.parse_args()
 
 categoriesFilename = args.input
@@ -24,26 +57,50 @@ categoriesFilename = args.input
 # Optional arg to specify max depth of category tree
 maxDepth = args.max_depth
 
-tree = ET.parse(categoriesFilename)
-root = tree.getroot()
-
-catDict = {}
-
-for child in root:
-    catPath = child.find("path")
-    leafCat = catPath[-1].find("id").text
-    catPathStr = ""
-    depth = 0
-    for cat in catPath:
-        if catPathStr != "":
-            catPathStr = catPathStr + " > "
-        catPathStr = catPathStr + cat.find("name").text
-        depth = depth + 1
-        if maxDepth > 0 and depth == maxDepth:
-            break
-    catDict[leafCat] = catPathStr
-
-for line in sys.stdin:
-    cat = line.rstrip("\n")
-    if cat in catDict:
-        print(catDict[cat])
+taxonomy = Taxonomy.load(categoriesFilename)
+
+
+# Paths for a whole batch of leaf ids at once, through the precomputed path
+#   table.  Predicted fastText labels (__label__<id>) work as is.  Ids not in
+#   the taxonomy get an empty path.
+def resolvePaths(leaves):
+    leaves = pd.Series(leaves, dtype=object).str.strip()
+    leaves = leaves.str.replace(f"^{LABEL_PREFIX}", "", regex=True)
+    return pd.Series(
+        taxonomy.path_names(taxonomy.index_of(leaves), maxDepth),
+        index=leaves.index,
+    ).fillna("")
+
+
+if args.leaves is None:
+    catDict = dict(zip(taxonomy.ids, taxonomy.path_table(maxDepth)))
+
+    for line in sys.stdin:
+        cat = line.rstrip("\n")
+        if cat in catDict:
+            print(catDict[cat])
+else:
+    # One output line or row per input line or row, even for unknown ids,
+    #   so the output lines up with the input
+    output = (
+        open(args.output, "w", buffering=1 << 20)
+        if args.output
+        else sys.stdout
+    )
+    if args.column is None:
+        with open(args.leaves) as leavesFile:
+            while True:
+                leaves = leavesFile.readlines(args.chunk_size * 16)
+                if len(leaves) == 0:
+                    break
+                output.write("\n".join(resolvePaths(leaves)) + "\n")
+    else:
+        header = True
+        for chunk in pd.read_csv(
+            args.leaves, dtype={args.column: str}, chunksize=args.chunk_size
+        ):
+            chunk[args.path_column] = resolvePaths(chunk[args.column])
+            chunk.to_csv(output, header=header, index=False)
+            header = False
+    if output is not sys.stdout:
+        output.close()
@@ -2,14 +2,15 @@
 """
 from __future__ import annotations
 
+import functools
 import multiprocessing
 import re
-from typing import Generator, List
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import nltk
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
 from unidecode import unidecode
 
 from utils import logger
@@ -18,6 +19,20 @@ from utils.constants import COLNAMES
 # Number of processors to be used for embarrassingly parallel jobs
 N_PROCESSORS: int = multiprocessing.cpu_count() - 1
 
+# One stemmer for the whole module; building one per token is most of the
+#   cost of stemming
+PORTER_STEMMER: nltk.stem.PorterStemmer = nltk.stem.PorterStemmer()
+
+
+@functools.lru_cache(maxsize=None)
+def stem(token: str) -> str:
+    """Porter stem of a token, memoized
+
+    | Query logs repeat the same tokens over and over,
+    so each distinct token is only ever stemmed once
+    """
+    return PORTER_STEMMER.stem(token)
+
 
 class TextNormalizer:
     """Multi-step pipeline for normalizing input text
@@ -70,47 +85,144 @@ class TextNormalizer:
         return self
 
     def stemmer(self) -> TextNormalizer:
-        self.tokens = [
-            nltk.stem.PorterStemmer().stem(token) for token in self.tokens
-        ]
+        self.tokens = [stem(token) for token in self.tokens]
         return self
 
     def done(self) -> str:
         return " ".join(self.tokens)
 
 
+def normalize_texts(texts: Iterable[str]) -> np.ndarray:
+    """Normalize strings the same way as ``TextNormalizer``, a column at a time
+
+    | Lower casing, accent stripping and non-word removal run over the whole
+    column; tokens are then deduplicated so each distinct token is stemmed
+    once and looked up from there
+
+    Parameters
+    ----------
+    texts : Iterable[str]
+        | Strings to normalize, ideally already deduplicated
+
+    Returns
+    -------
+    np.ndarray
+        | Normalized strings, in the same order as ``texts``
+
+    """
+    texts = pd.Series(texts, dtype=object)
+    token_lists: pd.Series = (
+        texts.str.lower()
+        .map(unidecode)
+        .str.replace(r"\W", " ", regex=True)
+        .str.split()
+    )
+    vocabulary: np.ndarray = pd.unique(token_lists.explode().dropna())
+    stems: Dict[str, str] = {token: stem(token) for token in vocabulary}
+    return np.array(
+        [
+            " ".join([stems[token] for token in tokens])
+            for tokens in token_lists
+        ],
+        dtype=object,
+    )
+
+
 def normalize_query(df_query: pd.DataFrame) -> pd.DataFrame:
-    df_query[COLNAMES.QUERY] = df_query[COLNAMES.QUERY].apply(
-        lambda x: TextNormalizer(x.lower())
-        .strip_accents()
-        .remove_non_word()
-        .tokenize()
-        .stemmer()
-        .done()
+    """Normalize the query column in place
+
+    | Query logs repeat the same strings massively, so only the distinct
+    queries are normalized and the results are mapped back to every row
+    through their categorical codes
+
+    Parameters
+    ----------
+    df_query : pd.DataFrame
+        | Input dataframe containing raw queries that are to be normalized
+
+    Returns
+    -------
+    pd.DataFrame
+        | Output dataframe containing normalized queries
+
+    """
+    query_codes, unique_queries = pd.factorize(df_query[COLNAMES.QUERY])
+    logger.info(
+        "Normalize %s unique queries out of %s",
+        len(unique_queries),
+        len(df_query),
     )
+    # NOTE: Missing queries have code -1 and stay missing
+    normalized: np.ndarray = np.append(normalize_texts(unique_queries), np.nan)
+    df_query[COLNAMES.QUERY] = normalized[query_codes]
     return df_query
 
 
-def chunckenize_input_df(
-    df_whole, n_chunks: int = N_PROCESSORS
-) -> Generator[pd.DataFrame, None, None]:
-    """Split input dataframes into n_chunks
+# Fewest unique queries worth handing to a worker process; below this,
+#   starting workers costs more than the normalization itself
+MIN_QUERIES_PER_WORKER: int = 50000
+
+# Shared memory holding the unique queries, attached once per worker process
+_shared_queries: Optional[Tuple[shared_memory.SharedMemory, ...]] = None
+
+
+def n_workers_for(n_queries: int, n_processors: int = N_PROCESSORS) -> int:
+    """Number of worker processes worth using for ``n_queries`` queries"""
+    return max(1, min(n_processors, n_queries // MIN_QUERIES_PER_WORKER))
+
 
-    Each chunk users 1 processor in subsequent multi-processor parallelization
+def _init_normalize_worker(buffer_name: str, offsets_name: str) -> None:
+    global _shared_queries
+    _shared_queries = (
+        shared_memory.SharedMemory(name=buffer_name),
+        shared_memory.SharedMemory(name=offsets_name),
+    )
+
+
+def _normalize_shared_queries(
+    bounds: Tuple[int, int],
+) -> Tuple[np.ndarray, List[str]]:
+    """Normalize the unique queries ``bounds[0]:bounds[1]`` in shared memory
+
+    Returns
+    -------
+    Tuple[np.ndarray, List[str]]
+        | Code of each query's normalized form,
+        and the distinct normalized forms the codes point to
     """
-    return iter(np.array_split(df_whole, n_chunks))
+    start, end = bounds
+    buffer, offsets_buffer = _shared_queries
+    offsets = np.ndarray(
+        (offsets_buffer.size // 8,), dtype=np.int64, buffer=offsets_buffer.buf
+    )[start : end + 1].tolist()
+    data: bytes = bytes(buffer.buf[offsets[0] : offsets[-1]])
+    queries: List[str] = [
+        data[begin - offsets[0] : stop - offsets[0]].decode("utf-8")
+        for (begin, stop) in zip(offsets[:-1], offsets[1:])
+    ]
+    codes, uniques = pd.factorize(normalize_texts(queries))
+    return codes.astype(np.int32), list(uniques)
 
 
-def normalize_query_multiprocessor(df_query: pd.DataFrame):
+def normalize_query_multiprocessor(
+    df_query: pd.DataFrame, n_processors: int = N_PROCESSORS
+) -> pd.DataFrame:
     """Multi-processor runner for normalizing query text
 
-    | Parallelization is fulfilled with ``joblib`` and
-    the computation is distributed across data chunks
+    | Only the unique queries are shipped to the workers, as one UTF-8 buffer
+    plus offsets in shared memory, so nothing but chunk bounds gets pickled
+    on the way in.  Workers send back the code of each query's normalized
+    form and the distinct normalized forms, which are merged and mapped back
+    to every row.
+    | The number of workers depends on the number of unique queries
+    (see ``n_workers_for``); if one is enough, this is ``normalize_query``.
 
     Parameters
     ----------
     df_query : pd.DataFrame
         | Input dataframe containing raw queries that are to be normalized
+    n_processors : int
+        | Most worker processes to use
 
     Returns
     -------
@@ -118,12 +230,63 @@ def normalize_query_multiprocessor(df_query: pd.DataFrame):
         | Output dataframe containing normalized queries
 
     """
+    query_codes, unique_queries = pd.factorize(df_query[COLNAMES.QUERY])
+    n_workers: int = n_workers_for(len(unique_queries), n_processors)
+    if n_workers == 1:
+        return normalize_query(df_query)
     logger.info(
-        "Distribute query normalization task onto %s processors", N_PROCESSORS
+        "Distribute normalization of %s unique queries onto %s processors",
+        len(unique_queries),
+        n_workers,
     )
-    result_list = Parallel(n_jobs=multiprocessing.cpu_count() - 1)(
-        delayed(normalize_query)(chunk)
-        for chunk in chunckenize_input_df(df_query)
+    encoded: List[bytes] = [query.encode("utf-8") for query in unique_queries]
+    offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(query) for query in encoded], out=offsets[1:])
+    buffer = shared_memory.SharedMemory(create=True, size=max(1, offsets[-1]))
+    offsets_buffer = shared_memory.SharedMemory(
+        create=True, size=offsets.nbytes
     )
+    try:
+        buffer.buf[: offsets[-1]] = b"".join(encoded)
+        np.ndarray(offsets.shape, dtype=np.int64, buffer=offsets_buffer.buf)[
+            :
+        ] = offsets
+        # A few chunks per worker, so a slow chunk doesn't hold up the rest
+        bounds = np.linspace(0, len(encoded), n_workers * 4 + 1).astype(int)
+        with multiprocessing.Pool(
+            processes=n_workers,
+            initializer=_init_normalize_worker,
+            initargs=(buffer.name, offsets_buffer.name),
+        ) as pool:
+            results = pool.map(
+                _normalize_shared_queries, list(zip(bounds[:-1], bounds[1:]))
+            )
+    finally:
+        buffer.close()
+        buffer.unlink()
+        offsets_buffer.close()
+        offsets_buffer.unlink()
     logger.info("Multiprocessor run completed")
-    return pd.concat(result_list, axis=0)
+
+    # Codes from each chunk point into that chunk's normalized forms, so
+    #   shift them into the concatenated forms, then dedupe across chunks
+    chunk_offsets = np.cumsum([0] + [len(uniques) for (_, uniques) in results])
+    unique_codes: np.ndarray = np.concatenate(
+        [
+            codes + offset
+            for ((codes, _), offset) in zip(results, chunk_offsets)
+        ]
+    )
+    merged_codes, normalized = pd.factorize(
+        np.array(
+            [form for (_, uniques) in results for form in uniques],
+            dtype=object,
+        )
+    )
+    # NOTE: Missing queries have code -1 and stay missing
+    normalized = np.append(normalized, np.nan)
+    row_codes: np.ndarray = np.where(
+        query_codes >= 0, merged_codes[unique_codes][query_codes], -1
+    )
+    df_query[COLNAMES.QUERY] = normalized[row_codes]
+    return df_query
@@ -1,105 +1,154 @@
 """Utility module for rolling up category tree"""
+
+from typing import Tuple
+
+import numpy as np
 import pandas as pd
 
 from utils.constants import COLNAMES
 
 
-class Helper:
-    """Helper class for rolling up categories"""
-
-    @staticmethod
-    def update_n_queries_this_category(
-        df_query_vs_category: pd.DataFrame,
-    ) -> pd.DataFrame:
-        """Updates number of queries belonging to each category
-
-        Parameters
-        ----------
-        df_query_vs_category : pd.DataFrame
-            | Input query vs. category dataframe.
-            Example:
-            >>> df_query_vs_category.head(3)
-                    category                                query
-            0        abcat0101001  Televisiones Panasonic  50 pulgadas
-            1        abcat0101001                                Sharp
-            2  pcmcat193100050014                                 nook
-
-        Returns
-        -------
-        pd.DataFrame
-            | Query vs. category dataframe with an additional coloumn
-            tallying the number of queries associated with each category
-            Example:
-            >>> df_query_vs_category.head(3)
-
-        """
-        if COLNAMES.N_QUERIES_THIS_CATEGORY in df_query_vs_category.columns:
-            df_query_vs_category.drop(
-                columns=[COLNAMES.N_QUERIES_THIS_CATEGORY],
-                inplace=True,
-            )
-        # NOTE: Duplicates are KEPT when tallying number of queries
-        #   associated with each category
-        return df_query_vs_category.join(
-            df_query_vs_category.groupby(COLNAMES.THIS_CATEGORY).agg(
-                **{
-                    COLNAMES.N_QUERIES_THIS_CATEGORY: pd.NamedAgg(
-                        column=COLNAMES.QUERY,
-                        aggfunc=pd.Series.count,
-                    )
-                }
-            ),
-            on=COLNAMES.THIS_CATEGORY,
-        )
+def category_tree_arrays(
+    df_category_tree: pd.DataFrame,
+) -> Tuple[pd.Index, np.ndarray, np.ndarray]:
+    """Compact array form of a category tree
+
+    Parameters
+    ----------
+    df_category_tree : pd.DataFrame
+        | Category tree dataframe
+        Example:
+        >>> parents_df.head(3)
+            category        parent
+        0  abcat0010000      cat00000
+        1  abcat0011000  abcat0010000
+        2  abcat0011001  abcat0011000
 
-    @staticmethod
-    def merge_to_parent_category(
-        df_rollup_candidates: pd.DataFrame, df_category_tree: pd.DataFrame
-    ) -> pd.DataFrame:
-        """Merge child to parent category
-
-        | Achieved by replacing "category" values with their immediate parents
-        (child-parent connections obtained from ``df_category_tree``)
-
-        Parameters
-        ----------
-        df_rollup_candidates : pd.DataFrame
-            | Query vs. category dataframe subset with categories
-            that contain too few queries
-            and thus need to be merged with parent categories
-        df_category_tree : pd.DataFrame
-            | Category tree dataframe
-            Example:
-            >>> parents_df.head(3)
-                category        parent
-            0  abcat0010000      cat00000
-            1  abcat0011000  abcat0010000
-            2  abcat0011001  abcat0011000
-
-        Returns
-        -------
-        pd.DataFrame
-            Query vs. category dataframe after category rollup
-
-        """
-        return (
-            df_rollup_candidates.join(
-                df_category_tree.set_index(COLNAMES.THIS_CATEGORY),
-                on=COLNAMES.THIS_CATEGORY,
-                how="left",
-            )
-            .drop(columns=[COLNAMES.THIS_CATEGORY])
-            .rename(columns={COLNAMES.PARENT_CATEGORY: COLNAMES.THIS_CATEGORY})
+    Returns
+    -------
+    Tuple[pd.Index, np.ndarray, np.ndarray]
+        | Index of every category id (children and parents),
+        index of each category's parent (-1 for roots)
+        and depth of each category (0 for roots)
+
+    """
+    category_ids = pd.Index(
+        pd.unique(
+            pd.concat(
+                [
+                    df_category_tree[COLNAMES.THIS_CATEGORY],
+                    df_category_tree[COLNAMES.PARENT_CATEGORY],
+                ],
+                ignore_index=True,
+            ).dropna()
         )
+    )
+    parents = np.full(len(category_ids), -1, dtype=np.int64)
+    parents[
+        category_ids.get_indexer(df_category_tree[COLNAMES.THIS_CATEGORY])
+    ] = category_ids.get_indexer(df_category_tree[COLNAMES.PARENT_CATEGORY])
+    # Every step moves all categories one ancestor up at once,
+    #   so this loops as many times as the tree is deep
+    depths = np.zeros(len(category_ids), dtype=np.int64)
+    ancestors = parents.copy()
+    while (ancestors >= 0).any():
+        has_ancestor = ancestors >= 0
+        depths[has_ancestor] += 1
+        ancestors[has_ancestor] = parents[ancestors[has_ancestor]]
+        if depths.max() > len(category_ids):
+            raise ValueError("Category tree has a cycle")
+    return category_ids, parents, depths
+
+
+def rollup_category_map(
+    n_queries_per_category: pd.Series,
+    *,
+    df_category_tree: pd.DataFrame,
+    min_n_queries_this_category: int,
+) -> pd.Series:
+    """Category each category rolls up to, given its number of queries
 
+    | Walking the tree bottom-up, one depth at a time, a category whose count
+    (its own queries plus those rolled up from its descendants) is below the
+    minimum passes its count to its parent.  Each category then resolves to
+    its nearest ancestor (or itself) that was kept.
+    | Only the counts are needed, so they can be tallied over a query log
+    too big to hold in memory.
 
-def recursive_rollup_category(
+    Parameters
+    ----------
+    n_queries_per_category : pd.Series
+        | Number of queries of each category, indexed by category
+    df_category_tree : pd.DataFrame
+        | Category tree dataframe, with category and parent columns
+        (see ``category_tree_arrays``)
+    min_n_queries_this_category : int
+        | Minimum number of queries that a category must contain
+
+    Returns
+    -------
+    pd.Series
+        | Rolled up category of each category in ``n_queries_per_category``,
+        missing for categories with no kept ancestor
+
+    """
+    category_ids, parents, depths = category_tree_arrays(df_category_tree)
+    # Categories that show up in the queries but not in the tree are roots
+    query_categories = pd.Index(n_queries_per_category.index)
+    category_ids = category_ids.append(
+        query_categories.difference(category_ids, sort=False)
+    )
+    n_missing = len(category_ids) - len(parents)
+    parents = np.append(parents, np.full(n_missing, -1, dtype=np.int64))
+    depths = np.append(depths, np.zeros(n_missing, dtype=np.int64))
+
+    query_category_index = category_ids.get_indexer(query_categories)
+    n_queries = np.zeros(len(category_ids), dtype=np.int64)
+    np.add.at(
+        n_queries,
+        query_category_index,
+        n_queries_per_category.to_numpy(dtype=np.int64),
+    )
+    keep = np.zeros(len(category_ids), dtype=bool)
+    for depth in range(depths.max(initial=0), -1, -1):
+        at_depth = np.flatnonzero(depths == depth)
+        keep[at_depth] = n_queries[at_depth] >= min_n_queries_this_category
+        rolled_up = at_depth[~keep[at_depth] & (parents[at_depth] >= 0)]
+        np.add.at(n_queries, parents[rolled_up], n_queries[rolled_up])
+
+    # Resolve every category to its nearest kept ancestor-or-self,
+    #   top-down so that parents are always resolved first
+    resolved = np.full(len(category_ids), -1, dtype=np.int64)
+    for depth in range(depths.max(initial=0) + 1):
+        at_depth = np.flatnonzero(depths == depth)
+        from_parent = at_depth[~keep[at_depth] & (parents[at_depth] >= 0)]
+        resolved[at_depth[keep[at_depth]]] = at_depth[keep[at_depth]]
+        resolved[from_parent] = resolved[parents[from_parent]]
+
+    # NOTE: Index -1 (no kept ancestor) picks the NaN appended at the end
+    category_names = np.append(category_ids.to_numpy(dtype=object), np.nan)
+    return pd.Series(
+        category_names[resolved[query_category_index]],
+        index=query_categories,
+        dtype=object,
+    )
+
+
+def rollup_category(
     df_query_vs_category: pd.DataFrame,
     *,
     df_category_tree: pd.DataFrame,
     min_n_queries_this_category: int,
-):
-    """Category rollup implemented with recursion
+) -> pd.DataFrame:
+    """Roll up categories with too few queries into their ancestors
+
+    | Queries are counted per category once, rolled up with
+    ``rollup_category_map`` and the category column is remapped in one step.
+    | Unlike rolling up one tree level at a time over the query rows,
+    a category's count includes everything rolled up from below before
+    it is decided whether to keep it.
+    | Queries with no kept ancestor (e.g. the root has too few queries)
+    end up with a missing category.
 
     Parameters
     ----------
@@ -112,13 +161,8 @@ def recursive_rollup_category(
         1        abcat0101001                                Sharp
         2  pcmcat193100050014                                 nook
     df_category_tree : pd.DataFrame
-        | Category tree dataframe
-        Example:
-        >>> parents_df.head(3)
-            category        parent
-        0  abcat0010000      cat00000
-        1  abcat0011000  abcat0010000
-        2  abcat0011001  abcat0011000
+        | Category tree dataframe, with category and parent columns
+        (see ``category_tree_arrays``)
     min_n_queries_this_category : int
         | Minimum number of queries that a category must contain;
         Categories with n_queries_this_category < min_n_queries_this_category
@@ -130,43 +174,26 @@ def recursive_rollup_category(
         df_query_vs_category after category rollup
 
     """
-    # 1. Attach or update "n_queries_this_category" column
-    df_query_vs_category = Helper.update_n_queries_this_category(
-        df_query_vs_category
+    category_codes, query_categories = pd.factorize(
+        df_query_vs_category[COLNAMES.THIS_CATEGORY]
     )
-
-    # 2. Extract records with number of products per category below
-    #   threshold ``min_n_queries_this_category``
-    # These are the category candidates that
-    #   require recursive merging of leaf nodes into ancestors
-    df_rollup_candidates: pd.DataFrame = df_query_vs_category.query(
-        f"{COLNAMES.N_QUERIES_THIS_CATEGORY} < {min_n_queries_this_category}"
-    )
-    if len(df_rollup_candidates) == 0:
-        # If no records require rolling up,
-        #   the query vs. category dataframe is ready as output
-        return df_query_vs_category.drop(
-            columns=[COLNAMES.N_QUERIES_THIS_CATEGORY], errors="ignore"
-        ).reset_index(drop=True)
-
-    # 3. Keep track of records that don't require rollup
-    df_unchanged: pd.DataFrame = df_query_vs_category.query(
-        f"{COLNAMES.N_QUERIES_THIS_CATEGORY} >= {min_n_queries_this_category}"
-    )
-
-    # 4. Update category by merging leaf to parent
-    df_rollup_candidates = Helper.merge_to_parent_category(
-        df_rollup_candidates, df_category_tree
+    # NOTE: Duplicates are KEPT when tallying number of queries
+    #   associated with each category
+    n_queries = pd.Series(
+        np.bincount(
+            category_codes[category_codes >= 0],
+            minlength=len(query_categories),
+        ),
+        index=query_categories,
     )
-
-    # 5. Combine rolled-up records and unchanged records
-    df_query_vs_category = pd.concat(
-        [df_unchanged, df_rollup_candidates], axis=0, ignore_index=True
-    ).drop(columns=[COLNAMES.N_QUERIES_THIS_CATEGORY])
-
-    # Recursive call again until exit condition is met
-    return recursive_rollup_category(
-        df_query_vs_category,
+    rolled_up = rollup_category_map(
+        n_queries,
         df_category_tree=df_category_tree,
         min_n_queries_this_category=min_n_queries_this_category,
     )
+    # NOTE: Code -1 (a missing category) picks the NaN appended at the end
+    rolled_up_categories = np.append(rolled_up.to_numpy(dtype=object), np.nan)
+    df_query_vs_category[COLNAMES.THIS_CATEGORY] = rolled_up_categories[
+        category_codes
+    ]
+    return df_query_vs_category.reset_index(drop=True)
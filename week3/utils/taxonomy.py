@@ -0,0 +1,25 @@
+"""Category taxonomy, shared with the week2 scripts
+
+| The implementation lives in the repository level
+``utilities/category_taxonomy.py``, so that scripts outside week3 can use it
+without importing this package (and its logging setup).  It has a name of its
+own so that it can't resolve to this module.  This module is the one place
+week3 reaches it from.
+"""
+
+import os
+import sys
+
+sys.path.append(
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "..", "utilities"
+    )
+)
+from category_taxonomy import (  # noqa: E402
+    CATEGORIES_FILE,
+    PATH_SEPARATOR,
+    ROOT_CATEGORY_ID,
+    Taxonomy,
+)
+
+__all__ = ["CATEGORIES_FILE", "PATH_SEPARATOR", "ROOT_CATEGORY_ID", "Taxonomy"]